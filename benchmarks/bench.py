@@ -0,0 +1,425 @@
+"""
+Benchmarks and conformance checks for the interpreter, compiler and grading.
+
+Usage (from repository root):
+    python benchmarks/bench.py                      # check and benchmark
+    python benchmarks/bench.py --check              # conformance only
+    python benchmarks/bench.py -o new.json -b old.json
+    python benchmarks/bench.py --record             # rewrite expected.json
+
+Conformance: every corpus program is run by every engine and its final
+state is compared with `expected.json`, which is recorded from the
+interpreter of the first release (see `legacy`). Programs, which must not
+compile, are checked to fail with the expected error. Runs which hit a time
+or step limit only have to fail the same way, since engines may stop them
+at different points. Optimised programs are compared by stack, registers,
+error and position mapped back to the source program.
+
+Benchmarks: compile time of every program, instructions per second of
+`VM.run` with and without the block compiler, and latency of grading
+a compiled program with `grading.run_tests`. Results are written as JSON
+and can be compared with results of another revision.
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import pathlib
+import platform
+import sys
+import time
+import typing
+
+ROOT = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT.parent / "server"))
+
+import corpus  # noqa: E402
+import grading  # noqa: E402
+import legacy  # noqa: E402
+import leninec  # noqa: E402
+from leninec.lanes import np, run_lanes  # noqa: E402
+
+EXPECTED = ROOT / "expected.json"
+
+State = typing.Dict[str, typing.Any]
+Engine = typing.Callable[[leninec.Program, corpus.Case], typing.List[State]]
+
+
+def templates() -> typing.Dict[str, str]:
+    """Read `TEMPLATES` from app.py without importing the app."""
+    tree = ast.parse((ROOT.parent / "server" / "app.py").read_text())
+    for node in tree.body:
+        if (
+            isinstance(node, ast.Assign)
+            and isinstance(node.targets[0], ast.Name)
+            and node.targets[0].id == "TEMPLATES"
+        ):
+            return ast.literal_eval(node.value)
+
+    raise LookupError("TEMPLATES are not defined in app.py")
+
+
+def compile_program(source: str) -> leninec.Program:
+    vm = leninec.VM()
+    vm.cache = None
+    vm.update_code(source)
+    return vm.program
+
+
+def _state(
+    stack: typing.Sequence[int],
+    registers: typing.Sequence[int],
+    position: int,
+    steps: int,
+    error: typing.Optional[BaseException],
+) -> State:
+    return {
+        "stack": list(stack),
+        "registers": list(registers),
+        "position": position,
+        "steps": steps,
+        "error": None if error is None else error.__class__.__name__,
+    }
+
+
+async def _run_vm(
+    program: leninec.Program,
+    case: corpus.Case,
+    jit: bool = True,
+    hooks: bool = False,
+) -> typing.List[State]:
+    vm = leninec.VM()
+    vm.delay = 0
+    vm.jit = jit
+    vm.load(program)
+    if hooks:
+        # Any hook forces step by step execution
+
+        @vm.on_step
+        async def _(event):
+            pass
+
+    states = []
+    for inp in case.inputs:
+        vm.reset_state()
+        vm.stack.extend(reversed(inp))
+        error = None
+        try:
+            await vm.run(timeout=None, max_steps=case.max_steps)
+        except (leninec.errors.VMError, ZeroDivisionError) as e:
+            error = e
+
+        states.append(_state(vm.stack, vm.registers, vm.position, vm.steps, error))
+
+    return states
+
+
+class _LegacyVM(legacy.VM):
+    """
+    Interpreter of the first release, which reports position and executed
+    steps like `VM`. `check_state` is called before every instruction and
+    once after the last one, so steps are counted there.
+    """
+
+    def __init__(self, max_steps: typing.Optional[int] = None):
+        super().__init__()
+        self.delay = 0
+        self.max_steps: typing.Optional[int] = max_steps
+        self.position: int = 0
+        self.steps: int = 0
+        self.checking: bool = False
+        self.add_position_change_hook(self._move)
+
+    async def _move(self, position: int):
+        self.position = position
+
+    def check_state(self) -> bool:
+        self.checking = True
+        super().check_state()
+        if self.position < len(self.instructions):
+            if self.max_steps is not None and self.steps >= self.max_steps:
+                raise leninec.StepLimitExceededError(
+                    f"Step limit of {self.max_steps} exceeded"
+                )
+
+            self.steps += 1
+
+        self.checking = False
+        return True
+
+
+async def _run_legacy(case: corpus.Case) -> typing.List[State]:
+    states = []
+    for inp in case.inputs:
+        vm = _LegacyVM(case.max_steps)
+        vm.update_code(case.source)
+        vm.stack.extend(reversed(inp))
+        error = None
+        try:
+            await vm.run(timeout=None)
+        except (legacy.errors.VMError, leninec.errors.VMError, ZeroDivisionError) as e:
+            error = e
+
+        # Position is not moved past an instruction which failed, while `VM`
+        # reports the next one as with errors found by `check_state`
+        position = vm.position + (error is not None and not vm.checking)
+        states.append(
+            _state(vm.stack, vm.registers.values(), position, vm.steps, error)
+        )
+
+    return states
+
+
+def _run_lanes(
+    program: leninec.Program,
+    case: corpus.Case,
+    vectorize: bool = False,
+) -> typing.List[State]:
+    return [
+        _state(lane.stack, lane.registers, lane.position, lane.steps, lane.error)
+        for lane in run_lanes(
+            program,
+            (list(reversed(inp)) for inp in case.inputs),
+            vectorize=vectorize,
+            max_steps=case.max_steps,
+        )
+    ]
+
+
+def _run_optimized(program: leninec.Program, case: corpus.Case) -> typing.List[State]:
+    optimized = leninec.optimize(program)
+    states = _run_lanes(optimized, case)
+    for state in states:
+        state["position"] = optimized.source_position(
+            state["position"],
+            failed=state["error"] is not None,
+        )
+
+    return states
+
+
+ENGINES: typing.Dict[str, Engine] = {
+    "interpreter": lambda program, case: asyncio.run(_run_vm(program, case, jit=False)),
+    "jit": lambda program, case: asyncio.run(_run_vm(program, case)),
+    "hooks": lambda program, case: asyncio.run(_run_vm(program, case, hooks=True)),
+    "lanes": _run_lanes,
+    "optimized": _run_optimized,
+}
+if np is not None:
+    ENGINES["vector"] = lambda program, case: _run_lanes(program, case, vectorize=True)
+
+# Engines, which do not preserve number of executed steps
+INEXACT_STEPS: typing.FrozenSet[str] = frozenset({"optimized"})
+
+TIME_LIMITS: typing.FrozenSet[str] = frozenset(
+    {"TimeoutExceededError", "InfiniteLoopError", "StepLimitExceededError"}
+)
+
+
+def compare(expected: State, actual: State, exact_steps: bool = True) -> bool:
+    """
+    Check final state of a run against the expected one.
+    :param expected: recorded state
+    :param actual: state produced by the engine
+    :param exact_steps: also compare number of executed steps
+    :return: True if states match
+    """
+    if expected["error"] in TIME_LIMITS:
+        return actual["error"] in TIME_LIMITS
+
+    keys = ["stack", "registers", "position", "error"]
+    if exact_steps:
+        keys.append("steps")
+
+    return all(expected[key] == actual[key] for key in keys)
+
+
+def record() -> typing.Dict[str, typing.List[State]]:
+    """
+    Record expected states with the interpreter of the first release. Cases
+    of `corpus.DIFFERENCES` are recorded with the current one.
+    """
+    expected = {
+        name: (
+            ENGINES["interpreter"](compile_program(case.source), case)
+            if name in corpus.DIFFERENCES
+            else asyncio.run(_run_legacy(case))
+        )
+        for name, case in corpus.CASES.items()
+    }
+    EXPECTED.write_text(json.dumps(expected, indent=1) + "\n")
+    return expected
+
+
+def check() -> typing.List[str]:
+    """
+    Run corpus with every engine
+    :return: descriptions of mismatches
+    """
+    expected = json.loads(EXPECTED.read_text())
+    failures = []
+    for name, case in corpus.CASES.items():
+        program = compile_program(case.source)
+        for engine, run in ENGINES.items():
+            states = run(program, case)
+            for inp, want, got in zip(case.inputs, expected[name], states):
+                if not compare(want, got, engine not in INEXACT_STEPS):
+                    failures.append(
+                        f"{engine} {name} {inp}: expected {want}, got {got}"
+                    )
+
+    for name, (source, error) in corpus.COMPILE_ERRORS.items():
+        try:
+            compile_program(source)
+        except leninec.errors.VMError as e:
+            if e.__class__.__name__ != error:
+                failures.append(f"compile {name}: expected {error}, got {e!r}")
+        else:
+            failures.append(f"compile {name}: expected {error}, compiled")
+
+    return failures
+
+
+def _best(func: typing.Callable[[], typing.Any], repeat: int) -> float:
+    """Best wall-clock time of `repeat` calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def bench_compile(repeat: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    results = {}
+    for name, case in corpus.CASES.items():
+        seconds = _best(lambda: compile_program(case.source), repeat)
+        results[name] = {
+            "source_bytes": len(case.source),
+            "source_lines": case.source.count("\n"),
+            "instructions": len(compile_program(case.source).instructions),
+            "seconds": seconds,
+        }
+
+    return results
+
+
+def bench_run(repeat: int) -> typing.Dict[str, typing.Dict[str, typing.Dict]]:
+    async def measure(program: leninec.Program, case: corpus.Case, jit: bool):
+        steps = sum(state["steps"] for state in await _run_vm(program, case, jit=jit))
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await _run_vm(program, case, jit=jit)
+            best = min(best, time.perf_counter() - start)
+
+        return {"steps": steps, "seconds": best, "ips": steps / best if best else 0}
+
+    async def measure_all():
+        return {
+            engine: {
+                name: await measure(compile_program(case.source), case, jit)
+                for name, case in corpus.CASES.items()
+            }
+            for engine, jit in (("jit", True), ("interpreter", False))
+        }
+
+    return asyncio.run(measure_all())
+
+
+def bench_grading(repeat: int) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    tasks = templates()
+    results = {}
+    for name, case in corpus.CASES.items():
+        if not case.task:
+            continue
+
+        task = tasks[case.task]
+        program = compile_program(case.source)
+        results[name] = {
+            "tests": len(case.inputs),
+            "verdict": grading.run_tests(program, task, case.inputs).verdict,
+            "seconds": _best(
+                lambda: grading.run_tests(program, task, case.inputs),
+                repeat,
+            ),
+        }
+
+    return results
+
+
+def _rows(
+    results: typing.Dict[str, typing.Any],
+    prefix: str = "",
+) -> typing.Iterator[typing.Tuple[str, float]]:
+    """Flatten all `seconds` measurements into (path, seconds) pairs."""
+    for key, value in results.items():
+        if key == "seconds":
+            yield prefix, value
+        elif isinstance(value, dict):
+            yield from _rows(value, f"{prefix}/{key}" if prefix else key)
+
+
+def report(results: typing.Dict[str, typing.Any], baseline: typing.Optional[dict]):
+    """Print all timings, with speedup relative to `baseline` if it is given."""
+    previous = dict(_rows(baseline)) if baseline else {}
+    for path, seconds in _rows(results):
+        line = f"{path:<40} {seconds * 1000:10.3f} ms"
+        if previous.get(path):
+            line += f"  x{previous[path] / seconds:.2f}" if seconds else ""
+
+        print(line)
+
+    for name, result in results["run"]["jit"].items():
+        print(
+            f"{'ips/' + name:<40} {result['ips'] / 1e6:10.3f} M (jit),"
+            f" {results['run']['interpreter'][name]['ips'] / 1e6:.3f} M (interpreter)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--check", action="store_true", help="only check conformance")
+    parser.add_argument("--record", action="store_true", help="rewrite expected.json")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="save results")
+    parser.add_argument("-b", "--baseline", type=pathlib.Path, help="compare with")
+    args = parser.parse_args()
+
+    if args.record:
+        record()
+        print(f"Recorded {len(corpus.CASES)} programs to {EXPECTED}")
+        return
+
+    failures = check()
+    for failure in failures:
+        print(failure)
+
+    print(f"Conformance: {len(failures)} mismatches, engines: {', '.join(ENGINES)}")
+    if failures:
+        sys.exit(1)
+
+    if args.check:
+        return
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": None if np is None else np.__version__,
+            "time": time.time(),
+        },
+        "compile": bench_compile(args.repeat),
+        "run": bench_run(args.repeat),
+        "grading": bench_grading(args.repeat),
+    }
+    baseline = json.loads(args.baseline.read_text()) if args.baseline else None
+    report(results, baseline)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=1) + "\n")
+
+
+if __name__ == "__main__":
+    main()
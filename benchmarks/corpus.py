@@ -0,0 +1,276 @@
+"""
+Leninec programs used both as benchmarks and as a conformance corpus.
+
+Every case is run with each of its inputs, inputs are pushed to the stack
+the same way grading does, so the first argument is on top. Expected final
+states are stored in `expected.json` and are recorded from the interpreter
+of the first release (see `legacy`) with `bench.py --record`, so engines
+are checked against the original semantics. Cases of `DIFFERENCES` rely on
+intended changes of the language and are recorded with the current
+interpreter instead. Programs of `COMPILE_ERRORS` must be rejected by the
+compiler with the given error.
+"""
+
+import typing
+
+
+class Case(typing.NamedTuple):
+    """
+    :param source: program source
+    :param inputs: input vectors, one run per vector
+    :param task: reference solution from `TEMPLATES`, if program solves one
+    :param max_steps: step budget of each run
+    """
+
+    source: str
+    inputs: typing.List[typing.List[int]]
+    task: str = ""
+    max_steps: typing.Optional[int] = None
+
+
+def _inputs(count: int, size: int, low: int = 1, high: int = 20):
+    """Deterministic input vectors, so results are comparable between runs."""
+    state = 2931
+    vectors = []
+    for _ in range(count):
+        vector = []
+        for _ in range(size):
+            state = (state * 1103515245 + 12345) % 2**31
+            vector.append(low + state % (high - low + 1))
+
+        vectors.append(vector)
+
+    return vectors
+
+
+# Solutions of `app.TEMPLATES`
+
+MATHS = """\
+pop a
+pop b
+pop c
+div b 2
+mul b c
+add a b
+sub a 10
+push a
+"""
+
+LOOP = """\
+pop a
+pop b
+pop c
+mov d 1
+jmp "check"
+loop:
+// b += c * d, c is saved on the stack
+push c
+mul c d
+add b c
+pop c
+add d 1
+sub a 1
+check:
+jg a "loop"
+push b
+"""
+
+# Call tree of naive recursion is walked with the stack as a work list,
+# 0 marks its bottom
+RECURSION = """\
+pop b
+push 0
+push b
+next:
+pop b
+je b "done"
+mov c b
+sub c 2
+jg c "split"
+add a 1
+jmp "next"
+split:
+sub b 1
+push b
+sub b 1
+push b
+jmp "next"
+done:
+push a
+"""
+
+HARD = """\
+pop b
+push 0
+push b
+next:
+pop b
+je b "done"
+add a b
+mov c 1
+divisors:
+mov d b
+sub d c
+jg d "check"
+jmp "next"
+check:
+mov d b
+mod d c
+je d "found"
+add c 1
+jmp "divisors"
+found:
+push c
+add c 1
+jmp "divisors"
+done:
+push a
+"""
+
+# Stress programs
+
+
+def _macro_heavy(depth: int = 8) -> str:
+    """Macro call tree, which expands to almost `VM.MAX_CODE_SIZE` instructions."""
+    lines = [
+        "#define m0",
+        "add a 7",
+        "mul a 3",
+        "mod a 997",
+        "add c a",
+        "mod c 991",
+        "#enddefine",
+    ]
+    for level in range(1, depth + 1):
+        lines.extend([f"#define m{level}", f"m{level - 1}!", f"m{level - 1}!"])
+        if level == 1:
+            # Local label of every expansion
+            lines.extend(['jg b "{}skip"', "add b 1", "skip:"])
+
+        lines.append("#enddefine")
+
+    lines.extend(["pop a", f"m{depth}!", "push c", "push b"])
+    return "\n".join(lines) + "\n"
+
+
+def _macro_bomb(body: typing.List[str], depth: int = 24, calls: int = 10) -> str:
+    """Macro call tree of `calls ** depth` calls of a macro with `body`."""
+    lines = ["#define m0", *body, "#enddefine"]
+    for level in range(1, depth + 1):
+        lines.extend([f"#define m{level}", *[f"m{level - 1}!"] * calls, "#enddefine"])
+
+    lines.append(f"m{depth}!")
+    return "\n".join(lines) + "\n"
+
+
+STACK_HEAVY = """\
+pop a
+mov c a
+fill:
+push a
+sub a 1
+jg a "fill"
+drain:
+pop b
+add d b
+sub c 1
+jg c "drain"
+push d
+"""
+
+NESTED_LOOPS = """\
+pop a
+outer:
+mov b a
+inner:
+add c b
+mod c 997
+sub b 1
+jg b "inner"
+sub a 1
+jg a "outer"
+push c
+"""
+
+OVERFLOW = """\
+pop a
+square:
+mul a a
+jmp "square"
+"""
+
+STACK_OVERFLOW = """\
+fill:
+push 1
+jmp "fill"
+"""
+
+DIVISION_BY_ZERO = """\
+pop a
+pop b
+sub b b
+div a b
+push a
+"""
+
+# Lanes take different branches, so both DIVI and MODI see zero divisors
+DIVISION_BY_IMMEDIATE_ZERO = """\
+pop a
+mov b a
+sub b 10
+jg b "big"
+mod a 0
+push a
+big:
+div a 0
+push a
+"""
+
+INFINITE_LOOP = """\
+pop a
+spin:
+jmp "spin"
+"""
+
+STEP_LIMIT = """\
+pop a
+count:
+add b 1
+jmp "count"
+"""
+
+CASES: typing.Dict[str, Case] = {
+    "maths": Case(MATHS, _inputs(10, 3), "maths"),
+    "loop": Case(LOOP, _inputs(10, 3), "loop"),
+    "recursion": Case(RECURSION, _inputs(10, 1), "recursion"),
+    "hard": Case(HARD, _inputs(10, 1), "hard"),
+    "macro_heavy": Case(_macro_heavy(), _inputs(4, 1)),
+    "stack_heavy": Case(STACK_HEAVY, [[999], [500], [1]]),
+    "nested_loops": Case(NESTED_LOOPS, [[300], [40]]),
+    "overflow": Case(OVERFLOW, [[2], [3]]),
+    "stack_overflow": Case(STACK_OVERFLOW, [[]]),
+    "division_by_zero": Case(DIVISION_BY_ZERO, [[5, 3]]),
+    "division_by_immediate_zero": Case(DIVISION_BY_IMMEDIATE_ZERO, _inputs(10, 1)),
+    "infinite_loop": Case(INFINITE_LOOP, [[1]], max_steps=10**5),
+    "step_limit": Case(STEP_LIMIT, [[1]], max_steps=10**4),
+}
+
+COMPILE_ERRORS: typing.Dict[str, typing.Tuple[str, str]] = {
+    "macro_bomb": (_macro_bomb(["add a 1"]), "CodeTooBigError"),
+    "empty_macro_bomb": (_macro_bomb(["// nothing"]), "CodeTooBigError"),
+    "blank_macro_bomb": (_macro_bomb(["", ""]), "CodeTooBigError"),
+    "label_macro_bomb": (_macro_bomb(["{}skip:"]), "CodeTooBigError"),
+    "undefined_label": ('pop a\njg a "nowhere"\npush a\n', "UndefinedLabelError"),
+}
+
+# Intended differences from the first release, by case name
+DIFFERENCES: typing.Dict[str, str] = {
+    "hard": "mod computes the remainder, it used to leave the register as is",
+    "macro_heavy": "mod computes the remainder",
+    "nested_loops": "mod computes the remainder",
+    "division_by_immediate_zero": "mod by zero fails like div by zero",
+    "undefined_label": (
+        "undefined labels fail at compile time, they used to fail with"
+        " KeyError only when the jump was taken"
+    ),
+}
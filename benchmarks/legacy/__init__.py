@@ -0,0 +1,49 @@
+"""
+Interpreter of the first release, kept unchanged. `expected.json` of the
+conformance corpus is recorded with it.
+"""
+
+from . import errors, registers, stack, vm
+from .errors import (
+    CodeTooBigError,
+    InvalidArgError,
+    InvalidInstructionError,
+    InvalidLabelError,
+    InvalidMacroError,
+    LabelRedefinitionError,
+    MacroRedefinitionError,
+    PopFromEmptyStackError,
+    StackOverflowError,
+    TimeoutExceededError,
+    UndefinedLabelError,
+    UndefinedMacroError,
+    ValueOverflowError,
+    VMSyntaxError,
+)
+from .registers import Registers
+from .stack import Stack
+from .vm import VM
+
+__all__ = [
+    "VM",
+    "Registers",
+    "Stack",
+    "CodeTooBigError",
+    "InvalidArgError",
+    "InvalidInstructionError",
+    "InvalidLabelError",
+    "InvalidMacroError",
+    "LabelRedefinitionError",
+    "MacroRedefinitionError",
+    "PopFromEmptyStackError",
+    "StackOverflowError",
+    "TimeoutExceededError",
+    "UndefinedLabelError",
+    "UndefinedMacroError",
+    "ValueOverflowError",
+    "VMSyntaxError",
+    "errors",
+    "registers",
+    "stack",
+    "vm",
+]
@@ -1,7 +1,18 @@
+import asyncio
 import functools
+import json
+import logging
+import math
 import random
+import time
+import typing
 
+import events
+import grading
+import metering
+import metrics
 from database import Database
+from events import EventChannel
 from fastapi import FastAPI, Form, Request, WebSocket, WebSocketDisconnect
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse, Response
@@ -13,6 +24,33 @@ import leninec
 
 
 TESTS_QUANTITY = 10
+TRACE_MAX_STEPS = 50_000
+
+# Step budget of each test, unless set for group task. Wall-clock timeouts
+# only guard against runaway execution
+DEFAULT_MAX_STEPS = 1_000_000
+MAX_STEPS_LIMIT = 100_000_000
+
+# Instructions a user can execute within the window before being throttled
+METER_WINDOW = 60
+METER_QUOTA = 50_000_000
+
+# Outbound websocket events, see events.EventChannel
+EVENTS_TICK = 0.02
+EVENTS_MAX_PENDING = 1024
+EVENTS_POLICY = "latest"
+
+# Failed test bank generation is retried after a delay, which doubles with
+# every attempt, until the attempts run out
+TEST_BANK_RETRY_DELAY = 60
+TEST_BANK_ATTEMPTS = 4
+
+# Submissions graded at once by a re-grade job, so live sessions still get
+# workers of the shared pool
+REGRADE_CONCURRENCY = 4
+
+# Grading results persisted in database, see grading.VerdictCache
+VERDICT_STORE_SIZE = 100_000
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -21,31 +59,358 @@ templates = Jinja2Templates(directory="templates")
 
 db = Database()
 
-PREFIX = """global f
-
-"""
+grader = grading.GradingBackend()
+
+sandbox = grading.ReferenceSandbox()
+
+verdicts = grading.VerdictCache(
+    load=db.aio.get_verdict,
+    store=functools.partial(db.aio.set_verdict, limit=VERDICT_STORE_SIZE),
+)
+
+meter = metering.StepMeter(window=METER_WINDOW, quota=METER_QUOTA)
+
+SESSIONS = metrics.Gauge("leninec_ws_sessions", "Active websocket sessions")
+COMPILE_SECONDS = metrics.Histogram(
+    "leninec_compile_seconds", "Duration of compiling submitted code"
+)
+RUN_SECONDS = metrics.Histogram(
+    "leninec_run_seconds",
+    "Duration of grading and debug runs by verdict",
+    ("verdict",),
+)
+REFERENCE_SECONDS = metrics.Histogram(
+    "leninec_reference_seconds", "Time spent in reference solutions per run"
+)
+SESSION_SECONDS = metrics.Histogram(
+    "leninec_session_verify_seconds", "Duration of session cookie verification"
+)
+REGRADED = metrics.Counter(
+    "leninec_regraded_total",
+    "Stored submissions re-graded by verdict",
+    ("verdict",),
+)
+metrics.Counter(
+    "leninec_instructions_total",
+    "VM instructions executed by users",
+    callback=lambda: meter.total,
+)
+metrics.Counter(
+    "leninec_compile_cache_total",
+    "Compiled program cache lookups by result",
+    ("result",),
+    callback=lambda: {
+        "hit": leninec.cache.program_cache.hits,
+        "miss": leninec.cache.program_cache.misses,
+    },
+)
+metrics.Gauge(
+    "leninec_compile_cache_size",
+    "Compiled programs in cache",
+    callback=lambda: len(leninec.cache.program_cache),
+)
+metrics.Counter(
+    "leninec_session_cache_total",
+    "Verified session cache lookups by result",
+    ("result",),
+    callback=lambda: {"hit": db.sessions.hits, "miss": db.sessions.misses},
+)
+metrics.Gauge(
+    "leninec_session_cache_size",
+    "Verified sessions in cache",
+    callback=lambda: len(db.sessions),
+)
+metrics.Counter(
+    "leninec_verdict_cache_total",
+    "Grading result cache lookups by result",
+    ("result",),
+    callback=lambda: {
+        "hit": verdicts.hits,
+        "stored_hit": verdicts.stored_hits,
+        "miss": verdicts.misses,
+    },
+)
+metrics.Gauge(
+    "leninec_verdict_cache_size",
+    "Grading results in memory cache",
+    callback=lambda: len(verdicts),
+)
+
+PREFIX = grading.PREFIX
+
+logger = logging.getLogger(__name__)
+
+# Versions of tasks, whose test banks are being generated, and background
+# tasks generating them
+_pending_banks: typing.Set[str] = set()
+_background: typing.Set[asyncio.Task] = set()
+
+# Failed attempts to generate test banks by task version and time of the
+# next attempt
+_failed_banks: typing.Dict[str, typing.Tuple[int, float]] = {}
+
+# Running re-grade jobs by group
+_regrade_jobs: typing.Dict[str, asyncio.Task] = {}
 
 
 def escape_html(text: str) -> str:
     return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 
-async def on_position_change(websocket: WebSocket, position: int):
-    await websocket.send_text(escape_html(f"@p {position}"))
+async def verify_session(session: str) -> typing.Union[User, bool]:
+    with SESSION_SECONDS.time():
+        # Cached sessions are checked without leaving the event loop
+        if (user := db.sessions.get(session)) is not None:
+            return user
+
+        return await db.aio.load_session(session)
+
+
+async def build_test_bank(task: str, taskvars: int):
+    """
+    Generate test bank of task in reference sandbox and store it in database.
+    Does nothing if bank already exists or is being generated, or if the
+    previous attempt failed recently, see `TEST_BANK_RETRY_DELAY`.
+    :param task: task source as stored in database
+    :param taskvars: number of arguments of `f`
+    """
+    version = grading.ReferenceCache.version(task)
+    attempts, retry_at = _failed_banks.get(version, (0, 0.0))
+    if (
+        version in _pending_banks
+        or time.monotonic() < retry_at
+        or await db.aio.get_test_bank(version)
+    ):
+        return
+
+    _pending_banks.add(version)
+    try:
+        seed = random.getrandbits(31)
+        vectors = await sandbox.generate_tests(task, int(taskvars), seed)
+        await db.aio.set_test_bank(version, seed, vectors)
+        _failed_banks.pop(version, None)
+        logger.info("Generated test bank %s from seed %d", version[:12], seed)
+    except Exception:
+        attempts += 1
+        if attempts < TEST_BANK_ATTEMPTS:
+            delay = TEST_BANK_RETRY_DELAY * 2 ** (attempts - 1)
+            logger.exception(
+                "Failed to generate test bank %s, retrying in %d seconds",
+                version[:12],
+                delay,
+            )
+        else:
+            delay = math.inf
+            logger.exception(
+                "Failed to generate test bank %s %d times, giving up",
+                version[:12],
+                attempts,
+            )
+
+        _failed_banks[version] = (attempts, time.monotonic() + delay)
+    finally:
+        _pending_banks.discard(version)
+
+
+def schedule_test_bank(task: str, taskvars: int):
+    """Run `build_test_bank` in background"""
+    job = asyncio.get_running_loop().create_task(build_test_bank(task, taskvars))
+    _background.add(job)
+    job.add_done_callback(_background.discard)
+
+
+async def draw_tests(
+    user: User,
+    count: int,
+    seed: typing.Optional[int] = None,
+) -> typing.Tuple[
+    typing.List[typing.List[int]],
+    typing.Optional[typing.List[int]],
+    typing.Optional[int],
+]:
+    """
+    Draw tests for user's task from its test bank. If bank is not ready,
+    schedules its generation and falls back to random inputs.
+    :param user: user to draw tests for
+    :param count: number of tests
+    :param seed: seed of tests, random if not specified
+    :return: input vectors, expected answers and seed, answers and seed are
+        None for random inputs
+    """
+    if bank := await db.aio.get_test_bank(grading.ReferenceCache.version(user.task)):
+        if seed is None:
+            seed = random.getrandbits(31)
+
+        return (*grading.draw_tests(bank, count, seed), seed)
+
+    schedule_test_bank(user.task, user.taskvars)
+    tests = [
+        [
+            random.randint(grading.TEST_MIN_VALUE, grading.TEST_MAX_VALUE)
+            for _ in range(int(user.taskvars))
+        ]
+        for _ in range(count)
+    ]
+    return tests, None, None
+
+
+async def regrade_submission(job: int, student: User, code: str) -> str:
+    """
+    Re-grade stored submission of student against current task and record
+    the result, see `regrade_group`.
+    :return: verdict
+    """
+    tests, expected, seed = await draw_tests(student, TESTS_QUANTITY)
+    try:
+        if expected is None:
+            expected = await sandbox.evaluate(student.task, tests)
+
+        result = await grader.grade_source(
+            code,
+            student.task,
+            tests,
+            max_steps=student.taskmaxsteps or DEFAULT_MAX_STEPS,
+            expected=expected,
+        )
+        verdict = result.verdict
+    except Exception:
+        logger.exception("Failed to re-grade %s", student.username)
+        verdict = "error"
+
+    logger.info("Re-graded %s: %s, seed %s", student.username, verdict, seed)
+    await db.aio.save_submission(
+        student.username, grading.ReferenceCache.version(student.task), code, verdict
+    )
+    if verdict == "OK":
+        await db.aio.set_done(student)
+
+    await db.aio.set_regrade_result(job, student.username, verdict)
+    REGRADED.inc(verdict)
+    return verdict
+
+
+async def regrade_group(job: int):
+    """
+    Run re-grade job: grade latest stored submission of every pending
+    student with worker pool. Progress is stored after every submission,
+    so job resumes where it stopped after restart. Job is cancelled if
+    task of the group changes.
+    :param job: job id, see `Database.create_regrade_job`
+    """
+    info = await db.aio.get_regrade_job(job)
+    group = info["group"]
+    try:
+        task = await db.aio.get_group_task(group)
+        if grading.ReferenceCache.version(task["task"]) != info["version"]:
+            await db.aio.set_regrade_status(job, "cancelled")
+            return
+
+        await build_test_bank(task["task"], task["taskvars"])
+        users = await db.aio.get_group_users(group)
+        students = {student.username: student for student in users}
+        submissions = await db.aio.get_group_submissions(group)
+        semaphore = asyncio.Semaphore(REGRADE_CONCURRENCY)
+
+        async def regrade(username: str):
+            async with semaphore:
+                # Task might have changed while waiting
+                if (await db.aio.get_group_task(group))["task"] != task["task"]:
+                    return False
+
+                if username in students and username in submissions:
+                    await regrade_submission(
+                        job, students[username], submissions[username]
+                    )
+                else:
+                    await db.aio.set_regrade_result(job, username, "missing")
+
+                return True
+
+        finished = await asyncio.gather(
+            *(regrade(username) for username in await db.aio.get_pending_regrade(job))
+        )
+        await db.aio.set_regrade_status(job, "done" if all(finished) else "cancelled")
+    except Exception:
+        logger.exception("Re-grade job %d of group %s failed", job, group)
+        await db.aio.set_regrade_status(job, "failed")
+    finally:
+        if _regrade_jobs.get(group) is asyncio.current_task():
+            del _regrade_jobs[group]
+
+
+def schedule_regrade(job: int, group: str):
+    """Run `regrade_group` in background"""
+    _regrade_jobs[group] = asyncio.get_running_loop().create_task(regrade_group(job))
+
+
+async def on_position_change(channel: EventChannel, position: int):
+    channel.publish(escape_html(f"@p {position}"))
+
+
+async def on_register_change(channel: EventChannel, registers: leninec.Registers):
+    channel.publish(escape_html(f"@r {registers.to_str()}"))
+
+
+async def on_stack_change(channel: EventChannel, stack: leninec.Stack):
+    channel.publish(escape_html(f"@s {stack.to_str()}"))
+
+
+def wire_value(value: int) -> typing.Union[int, str]:
+    """Browsers decode msgpack integers to doubles, exact within 2**53"""
+    return value if -(2**53) <= value <= 2**53 else str(value)
+
+
+async def on_step(channel: EventChannel, vm: leninec.VM, event: tuple):
+    """Publish protocol v2 deltas: push v, pop, reg b=v, pc n"""
+    position, register, stack = event
+    binary = channel.encoding == "msgpack"
+    if stack > 0:
+        value = vm.stack[-1]
+        channel.publish(["push", wire_value(value)] if binary else f"push {value}")
+    elif stack:
+        channel.publish(["pop"] if binary else "pop")
+
+    if register >= 0:
+        name, value = vm.REGISTERS[register], vm.registers[register]
+        channel.publish(
+            ["reg", name, wire_value(value)] if binary else f"reg {name}={value}"
+        )
 
+    channel.publish(["pc", position] if binary else f"pc {position}")
 
-async def on_register_change(websocket: WebSocket, registers: leninec.Registers):
-    await websocket.send_text(escape_html(f"@r {registers.to_str()}"))
 
+def state_snapshot(vm: leninec.VM) -> typing.List[str]:
+    """Full VM state, used to resync protocol v2 clients"""
+    return [
+        f"@r {vm.registers.to_str()}",
+        f"@s {vm.stack.to_str()}",
+        f"@p {vm.position}",
+    ]
 
-async def on_stack_change(websocket: WebSocket, stack: leninec.Stack):
-    await websocket.send_text(escape_html(f"@s {stack.to_str()}"))
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(metrics.REGISTRY.render(), media_type=metrics.Registry.CONTENT_TYPE)
+
+
+@app.on_event("startup")
+async def startup():
+    for job in await db.aio.get_running_regrade_jobs():
+        logger.info("Resuming re-grade job %d", job)
+        schedule_regrade(job, (await db.aio.get_regrade_job(job))["group"])
+
+
+@app.on_event("shutdown")
+def shutdown():
+    grader.shutdown()
+    sandbox.shutdown()
+    db.close()
 
 
 @app.get("/")
 async def main_page(request: Request):
     if "session" in request.cookies:
-        if user := db.verify_session(request.cookies["session"]):
+        if user := await verify_session(request.cookies["session"]):
             if user.role == "teacher":
                 return Response(status_code=302, headers={"Location": "/teacher"})
 
@@ -74,8 +439,8 @@ async def main_page(request: Request):
 
 @app.post("/register")
 async def register(user: User):
-    if db.register(user):
-        session_cookie = db.session(user.username)
+    if await db.aio.register(user):
+        session_cookie = await db.aio.session(user.username)
         return JSONResponse(
             status_code=200,
             content={"message": "User registered successfully"},
@@ -89,8 +454,8 @@ async def register(user: User):
 
 @app.post("/login")
 async def login(user: UserCredentials):
-    if db.login(user):
-        session_cookie = db.session(user.username)
+    if await db.aio.login(user):
+        session_cookie = await db.aio.session(user.username)
         return JSONResponse(
             status_code=200,
             content={"message": "User logged in successfully"},
@@ -126,7 +491,7 @@ def teacher_only(func):
     async def wrapper(request: Request, *args, **kwargs):
         if (
             "session" in request.cookies
-            and (user := db.verify_session(request.cookies["session"]))
+            and (user := await verify_session(request.cookies["session"]))
             and user.role == "teacher"
         ):
             return await func(request, *args, **kwargs)
@@ -141,7 +506,7 @@ def teacher_only(func):
 async def teacher_page(request: Request):
     return templates.TemplateResponse(
         "teacher.html",
-        {"request": request, "groups": db.get_usergroups()},
+        {"request": request, "groups": await db.aio.get_usergroups()},
     )
 
 
@@ -150,14 +515,14 @@ async def teacher_page(request: Request):
 async def get_group_students(request: Request, group: str):
     return JSONResponse(
         status_code=200,
-        content=jsonable_encoder({"users": db.get_group_users(group)}),
+        content=jsonable_encoder({"users": await db.aio.get_group_users(group)}),
     )
 
 
 @app.get("/groups/{group}/task")
 @teacher_only
 async def get_task_for_group(request: Request, group: str):
-    task = db.get_group_task(group)
+    task = await db.aio.get_group_task(group)
     return JSONResponse(
         status_code=200,
         content=jsonable_encoder(
@@ -182,60 +547,39 @@ async def update_task_for_group(
     request: Request,
     group: str,
     task: str = Form(...),
+    max_steps: int = Form(0),
 ):
     if "__" in task:
         return JSONResponse(status_code=400, content={"message": "Invalid task"})
 
-    base = (
-        next(
-            line
-            for line in db.sanitize_task(task).splitlines()
-            if line.startswith("def f(")
+    if not 0 <= max_steps <= MAX_STEPS_LIMIT:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "ok": False,
+                "error": f"Step limit must be up to {MAX_STEPS_LIMIT}",
+            },
         )
-        + "\n"
-        + "    ..."
-    )
-    for argcount in range(1, 10):
-        try:
-            exec(
-                (
-                    PREFIX
-                    + base.replace("&gt;", ">")
-                    .replace("&lt;", "<")
-                    .replace("&amp;", "&")
-                    + "\n\nf({})".format(str([10] * argcount).strip("[]"))
-                ),
-                {},
-                {},
-            )
-        except Exception:
-            continue
-        else:
-            break
-    else:
+
+    try:
+        argcount = grading.task_arity(db.sanitize_task(task))
+    except ValueError:
         return JSONResponse(status_code=400, content={"message": "Invalid task"})
 
     inp = [random.randint(0, 20) for _ in range(argcount)]
 
     try:
-        exec(
-            (
-                PREFIX
-                + db.sanitize_task(task)
-                .replace("&gt;", ">")
-                .replace("&lt;", "<")
-                .replace("&amp;", "&")
-                + "\n\nassert isinstance(f({}), int)".format(str(inp).strip("[]"))
-            ),
-            {},
-            {},
-        )
+        await sandbox.evaluate(db.sanitize_task(task), [inp])
     except Exception as e:
         return JSONResponse(status_code=400, content={"ok": False, "error": str(e)})
 
+    ok = await db.aio.set_group_task(group, task, argcount, max_steps)
+    # Saving the task again is an explicit request to retry
+    _failed_banks.pop(grading.ReferenceCache.version(db.sanitize_task(task)), None)
+    schedule_test_bank(db.sanitize_task(task), argcount)
     return JSONResponse(
         status_code=200,
-        content=jsonable_encoder({"ok": db.set_group_task(group, task, argcount)}),
+        content=jsonable_encoder({"ok": ok}),
     )
 
 
@@ -244,14 +588,52 @@ async def update_task_for_group(
 async def delete_task_for_group(request: Request, group: str):
     return JSONResponse(
         status_code=200,
-        content=jsonable_encoder({"ok": db.delete_group_task(group)}),
+        content=jsonable_encoder({"ok": await db.aio.delete_group_task(group)}),
     )
 
 
+@app.post("/groups/{group}/regrade")
+@teacher_only
+async def regrade_group_submissions(request: Request, group: str):
+    if group in _regrade_jobs:
+        return JSONResponse(
+            status_code=409,
+            content=jsonable_encoder(
+                {"ok": False, "job": await db.aio.get_regrade_job(group=group)}
+            ),
+        )
+
+    task = await db.aio.get_group_task(group)
+    if not task["task"]:
+        return JSONResponse(status_code=400, content={"message": "No task"})
+
+    job = await db.aio.create_regrade_job(
+        group,
+        grading.ReferenceCache.version(task["task"]),
+        list(await db.aio.get_group_submissions(group)),
+    )
+    schedule_regrade(job, group)
+    return JSONResponse(
+        status_code=200,
+        content=jsonable_encoder(
+            {"ok": True, "job": await db.aio.get_regrade_job(job)}
+        ),
+    )
+
+
+@app.get("/groups/{group}/regrade")
+@teacher_only
+async def get_regrade_progress(request: Request, group: str):
+    if not (job := await db.aio.get_regrade_job(group=group)):
+        return JSONResponse(status_code=404, content={"message": "Not found"})
+
+    return JSONResponse(status_code=200, content=jsonable_encoder({"job": job}))
+
+
 @app.get("/me")
 async def get_me(request: Request):
     if "session" in request.cookies:
-        if user := db.verify_session(request.cookies["session"]):
+        if user := await verify_session(request.cookies["session"]):
             return JSONResponse(
                 status_code=200,
                 content=jsonable_encoder(user),
@@ -299,69 +681,232 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     if (
         not (session := websocket.cookies.get("session"))
-        or not (user := db.verify_session(session))
+        or not (user := await verify_session(session))
         or not user.task
     ):
         await websocket.close()
         return
 
+    with SESSIONS.track():
+        async with EventChannel(
+            websocket,
+            tick=EVENTS_TICK,
+            max_pending=EVENTS_MAX_PENDING,
+            policy=EVENTS_POLICY,
+        ) as channel:
+            await run_session(websocket, channel, user)
+
+    await websocket.close()
+
+
+async def run_session(websocket: WebSocket, channel: EventChannel, user: User):
     vm = leninec.VM()
-    vm.add_position_change_hook(functools.partial(on_position_change, websocket))
-    vm.add_registers_change_hook(functools.partial(on_register_change, websocket))
-    vm.add_stack_change_hook(functools.partial(on_stack_change, websocket))
     test = 0
+    started = None
+    verdict = "error"
     try:
+        trace = False
+        profile = False
+        protocol = "1"
         data = await websocket.receive_text()
         while data.startswith("@"):
             if data.startswith("@d "):
                 delay = float(data.split(" ")[1])
                 vm.delay = delay
+            elif data == "@trace":
+                trace = True
+            elif data == "@profile":
+                profile = True
+            elif data.startswith("@v "):
+                protocol, *options = data.split(" ")[1:]
+                if options and options[0] in events.ENCODINGS:
+                    channel.encoding = options[0]
 
             data = await websocket.receive_text()
 
-        vm.update_code(data)
-
-        while test in range(1 if delay else TESTS_QUANTITY):
-            inp = [random.randint(1, 20) for _ in range(int(user.taskvars))]
-            vm.reset_state()
-            for i in reversed(inp):
-                vm.stack.push(i)
-            flag = "--debug" if delay else f"--test {test + 1}"
-            await websocket.send_text(escape_html(f"@i {inp} {flag}"))
-            await vm.run()
-            if not vm.stack.is_empty:
-                ans = vm.stack.pop()
-                try:
-                    exec(
-                        (
-                            PREFIX
-                            + user.task.replace("&gt;", ">")
-                            .replace("&lt;", "<")
-                            .replace("&amp;", "&")
-                            + "\n\nassert f({}) == {}".format(str(inp).strip("[]"), ans)
-                        ),
-                        {},
-                        {},
-                    )
-                except AssertionError:
-                    await websocket.send_text(
-                        escape_html(f"@e WA (Wrong Answer) test#{test + 1}")
-                    )
-                    break
-
-            test += 1
+        if retry_after := meter.retry_after(user.username):
+            channel.publish(
+                escape_html(
+                    "@e Instruction quota exceeded, try again in"
+                    f" {math.ceil(retry_after)} seconds"
+                )
+            )
+            return
+
+        max_steps = user.taskmaxsteps or DEFAULT_MAX_STEPS
+        if protocol == "2":
+            channel.batch = True
+            channel.snapshot = functools.partial(state_snapshot, vm)
+            vm.add_step_hook(functools.partial(on_step, channel, vm))
+            channel.publish(f"@v 2 {channel.encoding}")
         else:
-            await websocket.send_text(escape_html("@o Finished" if delay else "@o OK"))
-            db.set_done(user)
+            channel.encoding = "text"
+            vm.add_position_change_hook(
+                functools.partial(on_position_change, channel)
+            )
+            vm.add_registers_change_hook(
+                functools.partial(on_register_change, channel)
+            )
+            vm.add_stack_change_hook(functools.partial(on_stack_change, channel))
 
-        await websocket.send_text(escape_html("@f"))
+        with COMPILE_SECONDS.time():
+            vm.update_code(data)
+
+        started = time.perf_counter()
+        if not delay:
+            verdict = await grade(channel, vm, user, max_steps)
+            await db.aio.save_submission(
+                user.username, grading.ReferenceCache.version(user.task), data, verdict
+            )
+            return
+
+        (inp,), expected, _ = await draw_tests(user, 1)
+        vm.reset_state()
+        for i in reversed(inp):
+            vm.stack.push(i)
+        channel.publish(escape_html(f"@i {inp} --debug"))
+        if protocol == "2":
+            # Deltas are applied to the initial state
+            for message in state_snapshot(vm):
+                channel.publish(message)
+
+        if profile:
+            vm.profile = leninec.Profile(vm)
+
+        try:
+            if trace:
+                # Record the run and let the client play it back. Only the
+                # first TRACE_MAX_STEPS steps are recorded, playback of a
+                # longer run is followed by its final state
+                recorder = leninec.Trace(vm)
+                try:
+                    await recorder.record_async(vm, max_steps, TRACE_MAX_STEPS)
+                finally:
+                    channel.publish(f"@t {recorder.dump()}")
+                    if recorder.truncated:
+                        for message in state_snapshot(vm):
+                            channel.publish(message)
+            else:
+                await vm.run(max_steps=max_steps)
+        finally:
+            if vm.profile is not None:
+                # Summary for hot-line heatmap, positions match `@p`
+                channel.publish(
+                    "@P " + json.dumps(vm.profile.to_dict(), separators=(",", ":"))
+                )
+        if not vm.stack.is_empty:
+            ans = vm.stack.pop()
+            if expected is None:
+                try:
+                    with REFERENCE_SECONDS.time():
+                        expected = await sandbox.evaluate(user.task, [inp])
+                except Exception as e:
+                    verdict = "error"
+                    channel.publish(
+                        escape_html(f"@e Reference solution failed: {e}")
+                    )
+                    channel.publish(escape_html("@f"))
+                    return
+
+            if expected[0] != ans:
+                verdict = "WA"
+                channel.publish(escape_html("@e WA (Wrong Answer) test#1"))
+                channel.publish(escape_html("@f"))
+                return
+
+        verdict = "OK"
+        channel.publish(escape_html("@o Finished"))
+        await db.aio.set_done(user)
+        channel.publish(escape_html("@f"))
+    except (
+        leninec.errors.InfiniteLoopError,
+        leninec.errors.StepLimitExceededError,
+    ) as e:
+        verdict = "TL"
+        channel.publish(escape_html(f"@e TL (Time-Limit Exceeded) test#{test}: {e}"))
     except leninec.errors.TimeoutExceededError:
-        await websocket.send_text(
-            escape_html(f"@e TL (Time-Limit Exceeded) test#{test}")
-        )
+        verdict = "TL"
+        channel.publish(escape_html(f"@e TL (Time-Limit Exceeded) test#{test}"))
     except leninec.errors.VMError as e:
-        await websocket.send_text(escape_html(f"@e {e.__class__.__name__}: {e}"))
+        if started is not None:
+            verdict = "RE"
+
+        channel.publish(escape_html(f"@e {e.__class__.__name__}: {e}"))
     except WebSocketDisconnect:
         pass
+    finally:
+        meter.record(user.username, vm.steps)
+        if started is not None:
+            RUN_SECONDS.observe(time.perf_counter() - started, verdict)
+
+
+async def grade(
+    channel: EventChannel,
+    vm: leninec.VM,
+    user: User,
+    max_steps: typing.Optional[int] = None,
+) -> str:
+    """
+    Grade compiled program in worker pool and report results to client
+    :return: verdict
+    """
+    program_hash = grading.VerdictCache.program_hash(vm.program)
+    tests, expected, seed = await draw_tests(
+        user, TESTS_QUANTITY, grading.VerdictCache.seed(program_hash)
+    )
+    # Runs with random inputs can not be reproduced, so they are not cached
+    key = None
+    if seed is not None:
+        key = verdicts.key(
+            program_hash, grading.ReferenceCache.version(user.task), seed, max_steps
+        )
 
-    await websocket.close()
+    if key is not None and (result := await verdicts.get(key)) is not None:
+        logger.info(
+            "Graded %s: %s, seed %s, cached", user.username, result.verdict, seed
+        )
+    else:
+        if expected is None:
+            try:
+                with REFERENCE_SECONDS.time():
+                    expected = await sandbox.evaluate(user.task, tests)
+            except Exception as e:
+                logger.warning("Reference solution of %s failed: %s", user.username, e)
+                channel.publish(escape_html(f"@e Reference solution failed: {e}"))
+                channel.publish(escape_html("@f"))
+                return "error"
+
+        result = await grader.grade(
+            vm.program, user.task, tests, max_steps=max_steps, expected=expected
+        )
+        logger.info("Graded %s: %s, seed %s", user.username, result.verdict, seed)
+        meter.record(user.username, result.steps)
+        if key is not None:
+            await verdicts.put(key, result)
+
+    for test, summary in enumerate(result.tests):
+        channel.publish(escape_html(f"@i {summary.input} --test {test + 1}"))
+        channel.publish(escape_html(f"@r {'|'.join(map(str, summary.registers))}"))
+        channel.publish(escape_html(f"@s {'|'.join(map(str, summary.stack))}"))
+        channel.publish(escape_html(f"@p {summary.position}"))
+
+    if result.verdict == "TL":
+        message = f"@e TL (Time-Limit Exceeded) test#{max(len(result.tests) - 1, 0)}"
+        if result.error.startswith(("Infinite loop", "Step limit")):
+            message += f": {result.error}"
+
+        channel.publish(escape_html(message))
+        return result.verdict
+
+    if result.verdict == "RE":
+        channel.publish(escape_html(f"@e {result.error}"))
+        return result.verdict
+
+    if result.verdict == "WA":
+        channel.publish(escape_html(f"@e WA (Wrong Answer) test#{len(result.tests)}"))
+    else:
+        channel.publish(escape_html("@o OK"))
+        await db.aio.set_done(user)
+
+    channel.publish(escape_html("@f"))
+    return result.verdict
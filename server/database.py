@@ -1,4 +1,7 @@
+import asyncio
+import collections
 import contextlib
+import functools
 import hashlib
 import json
 import os
@@ -6,8 +9,10 @@ import random
 import re
 import sqlite3
 import string
+import threading
 import time
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 try:
@@ -15,6 +20,7 @@ try:
 except ImportError:
     import python_jwt as jwt
 
+import metrics
 from models import User, UserCredentials
 
 DB_PATH = (
@@ -39,22 +45,205 @@ except FileNotFoundError:
         )
 
 
+# Queries of async methods run on a dedicated thread pool, every thread
+# keeps its own connection
+DB_THREADS = 4
+STATEMENT_CACHE_SIZE = 256
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Verified sessions are cached for a short time, changes of users made
+# through Database invalidate them right away
+SESSION_CACHE_SIZE = 4096
+SESSION_CACHE_TTL = 60
+
+QUERY_SECONDS = metrics.Histogram(
+    "leninec_db_query_seconds",
+    "Duration of Database method calls",
+    ("method",),
+)
+
+
+def _timed(func: callable) -> callable:
+    return metrics.timed(QUERY_SECONDS, func.__name__)(func)
+
+
 class _SQliteContextManager:
+    """
+    Gives cursor of the connection of the current thread. Connections are
+    opened once per thread and kept open until `close`. Transaction is
+    committed on exit, or rolled back if the block raises.
+    """
+
     def __init__(self, db_path: Path):
         self._db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: typing.List[sqlite3.Connection] = []
+        # Connections of previous generations were closed
+        self._generation = 0
+
+    def connection(self) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "generation", None) != self._generation:
+            # Connection is only used by its thread, but `close` is called
+            # from another one
+            local.conn = sqlite3.connect(
+                self._db_path,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+            )
+            for pragma in PRAGMAS:
+                local.conn.execute(pragma)
+
+            local.generation = self._generation
+            with self._lock:
+                self._connections.append(local.conn)
+
+        return local.conn
 
     def __enter__(self):
-        self.conn = sqlite3.connect(self._db_path)
-        return self.conn.cursor()
+        return self.connection().cursor()
 
-    def __exit__(self, *_):
-        self.conn.commit()
-        self.conn.close()
+    def __exit__(self, exc_type, *_):
+        if exc_type is None:
+            self._local.conn.commit()
+        else:
+            self._local.conn.rollback()
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+            for conn in self._connections:
+                conn.close()
+
+            self._connections.clear()
+
+
+class _AsyncDatabase:
+    """
+    Awaitable versions of `Database` methods, e.g.
+    `await db.aio.get_group_users(group)`. Methods run on the thread pool
+    of database, so event loop never waits for disk.
+    """
+
+    def __init__(self, database: "Database"):
+        self._database = database
+
+    def __getattr__(self, name: str) -> callable:
+        method = getattr(self._database, name)
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(
+                self._database.executor, functools.partial(method, *args, **kwargs)
+            )
+
+        return wrapper
+
+
+class SessionCache:
+    """
+    Bounded cache of verified session cookies. Entries expire after `ttl`
+    seconds or when the session itself expires, whichever is earlier.
+    Only valid sessions are cached. Every invalidation bumps `generation`,
+    so a session read from database before it is not cached afterwards.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = SESSION_CACHE_SIZE,
+        ttl: float = SESSION_CACHE_TTL,
+    ):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self.generation: int = 0
+        self._sessions: typing.OrderedDict[str, typing.Tuple[User, float]] = (
+            collections.OrderedDict()
+        )
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def get(self, session: str) -> typing.Optional[User]:
+        """
+        Get user of cached session
+        :param session: session cookie
+        :return: user, None if session is not cached or expired
+        """
+        with self._lock:
+            if (entry := self._sessions.get(session)) is not None:
+                if entry[1] > time.time():
+                    self.hits += 1
+                    return entry[0]
+
+                del self._sessions[session]
+
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        session: str,
+        user: User,
+        expires: float,
+        generation: typing.Optional[int] = None,
+    ):
+        """
+        Cache verified session
+        :param session: session cookie
+        :param user: user of session
+        :param expires: expiration time of session
+        :param generation: `generation` before user was read, session is not
+            cached if it was invalidated since
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self._sessions[session] = (user, min(time.time() + self.ttl, expires))
+            self._sessions.move_to_end(session)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def invalidate(
+        self,
+        username: typing.Optional[str] = None,
+        group: typing.Optional[str] = None,
+    ):
+        """
+        Drop cached sessions of user or of all users of group
+        :param username: username of user
+        :param group: group of users
+        """
+        with self._lock:
+            self.generation += 1
+            for session, (user, _) in list(self._sessions.items()):
+                if user.username == username or user.group == group:
+                    del self._sessions[session]
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {"size": len(self._sessions), "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._sessions.clear()
 
 
 class Database:
     def __init__(self):
         self.db = _SQliteContextManager(DB_PATH)
+        self.sessions = SessionCache()
+        self.aio = _AsyncDatabase(self)
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
         self._salt = "'+zA+'s#^@0C:+z(cfx8-?-eoZ56K"
 
         with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
@@ -70,6 +259,7 @@ class Database:
                     usergroup TEXT,
                     taskstatus TEXT,
                     taskvars INT,
+                    taskmaxsteps INT,
                     PRIMARY KEY (username)
                 )
                 """
@@ -79,6 +269,94 @@ class Database:
             cursor.execute("ALTER TABLE users ADD COLUMN taskvars INT")
             cursor.execute("UPDATE users SET taskvars = 1")
 
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute("ALTER TABLE users ADD COLUMN taskmaxsteps INT")
+            cursor.execute("UPDATE users SET taskmaxsteps = 0")
+
+        # Answers can exceed SQLite integers, so they are stored as text
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE test_vectors (
+                    version TEXT,
+                    seed INT,
+                    position INT,
+                    input TEXT,
+                    expected TEXT,
+                    PRIMARY KEY (version, position)
+                )
+                """
+            )
+
+        # Latest submission of every user for every task version
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE submissions (
+                    username TEXT,
+                    version TEXT,
+                    code TEXT,
+                    verdict TEXT,
+                    submitted REAL,
+                    PRIMARY KEY (username, version)
+                )
+                """
+            )
+
+        # Grading results, see `grading.VerdictCache`
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE verdicts (
+                    key TEXT,
+                    result TEXT,
+                    PRIMARY KEY (key)
+                )
+                """
+            )
+
+        # Re-grade jobs, result is NULL until submission is re-graded
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE regrade_jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    usergroup TEXT,
+                    version TEXT,
+                    status TEXT,
+                    created REAL
+                )
+                """
+            )
+
+        with contextlib.suppress(sqlite3.OperationalError), self.db as cursor:
+            cursor.execute(
+                """
+                CREATE TABLE regrade_results (
+                    job INT,
+                    username TEXT,
+                    verdict TEXT,
+                    PRIMARY KEY (job, username)
+                )
+                """
+            )
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Thread pool of async methods, see `aio`"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="db")
+
+        return self._executor
+
+    def close(self):
+        """Stop thread pool and close connections"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        self.db.close()
+
     def embed_salt(self, password: str) -> str:
         """
         Embeds the salt into the password using non-standart way.
@@ -87,6 +365,7 @@ class Database:
         """
         return "".join(a + b for a, b in zip(password, self._salt)) + self._salt
 
+    @_timed
     def register(self, user: User) -> bool:
         """
         Adds user to the database.
@@ -105,7 +384,7 @@ class Database:
 
         with self.db as cursor:
             cursor.execute(
-                "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
                 (
                     user.username,
                     hashlib.sha256(self.embed_salt(user.password).encode()).hexdigest(),
@@ -116,11 +395,13 @@ class Database:
                     user.group,
                     "",
                     0,
+                    0,
                 ),
             )
 
         return True
 
+    @_timed
     def login(self, user: UserCredentials) -> bool:
         """
         Checks if user exists and password is correct.
@@ -137,6 +418,7 @@ class Database:
             )
             return bool(cursor.fetchone())
 
+    @_timed
     def session(self, username: str) -> str:
         """
         Create a new session for user.
@@ -164,6 +446,19 @@ class Database:
         :param session: session cookie
         :return: fullname if session is valid, False otherwise
         """
+        if (user := self.sessions.get(session)) is not None:
+            return user
+
+        return self.load_session(session)
+
+    @_timed
+    def load_session(self, session: str) -> typing.Union[User, bool]:
+        """
+        Verify session cookie without looking it up in `sessions` cache,
+        valid session is cached then.
+        :param session: session cookie
+        :return: user if session is valid, False otherwise
+        """
         try:
             data = jwt.decode(session, SECRET, algorithms=["HS256"])
         except jwt.exceptions.DecodeError:
@@ -172,16 +467,20 @@ class Database:
         if data["expires"] < int(time.time()):
             return False
 
+        generation = self.sessions.generation
         with self.db as cursor:
             cursor.execute(
                 "SELECT * FROM users WHERE username = ?",
                 (data["username"],),
             )
-            if not (user := cursor.fetchone()):
+            if not (row := cursor.fetchone()) or row[1] != data["password_hash"]:
                 return False
 
-            return User.from_tuple(user) if user[1] == data["password_hash"] else False
+        user = User.from_tuple(row)
+        self.sessions.put(session, user, data["expires"], generation)
+        return user
 
+    @_timed
     def get_usergroups(self) -> typing.List[str]:
         """
         Get all usergroups.
@@ -195,6 +494,7 @@ class Database:
                 if usergroup[0] != "teacher"
             ]
 
+    @_timed
     def get_group_users(self, group: str) -> typing.List[User]:
         """
         Get all users from group.
@@ -204,6 +504,7 @@ class Database:
             cursor.execute("SELECT * FROM users WHERE usergroup = ?", (group,))
             return [User.from_tuple(user) for user in cursor.fetchall()]
 
+    @_timed
     def get_group_task(self, group: str) -> dict:
         """
         Get task from group.
@@ -211,37 +512,49 @@ class Database:
         """
         with self.db as cursor:
             cursor.execute(
-                "SELECT task, taskvars FROM users WHERE usergroup = ?", (group,)
+                "SELECT task, taskvars, taskmaxsteps FROM users WHERE usergroup = ?",
+                (group,),
             )
             res = cursor.fetchone()
             return (
-                {"task": res[0], "taskvars": res[1]}
+                {"task": res[0], "taskvars": res[1], "taskmaxsteps": res[2] or 0}
                 if res
-                else {"task": "", "taskvars": 0}
+                else {"task": "", "taskvars": 0, "taskmaxsteps": 0}
             )
 
     @staticmethod
     def sanitize_task(task: str) -> str:
         return re.sub(r"<.*?>", "", task)
 
-    def set_group_task(self, group: str, task: str, taskvars: int) -> bool:
+    @_timed
+    def set_group_task(
+        self,
+        group: str,
+        task: str,
+        taskvars: int,
+        taskmaxsteps: int = 0,
+    ) -> bool:
         """
         Set task for group.
         :param group: group to set task for
         :param task: task to set
         :param taskvars: number of variables in task
+        :param taskmaxsteps: step limit of each test, 0 for default
         :return: bool
         """
         with self.db as cursor:
             cursor.execute(
                 (
-                    "UPDATE users SET task = ?, taskvars = ?, taskstatus = ? WHERE"
-                    " usergroup = ?"
+                    "UPDATE users SET task = ?, taskvars = ?, taskmaxsteps = ?,"
+                    " taskstatus = ? WHERE usergroup = ?"
                 ),
-                (self.sanitize_task(task), taskvars, "", group),
+                (self.sanitize_task(task), taskvars, taskmaxsteps, "", group),
             )
-            return True
 
+        self.sessions.invalidate(group=group)
+        return True
+
+    @_timed
     def delete_group_task(self, group: str) -> bool:
         """
         Delete task for group.
@@ -250,13 +563,271 @@ class Database:
         with self.db as cursor:
             cursor.execute(
                 (
-                    "UPDATE users SET task = ?, taskvars = ?, taskstatus = ? WHERE"
-                    " usergroup = ?"
+                    "UPDATE users SET task = ?, taskvars = ?, taskmaxsteps = ?,"
+                    " taskstatus = ? WHERE usergroup = ?"
                 ),
-                ("", 0, "", group),
+                ("", 0, 0, "", group),
+            )
+
+        self.sessions.invalidate(group=group)
+        return True
+
+    @_timed
+    def get_test_bank(self, version: str) -> typing.List[typing.Tuple[list, int]]:
+        """
+        Get test bank of task.
+        :param version: task version, see `grading.ReferenceCache.version`
+        :return: (input, expected answer) pairs, empty if bank is not generated
+        """
+        with self.db as cursor:
+            cursor.execute(
+                (
+                    "SELECT input, expected FROM test_vectors WHERE version = ?"
+                    " ORDER BY position"
+                ),
+                (version,),
+            )
+            return [(json.loads(inp), int(expected)) for inp, expected in cursor]
+
+    @_timed
+    def set_test_bank(
+        self,
+        version: str,
+        seed: int,
+        vectors: typing.List[typing.Tuple[list, int]],
+    ) -> bool:
+        """
+        Replace test bank of task.
+        :param version: task version, see `grading.ReferenceCache.version`
+        :param seed: seed the bank was generated from
+        :param vectors: (input, expected answer) pairs
+        :return: bool
+        """
+        with self.db as cursor:
+            cursor.execute("DELETE FROM test_vectors WHERE version = ?", (version,))
+            cursor.executemany(
+                "INSERT INTO test_vectors VALUES (?, ?, ?, ?, ?)",
+                (
+                    (version, seed, position, json.dumps(inp), str(expected))
+                    for position, (inp, expected) in enumerate(vectors)
+                ),
+            )
+            return True
+
+    @_timed
+    def get_verdict(self, key: str) -> typing.Optional[str]:
+        """
+        Get stored grading result.
+        :param key: cache key, see `grading.VerdictCache.key`
+        :return: serialised result, None if it is not stored
+        """
+        with self.db as cursor:
+            cursor.execute("SELECT result FROM verdicts WHERE key = ?", (key,))
+            return row[0] if (row := cursor.fetchone()) else None
+
+    @_timed
+    def set_verdict(self, key: str, result: str, limit: int = 100_000) -> bool:
+        """
+        Store grading result, dropping the oldest ones above `limit`.
+        :param key: cache key, see `grading.VerdictCache.key`
+        :param result: serialised result
+        :param limit: max number of stored results
+        :return: bool
+        """
+        with self.db as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?)", (key, result)
+            )
+            # New rows get the largest rowid, so rowids are in insertion order
+            cursor.execute(
+                "DELETE FROM verdicts WHERE rowid <= ?", (cursor.lastrowid - limit,)
+            )
+            return True
+
+    @_timed
+    def save_submission(
+        self,
+        username: str,
+        version: str,
+        code: str,
+        verdict: str,
+    ) -> bool:
+        """
+        Store graded submission, replacing previous one for the task version.
+        :param username: author of submission
+        :param version: task version, see `grading.ReferenceCache.version`
+        :param code: program source
+        :param verdict: grading verdict
+        :return: bool
+        """
+        with self.db as cursor:
+            cursor.execute(
+                "INSERT OR REPLACE INTO submissions VALUES (?, ?, ?, ?, ?)",
+                (username, version, code, verdict, time.time()),
+            )
+            return True
+
+    @_timed
+    def get_group_submissions(self, group: str) -> typing.Dict[str, str]:
+        """
+        Get latest submissions of group users for any task version.
+        :param group: group to get submissions of
+        :return: program sources by username
+        """
+        with self.db as cursor:
+            cursor.execute(
+                (
+                    "SELECT s.username, s.code FROM submissions s"
+                    " JOIN users u ON u.username = s.username"
+                    " WHERE u.usergroup = ? ORDER BY s.submitted"
+                ),
+                (group,),
+            )
+            return dict(cursor.fetchall())
+
+    @_timed
+    def create_regrade_job(
+        self,
+        group: str,
+        version: str,
+        usernames: typing.List[str],
+    ) -> int:
+        """
+        Create re-grade job of group.
+        :param group: group to re-grade
+        :param version: task version to re-grade against
+        :param usernames: users, whose submissions are re-graded
+        :return: job id
+        """
+        with self.db as cursor:
+            cursor.execute(
+                (
+                    "INSERT INTO regrade_jobs (usergroup, version, status, created)"
+                    " VALUES (?, ?, ?, ?)"
+                ),
+                (group, version, "running", time.time()),
+            )
+            job = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO regrade_results VALUES (?, ?, NULL)",
+                ((job, username) for username in usernames),
+            )
+            return job
+
+    @_timed
+    def get_regrade_job(
+        self,
+        job: typing.Optional[int] = None,
+        group: typing.Optional[str] = None,
+    ) -> typing.Optional[dict]:
+        """
+        Get re-grade job with its progress.
+        :param job: job id
+        :param group: get the latest job of group instead
+        :return: job, None if there is no such job
+        """
+        with self.db as cursor:
+            if job is None:
+                cursor.execute(
+                    (
+                        "SELECT id, usergroup, version, status, created"
+                        " FROM regrade_jobs WHERE usergroup = ?"
+                        " ORDER BY id DESC LIMIT 1"
+                    ),
+                    (group,),
+                )
+            else:
+                cursor.execute(
+                    (
+                        "SELECT id, usergroup, version, status, created"
+                        " FROM regrade_jobs WHERE id = ?"
+                    ),
+                    (job,),
+                )
+
+            if not (row := cursor.fetchone()):
+                return None
+
+            cursor.execute(
+                (
+                    "SELECT verdict, COUNT(*) FROM regrade_results WHERE job = ?"
+                    " GROUP BY verdict"
+                ),
+                (row[0],),
+            )
+            verdicts = dict(cursor.fetchall())
+            pending = verdicts.pop(None, 0)
+            total = pending + sum(verdicts.values())
+            return {
+                "id": row[0],
+                "group": row[1],
+                "version": row[2],
+                "status": row[3],
+                "created": row[4],
+                "total": total,
+                "done": total - pending,
+                "verdicts": verdicts,
+            }
+
+    @_timed
+    def get_running_regrade_jobs(self) -> typing.List[int]:
+        """
+        Get jobs, which were not finished, e.g. because of restart.
+        :return: job ids
+        """
+        with self.db as cursor:
+            cursor.execute("SELECT id FROM regrade_jobs WHERE status = 'running'")
+            return [job for job, in cursor.fetchall()]
+
+    @_timed
+    def get_pending_regrade(self, job: int) -> typing.List[str]:
+        """
+        Get users, whose submissions are not re-graded yet.
+        :param job: job id
+        :return: usernames
+        """
+        with self.db as cursor:
+            cursor.execute(
+                (
+                    "SELECT username FROM regrade_results"
+                    " WHERE job = ? AND verdict IS NULL"
+                ),
+                (job,),
+            )
+            return [username for username, in cursor.fetchall()]
+
+    @_timed
+    def set_regrade_result(self, job: int, username: str, verdict: str) -> bool:
+        """
+        Record verdict of re-graded submission.
+        :param job: job id
+        :param username: author of submission
+        :param verdict: grading verdict
+        :return: bool
+        """
+        with self.db as cursor:
+            cursor.execute(
+                "UPDATE regrade_results SET verdict = ? WHERE job = ? AND username = ?",
+                (verdict, job, username),
             )
             return True
 
+    @_timed
+    def set_regrade_status(self, job: int, status: str) -> bool:
+        """
+        Set status of re-grade job.
+        :param job: job id
+        :param status: running, done, cancelled or failed
+        :return: bool
+        """
+        with self.db as cursor:
+            cursor.execute(
+                "UPDATE regrade_jobs SET status = ? WHERE id = ?",
+                (status, job),
+            )
+            return True
+
+    @_timed
     def set_done(self, user: User) -> bool:
         """
         Set task as done for user.
@@ -267,4 +838,6 @@ class Database:
                 "UPDATE users SET taskstatus = ? WHERE username = ?",
                 ("done", user.username),
             )
-            return True
+
+        self.sessions.invalidate(username=user.username)
+        return True
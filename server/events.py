@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import typing
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("drop", "latest", "disconnect")
+ENCODINGS = ("text", "msgpack") if msgpack else ("text",)
+STATE_PREFIXES = ("@p", "@r", "@s")
+
+
+def is_delta(message: typing.Any) -> bool:
+    """Check if message is a protocol v2 state delta"""
+    return not isinstance(message, str) or not message.startswith("@")
+
+
+def is_state(message: typing.Any) -> bool:
+    """Check if message carries VM state (full or delta)"""
+    return is_delta(message) or message.startswith(STATE_PREFIXES)
+
+
+class EventChannel:
+    """
+    Bounded outbound queue between VM hooks and a websocket.
+    Messages are published without awaiting the network. A separate sender
+    task flushes everything published since the last flush at most once per
+    `tick` seconds. Every message is sent as its own frame, unless `batch`
+    is set (protocol v2), then they are sent as a single frame holding an
+    array of messages.
+
+    When more than `max_pending` messages are waiting, `policy` is applied:
+        drop       - oldest state messages (@p, @r, @s) are dropped
+        latest     - only the latest state message of each kind is kept
+        disconnect - connection is closed
+    Deltas can not be dropped one by one, so with `drop` and `latest`
+    policies all queued state messages are replaced by `snapshot()`.
+
+    Batched frames are JSON arrays, with `msgpack` encoding they are binary
+    msgpack arrays.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        tick: float = 0.02,
+        max_pending: int = 1024,
+        policy: str = "latest",
+        encoding: str = "text",
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown slow consumer policy {policy}")
+
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unsupported encoding {encoding}")
+
+        self.tick: float = tick
+        self.max_pending: int = max_pending
+        self.policy: str = policy
+        self.encoding: str = encoding
+        self.batch: bool = False
+        self.snapshot: typing.Optional[typing.Callable[[], typing.List]] = None
+        self._websocket = websocket
+        self._queue: typing.Deque = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._sender: typing.Optional[asyncio.Task] = None
+        self._closing: bool = False
+        self._closed: bool = False
+
+    async def __aenter__(self) -> "EventChannel":
+        self._sender = asyncio.create_task(self._send_loop())
+        return self
+
+    async def __aexit__(self, *_):
+        self._closing = True
+        self._wakeup.set()
+        with contextlib.suppress(Exception, asyncio.CancelledError):
+            await self._sender
+
+    def publish(self, message: typing.Any):
+        """
+        Put message to the queue.
+        Raises WebSocketDisconnect if connection is closed.
+        """
+        if self._closed:
+            raise WebSocketDisconnect(code=1008)
+
+        self._queue.append(message)
+        if len(self._queue) > self.max_pending:
+            self._apply_policy()
+
+        self._wakeup.set()
+
+    def _apply_policy(self):
+        if self.policy == "disconnect":
+            logger.warning("Slow consumer, closing connection")
+            self._closed = True
+            self._queue.clear()
+            self._sender.cancel()
+            raise WebSocketDisconnect(code=1008)
+
+        queue = self._queue
+        if self.snapshot is not None and any(map(is_delta, queue)):
+            self._queue = collections.deque(
+                message for message in queue if not is_state(message)
+            )
+            self._queue.extend(self.snapshot())
+            return
+
+        if self.policy == "latest":
+            seen = set()
+            kept = collections.deque()
+            for message in reversed(queue):
+                kind = message[:2]
+                if is_state(message):
+                    if kind in seen:
+                        continue
+
+                    seen.add(kind)
+
+                kept.appendleft(message)
+
+            self._queue = kept
+            return
+
+        overflow = len(queue) - self.max_pending
+        kept = collections.deque()
+        for message in queue:
+            if overflow and is_state(message):
+                overflow -= 1
+                continue
+
+            kept.append(message)
+
+        self._queue = kept
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if self._queue:
+                    messages = list(self._queue)
+                    self._queue.clear()
+                    if not self.batch:
+                        for message in messages:
+                            await self._websocket.send_text(message)
+                    elif self.encoding == "msgpack":
+                        await self._websocket.send_bytes(msgpack.packb(messages))
+                    else:
+                        await self._websocket.send_text(
+                            json.dumps(messages, separators=(",", ":"))
+                        )
+
+                if self._closing and not self._queue:
+                    return
+
+                await asyncio.sleep(self.tick)
+        except Exception:
+            self._closed = True
+            raise
@@ -0,0 +1,738 @@
+import ast
+import asyncio
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import signal
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import leninec
+from leninec.lanes import run_lanes
+
+logger = logging.getLogger(__name__)
+
+PREFIX = """global f
+
+"""
+
+TEST_TIMEOUT = 300
+
+# Compiled reference solutions kept per process and answers memoised
+# for each of them
+REFERENCE_CACHE_SIZE = 64
+REFERENCE_MEMO_SIZE = 4096
+
+# Test bank of each task: input vectors with expected answers, generated
+# once from a seed, so every grading run can be reproduced
+TEST_BANK_SIZE = 256
+TEST_MIN_VALUE = 1
+TEST_MAX_VALUE = 20
+
+# Reference solutions are evaluated in sandbox workers. CPU time is
+# limited per call, memory is limited on top of worker's own usage
+SANDBOX_WORKERS = 2
+SANDBOX_CPU_LIMIT = 5
+SANDBOX_MEMORY_LIMIT = 256 * 2**20
+MAX_ARITY = 9
+
+# Grading results kept in memory, more of them are persisted by the server
+VERDICT_CACHE_SIZE = 4096
+
+Vector = typing.Tuple[typing.List[int], int]
+
+
+class TestResult(typing.NamedTuple):
+    input: typing.List[int]
+    registers: typing.Tuple[int, ...]
+    stack: typing.Tuple[int, ...]
+    position: int
+
+
+class GradingResult(typing.NamedTuple):
+    verdict: str  # OK, WA, TL, RE or CE
+    tests: typing.List[TestResult]
+    error: str = ""
+    steps: int = 0  # Instructions executed over all tests
+    reference_time: float = 0.0  # Seconds spent in reference solution
+
+
+def unescape_html(text: str) -> str:
+    return text.replace("&gt;", ">").replace("&lt;", "<").replace("&amp;", "&")
+
+
+def task_arity(task: str) -> int:
+    """
+    Get number of arguments to call reference function `f` with, from its
+    signature. Raises ValueError if task is invalid.
+    :param task: task source as stored in database
+    :return: smallest number of positional arguments `f` accepts
+    """
+    try:
+        tree = ast.parse(unescape_html(task))
+    except SyntaxError as e:
+        raise ValueError(f"Syntax error: {e}") from e
+
+    functions = [
+        node
+        for node in tree.body
+        if isinstance(node, ast.FunctionDef) and node.name == "f"
+    ]
+    if not functions:
+        raise ValueError("Function f is not defined")
+
+    # The last definition is the one, which is called
+    args = functions[-1].args
+    positional = len(getattr(args, "posonlyargs", [])) + len(args.args)
+    required = positional - len(args.defaults)
+    arity = max(required, 1)
+    if (
+        arity > MAX_ARITY
+        or (arity > positional and args.vararg is None)
+        or any(default is None for default in args.kw_defaults)
+    ):
+        raise ValueError("Function f must accept from 1 to 9 integer arguments")
+
+    return arity
+
+
+def load_reference(
+    task: str,
+    memo_size: typing.Optional[int] = REFERENCE_MEMO_SIZE,
+) -> typing.Callable[..., int]:
+    """
+    Execute teacher's task and return reference function `f`.
+    :param task: task source as stored in database
+    :param memo_size: if specified, answers are memoised in LRU cache of
+        this size. Recursive calls of `f` go through the cache too
+    :return: reference function
+    """
+    namespace = {}
+    exec(PREFIX + unescape_html(task), namespace, {})
+    if memo_size:
+        namespace["f"] = functools.lru_cache(maxsize=memo_size)(namespace["f"])
+
+    return namespace["f"]
+
+
+class ReferenceCache:
+    """
+    Process-wide LRU cache of reference functions, keyed by task version
+    (hash of task source). Changed task gets a new version, so stale
+    functions are never used and are eventually evicted.
+    """
+
+    def __init__(self, maxsize: int = REFERENCE_CACHE_SIZE):
+        self.maxsize: int = maxsize
+        self._functions: typing.OrderedDict[str, typing.Callable[..., int]] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._functions)
+
+    @staticmethod
+    def version(task: str) -> str:
+        """
+        Get version of task
+        :param task: task source as stored in database
+        :return: hex digest
+        """
+        return hashlib.sha256(task.encode()).hexdigest()
+
+    def get(self, task: str) -> typing.Callable[..., int]:
+        """
+        Get memoised reference function of task, loading it on cache miss
+        :param task: task source as stored in database
+        :return: reference function
+        """
+        key = self.version(task)
+        if (function := self._functions.get(key)) is not None:
+            self._functions.move_to_end(key)
+            return function
+
+        function = self._functions[key] = load_reference(task)
+        while len(self._functions) > self.maxsize:
+            self._functions.popitem(last=False)
+
+        return function
+
+
+references = ReferenceCache()
+
+
+class VerdictCache:
+    """
+    LRU cache of grading results, keyed by compiled program, task version,
+    seed of tests and step budget. Programs, which differ only in label
+    names, whitespace, comments or macros, compile to the same bytecode,
+    so they share results. Reported positions are bytecode positions, so
+    a cached result is exactly what grading the program would produce.
+
+    Results evicted from memory can be kept by `store` and read back by
+    `load`, e.g. from database. They are coroutine functions, which
+    exchange results serialised to JSON.
+    Wall-clock time limits depend on server load and infinite loop errors
+    name labels of the program, so such results are not cached.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = VERDICT_CACHE_SIZE,
+        load: typing.Optional[
+            typing.Callable[[str], typing.Awaitable[typing.Optional[str]]]
+        ] = None,
+        store: typing.Optional[
+            typing.Callable[[str, str], typing.Awaitable[typing.Any]]
+        ] = None,
+    ):
+        self.maxsize: int = maxsize
+        self.load: typing.Optional[
+            typing.Callable[[str], typing.Awaitable[typing.Optional[str]]]
+        ] = load
+        self.store: typing.Optional[
+            typing.Callable[[str, str], typing.Awaitable[typing.Any]]
+        ] = store
+        self.hits: int = 0
+        self.stored_hits: int = 0
+        self.misses: int = 0
+        self._results: typing.OrderedDict[str, GradingResult] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    @staticmethod
+    def program_hash(program: leninec.Program) -> str:
+        """
+        Get hash of canonical form of program: its bytecode, in which
+        labels are already replaced with positions
+        :param program: compiled program
+        :return: hex digest
+        """
+        return hashlib.sha256(repr(program.instructions).encode()).hexdigest()
+
+    @staticmethod
+    def seed(program_hash: str) -> int:
+        """
+        Get seed of tests for program, so the same program is always
+        graded with the same tests
+        :param program_hash: see `program_hash`
+        :return: seed
+        """
+        return int(program_hash[:8], 16) & 0x7FFFFFFF
+
+    @staticmethod
+    def key(
+        program_hash: str,
+        version: str,
+        seed: int,
+        max_steps: typing.Optional[int] = None,
+    ) -> str:
+        """
+        Get cache key of grading run
+        :param program_hash: see `program_hash`
+        :param version: task version, see `ReferenceCache.version`
+        :param seed: seed of tests
+        :param max_steps: step budget of each test
+        :return: hex digest
+        """
+        return hashlib.sha256(
+            f"{program_hash}\0{version}\0{seed}\0{max_steps}".encode()
+        ).hexdigest()
+
+    @staticmethod
+    def cacheable(result: GradingResult) -> bool:
+        """Check if result does not depend on anything but the key"""
+        if result.verdict == "TL":
+            return result.error.startswith("Step limit")
+
+        return result.verdict in ("OK", "WA", "RE", "CE")
+
+    @staticmethod
+    def dumps(result: GradingResult) -> str:
+        return json.dumps(
+            {
+                "verdict": result.verdict,
+                "tests": [list(test) for test in result.tests],
+                "error": result.error,
+                "steps": result.steps,
+            },
+            separators=(",", ":"),
+        )
+
+    @staticmethod
+    def loads(data: str) -> GradingResult:
+        result = json.loads(data)
+        return GradingResult(
+            result["verdict"],
+            [
+                TestResult(inp, tuple(registers), tuple(stack), position)
+                for inp, registers, stack, position in result["tests"]
+            ],
+            result["error"],
+            result["steps"],
+        )
+
+    def _remember(self, key: str, result: GradingResult):
+        self._results[key] = result
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    async def get(self, key: str) -> typing.Optional[GradingResult]:
+        """
+        Get cached result, from memory or from `load`
+        :param key: see `key`
+        :return: grading result, None on cache miss
+        """
+        if (result := self._results.get(key)) is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return result
+
+        if self.load is not None and (data := await self.load(key)) is not None:
+            self.stored_hits += 1
+            result = self.loads(data)
+            self._remember(key, result)
+            return result
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, result: GradingResult):
+        """
+        Cache grading result, unless it is not `cacheable`
+        :param key: see `key`
+        :param result: grading result
+        """
+        if not self.cacheable(result):
+            return
+
+        self._remember(key, result)
+        if self.store is not None:
+            await self.store(key, self.dumps(result))
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            "size": len(self._results),
+            "hits": self.hits,
+            "stored_hits": self.stored_hits,
+            "misses": self.misses,
+        }
+
+
+def generate_tests(
+    task: str,
+    taskvars: int,
+    seed: int,
+    count: int = TEST_BANK_SIZE,
+) -> typing.List[Vector]:
+    """
+    Generate input vectors with expected answers. Executed in sandbox worker.
+    :param task: task source as stored in database
+    :param taskvars: number of arguments of `f`
+    :param seed: seed of input values
+    :param count: number of vectors
+    :return: (input, expected answer) pairs
+    """
+    rng = random.Random(seed)
+    tests = [
+        [rng.randint(TEST_MIN_VALUE, TEST_MAX_VALUE) for _ in range(taskvars)]
+        for _ in range(count)
+    ]
+    return list(zip(tests, evaluate(task, tests)))
+
+
+class SandboxError(Exception):
+    """Reference solution exceeded sandbox limits or returned invalid answer"""
+
+
+def _sandbox_init(memory_limit: int):
+    """Limit address space of sandbox worker on top of its current usage."""
+    if resource is None:
+        return
+
+    try:
+        with open("/proc/self/statm") as f:
+            used = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        used = 0
+
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = used + memory_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _cpu_limit_exceeded(signum, frame):
+    raise SandboxError("CPU time limit exceeded")
+
+
+def _sandboxed(cpu_limit: float, func: callable, *args):
+    """
+    Call function in sandbox worker, limiting its CPU time. Worker
+    survives the limit, so it stays warm for the next call.
+    """
+    timer = getattr(signal, "ITIMER_PROF", None)
+    if timer is not None:
+        signal.signal(signal.SIGPROF, _cpu_limit_exceeded)
+        signal.setitimer(timer, cpu_limit)
+
+    try:
+        return func(*args)
+    except MemoryError:
+        raise SandboxError("Memory limit exceeded") from None
+    except RecursionError:
+        raise SandboxError("Maximum recursion depth exceeded") from None
+    finally:
+        if timer is not None:
+            signal.setitimer(timer, 0)
+
+
+def evaluate(task: str, tests: typing.List[typing.List[int]]) -> typing.List[int]:
+    """
+    Compute expected answers. Executed in sandbox worker.
+    :param task: task source as stored in database
+    :param tests: input vectors
+    :return: answers of reference solution
+    """
+    reference = references.get(task)
+    answers = [reference(*inp) for inp in tests]
+    for answer in answers:
+        if not isinstance(answer, int) or isinstance(answer, bool):
+            raise SandboxError(f"f must return int, not {type(answer).__name__}")
+
+    return answers
+
+
+def draw_tests(
+    bank: typing.Sequence[Vector],
+    count: int,
+    seed: int,
+) -> typing.Tuple[typing.List[typing.List[int]], typing.List[int]]:
+    """
+    Draw tests from test bank. Same seed always gives the same tests.
+    :param bank: test bank
+    :param count: number of tests
+    :param seed: seed of this grading run
+    :return: input vectors and their expected answers
+    """
+    tests = random.Random(seed).sample(list(bank), min(count, len(bank)))
+    return [inp for inp, _ in tests], [expected for _, expected in tests]
+
+
+def run_tests(
+    program: leninec.Program,
+    task: str,
+    tests: typing.List[typing.List[int]],
+    timeout: float = TEST_TIMEOUT,
+    optimize: bool = True,
+    max_steps: typing.Optional[int] = None,
+    expected: typing.Optional[typing.List[int]] = None,
+) -> GradingResult:
+    """
+    Run compiled program against all input vectors at once and check
+    answers in order. Executed in worker process.
+    :param program: compiled program
+    :param task: task source as stored in database
+    :param tests: input vectors
+    :param timeout: wall-clock timeout for the whole batch
+    :param optimize: run program through peephole optimiser first.
+        Reported positions always refer to the source program
+    :param max_steps: step budget of each test
+    :param expected: expected answers, e.g. from test bank. Computed with
+        reference solution if not specified
+    :return: verdict with summaries of executed tests
+    """
+    if optimize:
+        program = leninec.optimize(program)
+
+    lanes = run_lanes(
+        program,
+        (list(reversed(inp)) for inp in tests),
+        timeout=timeout,
+        max_steps=max_steps,
+    )
+    steps = sum(lane.steps for lane in lanes)
+    reference = None
+    reference_time = 0.0
+    results = []
+    for test, (inp, lane) in enumerate(zip(tests, lanes)):
+        timed_out = isinstance(lane.error, leninec.errors.TimeoutExceededError)
+        position = program.source_position(
+            lane.position,
+            failed=lane.error is not None and not timed_out,
+        )
+        results.append(TestResult(inp, lane.registers, lane.stack, position))
+        if timed_out:
+            return GradingResult("TL", results, str(lane.error), steps)
+
+        if lane.error is not None:
+            if not isinstance(lane.error, leninec.errors.VMError):
+                raise lane.error
+
+            return GradingResult(
+                "RE", results, f"{lane.error.__class__.__name__}: {lane.error}", steps
+            )
+
+        if lane.stack:
+            if expected is not None:
+                answer = expected[test]
+            else:
+                start = time.perf_counter()
+                reference = reference or references.get(task)
+                answer = reference(*inp)
+                reference_time += time.perf_counter() - start
+
+            if answer != lane.stack[-1]:
+                return GradingResult(
+                    "WA", results, steps=steps, reference_time=reference_time
+                )
+
+    return GradingResult("OK", results, steps=steps, reference_time=reference_time)
+
+
+def grade_source(
+    source: str,
+    task: str,
+    tests: typing.List[typing.List[int]],
+    timeout: float = TEST_TIMEOUT,
+    optimize: bool = True,
+    max_steps: typing.Optional[int] = None,
+    expected: typing.Optional[typing.List[int]] = None,
+) -> GradingResult:
+    """
+    Compile program and grade it, see `run_tests`. Executed in worker
+    process, so stored submissions are recompiled off the event loop.
+    :param source: program source
+    :return: verdict, CE if program does not compile
+    """
+    vm = leninec.VM()
+    try:
+        vm.update_code(source)
+    except leninec.errors.VMError as e:
+        return GradingResult("CE", [], f"{e.__class__.__name__}: {e}")
+
+    return run_tests(vm.program, task, tests, timeout, optimize, max_steps, expected)
+
+
+class WorkerPool:
+    """
+    Pool of worker processes, so CPU-heavy jobs do not block the event
+    loop. Pool is recreated after `recycle_after` jobs, when a job times
+    out or when a worker dies.
+    """
+
+    def __init__(
+        self,
+        workers: typing.Optional[int] = None,
+        recycle_after: int = 500,
+        initializer: typing.Optional[callable] = None,
+        initargs: tuple = (),
+    ):
+        self.workers: int = workers or os.cpu_count() or 1
+        self.recycle_after: int = recycle_after
+        self.initializer: typing.Optional[callable] = initializer
+        self.initargs: tuple = initargs
+        self._executor: typing.Optional[ProcessPoolExecutor] = None
+        self._jobs: int = 0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None or self._jobs >= self.recycle_after:
+            self._recycle()
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=self.initializer,
+                initargs=self.initargs,
+            )
+
+        self._jobs += 1
+        return self._executor
+
+    def _recycle(self, terminate: bool = False):
+        """
+        Drop current pool. Running jobs are allowed to finish,
+        unless `terminate` is set.
+        """
+        if self._executor is None:
+            return
+
+        executor, self._executor, self._jobs = self._executor, None, 0
+        # Executor has no public API to kill stuck workers
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=False)
+        if terminate:
+            for process in processes:
+                process.terminate()
+
+    async def _submit(self, timeout: float, func: callable, *args):
+        """
+        Run function in worker pool. Raises asyncio.TimeoutError if it
+        does not finish within `timeout`, pool is recycled then.
+        """
+        # Jobs of a pool terminated because of another job's timeout
+        # fail with BrokenProcessPool, so they are retried once. Submitting to
+        # a pool whose worker died raises it as well
+        for attempt in range(2):
+            executor = self._get_executor()
+            try:
+                future = asyncio.get_running_loop().run_in_executor(
+                    executor, func, *args
+                )
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if executor is self._executor:
+                    self._recycle(terminate=True)
+
+                raise
+            except BrokenProcessPool:
+                if executor is self._executor:
+                    self._recycle()
+
+                if attempt:
+                    raise
+
+    def shutdown(self):
+        self._recycle(terminate=True)
+
+
+class GradingBackend(WorkerPool):
+    """Runs grading jobs in worker pool."""
+
+    async def grade(
+        self,
+        program: leninec.Program,
+        task: str,
+        tests: typing.List[typing.List[int]],
+        timeout: float = TEST_TIMEOUT,
+        optimize: bool = True,
+        max_steps: typing.Optional[int] = None,
+        expected: typing.Optional[typing.List[int]] = None,
+    ) -> GradingResult:
+        """
+        Grade compiled program in worker pool.
+        :param program: compiled program
+        :param task: task source as stored in database
+        :param tests: input vectors
+        :param timeout: wall-clock timeout for the whole batch
+        :param optimize: run program through peephole optimiser first
+        :param max_steps: step budget of each test
+        :param expected: expected answers, see `run_tests`
+        :return: grading result
+        """
+        try:
+            return await self._submit(
+                timeout + 5,
+                run_tests,
+                program,
+                task,
+                tests,
+                timeout,
+                optimize,
+                max_steps,
+                expected,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Grading job timed out, recycling worker pool")
+            return GradingResult("TL", [], f"Timeout of {timeout} seconds exceeded")
+
+    async def grade_source(
+        self,
+        source: str,
+        task: str,
+        tests: typing.List[typing.List[int]],
+        timeout: float = TEST_TIMEOUT,
+        max_steps: typing.Optional[int] = None,
+        expected: typing.Optional[typing.List[int]] = None,
+    ) -> GradingResult:
+        """
+        Compile and grade program source in worker pool, see `grade`.
+        :param source: program source
+        :return: grading result, CE if program does not compile
+        """
+        try:
+            return await self._submit(
+                timeout + 5,
+                grade_source,
+                source,
+                task,
+                tests,
+                timeout,
+                True,
+                max_steps,
+                expected,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Grading job timed out, recycling worker pool")
+            return GradingResult("TL", [], f"Timeout of {timeout} seconds exceeded")
+
+
+class ReferenceSandbox(WorkerPool):
+    """
+    Evaluates reference solutions in a small pool of worker processes.
+    Every call is limited in CPU time and every worker in memory, so
+    teacher's code can not block the server. Workers are reused between
+    calls and keep compiled reference functions (see `references`).
+    Wall-clock timeout of the whole job recycles the pool, it catches
+    code, which is not interrupted by CPU limit, e.g. sleeping.
+    """
+
+    def __init__(
+        self,
+        workers: int = SANDBOX_WORKERS,
+        cpu_limit: float = SANDBOX_CPU_LIMIT,
+        memory_limit: int = SANDBOX_MEMORY_LIMIT,
+    ):
+        super().__init__(
+            workers,
+            initializer=_sandbox_init,
+            initargs=(memory_limit,),
+        )
+        self.cpu_limit: float = cpu_limit
+
+    async def _run(self, func: callable, *args):
+        try:
+            return await self._submit(
+                self.cpu_limit * 2 + 5, _sandboxed, self.cpu_limit, func, *args
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Sandbox job timed out, recycling worker pool")
+            raise SandboxError(
+                f"Time limit of {self.cpu_limit} seconds exceeded"
+            ) from None
+
+    async def evaluate(
+        self,
+        task: str,
+        tests: typing.List[typing.List[int]],
+    ) -> typing.List[int]:
+        """
+        Compute expected answers, see `evaluate`. Raises SandboxError if
+        limits are exceeded and any error raised by reference solution.
+        """
+        return await self._run(evaluate, task, tests)
+
+    async def generate_tests(
+        self,
+        task: str,
+        taskvars: int,
+        seed: int,
+        count: int = TEST_BANK_SIZE,
+    ) -> typing.List[Vector]:
+        """Generate test bank, see `generate_tests`."""
+        return await self._run(generate_tests, task, taskvars, seed, count)
@@ -1,6 +1,24 @@
-from . import errors, registers, stack, vm
+from . import (
+    cache,
+    errors,
+    jit,
+    lanes,
+    loops,
+    macros,
+    opcodes,
+    optimizer,
+    profiler,
+    program,
+    registers,
+    scheduler,
+    stack,
+    trace,
+    vm,
+)
+from .cache import ProgramCache
 from .errors import (
     CodeTooBigError,
+    InfiniteLoopError,
     InvalidArgError,
     InvalidInstructionError,
     InvalidLabelError,
@@ -9,21 +27,34 @@ from .errors import (
     MacroRedefinitionError,
     PopFromEmptyStackError,
     StackOverflowError,
+    StepLimitExceededError,
     TimeoutExceededError,
     UndefinedLabelError,
     UndefinedMacroError,
     ValueOverflowError,
     VMSyntaxError,
 )
+from .optimizer import optimize
+from .profiler import Profile
+from .program import Program
 from .registers import Registers
+from .scheduler import Scheduler
 from .stack import Stack
-from .vm import VM
+from .trace import Trace
+from .vm import State, VM
 
 __all__ = [
     "VM",
+    "Profile",
+    "Program",
+    "ProgramCache",
     "Registers",
+    "Scheduler",
     "Stack",
+    "State",
+    "Trace",
     "CodeTooBigError",
+    "InfiniteLoopError",
     "InvalidArgError",
     "InvalidInstructionError",
     "InvalidLabelError",
@@ -32,13 +63,26 @@ __all__ = [
     "MacroRedefinitionError",
     "PopFromEmptyStackError",
     "StackOverflowError",
+    "StepLimitExceededError",
     "TimeoutExceededError",
     "UndefinedLabelError",
     "UndefinedMacroError",
     "ValueOverflowError",
     "VMSyntaxError",
+    "optimize",
+    "cache",
     "errors",
+    "jit",
+    "lanes",
+    "loops",
+    "macros",
+    "opcodes",
+    "optimizer",
+    "profiler",
+    "program",
     "registers",
+    "scheduler",
     "stack",
+    "trace",
     "vm",
 ]
@@ -0,0 +1,104 @@
+import collections
+import hashlib
+import typing
+
+from .program import Program
+
+
+class ProgramCache:
+    """
+    Process-wide LRU cache of compiled programs, keyed by hash of
+    normalised source code. Compilation errors are not cached.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize: int = maxsize
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._programs: typing.OrderedDict[str, Program] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._programs)
+
+    @staticmethod
+    def normalize(code: str) -> str:
+        """
+        Drop whitespace around lines, empty lines and comments outside of
+        macro definitions. Such changes never affect compilation result.
+        Macro bodies are kept line by line, since a macro with an empty body
+        can not be called, while one with only comments or blank lines can.
+        """
+        lines = []
+        in_macro = False
+        for line in map(str.strip, code.splitlines()):
+            if in_macro:
+                lines.append(line)
+                in_macro = line != "#enddefine"
+            elif line and not line.startswith("//"):
+                lines.append(line)
+                # Same check as the compiler does, macro calls end with '!'
+                in_macro = not line.endswith("!") and line.lower().startswith("#define")
+
+        return "\n".join(lines)
+
+    @classmethod
+    def key(cls, code: str, salt: str = "") -> str:
+        """
+        Get cache key of source code.
+        :param code: source code
+        :param salt: compiler configuration, which affects the result
+        :return: hex digest
+        """
+        return hashlib.sha256(f"{salt}\0{cls.normalize(code)}".encode()).hexdigest()
+
+    def get(self, key: str) -> typing.Optional[Program]:
+        program = self._programs.get(key)
+        if program is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._programs.move_to_end(key)
+        return program
+
+    def put(self, key: str, program: Program):
+        self._programs[key] = program
+        self._programs.move_to_end(key)
+        while len(self._programs) > self.maxsize:
+            self._programs.popitem(last=False)
+            self.evictions += 1
+
+    def compile(
+        self,
+        code: str,
+        compiler: typing.Callable[[str], Program],
+        salt: str = "",
+    ) -> Program:
+        """
+        Get compiled program from cache or compile it.
+        :param code: source code
+        :param compiler: function to compile code on cache miss
+        :param salt: compiler configuration, which affects the result
+        :return: compiled program
+        """
+        key = self.key(code, salt)
+        if (program := self.get(key)) is None:
+            program = compiler(code)
+            self.put(key, program)
+
+        return program
+
+    def stats(self) -> typing.Dict[str, int]:
+        return {
+            "size": len(self._programs),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        self._programs.clear()
+
+
+program_cache = ProgramCache()
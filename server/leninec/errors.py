@@ -56,3 +56,11 @@ class InvalidArgError(VMError):
 
 class UndefinedLabelError(VMError):
     """Raised when trying to use undefined label"""
+
+
+class InfiniteLoopError(TimeoutExceededError):
+    """Raised when VM returns to an already visited state"""
+
+
+class StepLimitExceededError(TimeoutExceededError):
+    """Raised when VM executes more instructions than allowed"""
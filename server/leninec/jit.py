@@ -0,0 +1,200 @@
+"""
+Basic-block compiler.
+
+Program is split into basic blocks at jump targets and after jumps. Each block
+is translated into a Python function, which keeps registers in local
+variables, executes all instructions of the block and returns position of the
+next block:
+
+    def _block_3(r, s):
+        r0 = r[0]
+        n = len(s)
+        if n < 1 or n + 0 > 1000:
+            return -1
+        t = s[n - 1:]
+        try:
+            r0 = s.pop()
+            if not -18446744073709551615 <= r0 <= 18446744073709551615:
+                raise Bailout
+            r0 = r0 + 5
+            ...
+        except Exception:
+            del s[n - 1:]
+            s.extend(t)
+            return -1
+        r[0] = r0
+        return 7 if r0 > 0 else 5
+
+Stack bounds are checked once on entry to the block, overflow is checked after
+every write which can overflow. If any check fails, block undoes its stack
+changes and returns -1 without writing registers back, so VM can execute the
+block again instruction by instruction and fail exactly where the interpreter
+would.
+"""
+
+import typing
+
+from . import opcodes
+
+Block = typing.Tuple[typing.Callable[[typing.List[int], typing.List[int]], int], int]
+
+# Arithmetic opcodes, whose result always fits into range of the operands
+_BOUNDED: typing.FrozenSet[int] = frozenset(
+    {opcodes.MOV, opcodes.DIV, opcodes.DIVI, opcodes.MOD, opcodes.MODI}
+)
+
+_OPERATORS: typing.Dict[int, str] = {
+    opcodes.ADD: "+",
+    opcodes.ADDI: "+",
+    opcodes.SUB: "-",
+    opcodes.SUBI: "-",
+    opcodes.MUL: "*",
+    opcodes.MULI: "*",
+    opcodes.DIV: "//",
+    opcodes.DIVI: "//",
+    opcodes.MOD: "%",
+    opcodes.MODI: "%",
+}
+
+_CONDITIONS: typing.Dict[int, str] = {
+    opcodes.JE: "not {}",
+    opcodes.JG: "{} > 0",
+    opcodes.JL: "{} < 0",
+}
+
+
+class Bailout(Exception):
+    """Raised inside of a block, when it has to be executed by interpreter."""
+
+
+def leaders(
+    instructions: typing.Sequence[typing.Tuple[int, int, int]],
+) -> typing.List[int]:
+    """
+    Get sorted start positions of basic blocks
+    :param instructions: compiled program
+    :return: block start positions
+    """
+    result = {0}
+    for i, (op, a, b) in enumerate(instructions):
+        if op in opcodes.JUMPS:
+            result.add(i + 1)
+            result.add(a if op == opcodes.JMP else b)
+
+    return sorted(position for position in result if position < len(instructions))
+
+
+def compile_blocks(
+    instructions: typing.Sequence[typing.Tuple[int, int, int]],
+    max_value: int,
+    max_stack: int,
+) -> typing.Dict[int, Block]:
+    """
+    Compile program into block functions. Use `Program.blocks`, which keeps
+    them with the program.
+    :param instructions: compiled program
+    :param max_value: max absolute register value
+    :param max_stack: max stack size
+    :return: block start position -> (block function, number of instructions)
+    """
+    starts = leaders(instructions)
+    source = []
+    for start, end in zip(starts, starts[1:] + [len(instructions)]):
+        source.extend(_translate(instructions, start, end, max_value, max_stack))
+
+    namespace = {"Bailout": Bailout}
+    exec(compile("\n".join(source), "<leninec blocks>", "exec"), namespace)
+    return {
+        start: (namespace[f"_block_{start}"], end - start)
+        for start, end in zip(starts, starts[1:] + [len(instructions)])
+    }
+
+
+def _translate(
+    instructions: typing.Sequence[typing.Tuple[int, int, int]],
+    start: int,
+    end: int,
+    max_value: int,
+    max_stack: int,
+) -> typing.List[str]:
+    """Generate source of a single block function."""
+    body = []
+    used, written = set(), set()
+    level = need = grow = 0
+    stack_used = False
+    next_position = str(end)
+
+    def check(register: int):
+        body.append(f"if not -{max_value} <= r{register} <= {max_value}:")
+        body.append("    raise Bailout")
+
+    for position in range(start, end):
+        op, a, b = instructions[position]
+        if op <= opcodes.MODI:
+            used.add(a)
+            written.add(a)
+            if op == opcodes.MOVI:
+                body.append(f"r{a} = {b}")
+                if abs(b) > max_value:
+                    check(a)
+
+                continue
+
+            if op & 1:
+                right = str(b)
+            else:
+                used.add(b)
+                right = f"r{b}"
+
+            if op == opcodes.MOV:
+                body.append(f"r{a} = {right}")
+            else:
+                body.append(f"r{a} = r{a} {_OPERATORS[op]} {right}")
+
+            if op not in _BOUNDED:
+                check(a)
+        elif op == opcodes.POP:
+            used.add(a)
+            written.add(a)
+            stack_used = True
+            level -= 1
+            need = max(need, -level)
+            body.append(f"r{a} = s.pop()")
+            check(a)
+        elif op <= opcodes.PUSHI:
+            stack_used = True
+            level += 1
+            grow = max(grow, level)
+            if op == opcodes.PUSHI:
+                body.append(f"s.append({a})")
+            else:
+                used.add(a)
+                body.append(f"s.append(r{a})")
+        elif op == opcodes.JMP:
+            next_position = str(a)
+        else:
+            used.add(a)
+            condition = _CONDITIONS[op].format(f"r{a}")
+            next_position = f"{b} if {condition} else {end}"
+
+    lines = [f"def _block_{start}(r, s):"]
+    lines.extend(f"    r{register} = r[{register}]" for register in sorted(used))
+    if stack_used:
+        lines.append("    n = len(s)")
+        lines.append(f"    if n < {need} or n + {grow} > {max_stack}:")
+        lines.append("        return -1")
+        lines.append(f"    t = s[n - {need}:]")
+
+    if body:
+        lines.append("    try:")
+        lines.extend(f"        {line}" for line in body)
+        lines.append("    except Exception:")
+        if stack_used:
+            lines.append(f"        del s[n - {need}:]")
+            lines.append("        s.extend(t)")
+
+        lines.append("        return -1")
+
+    lines.extend(f"    r[{register}] = r{register}" for register in sorted(written))
+    lines.append(f"    return {next_position}")
+    return lines
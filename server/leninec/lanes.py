@@ -0,0 +1,341 @@
+"""
+Batched execution of one program over many initial stacks.
+
+Lanes are executed in lockstep: lanes sharing the same position form a group
+and the instruction at that position is executed for the whole group at once.
+The group with the lowest position always goes first, so lanes which diverged
+on a branch catch up and are merged back together. Register files are stored
+as per-lane NumPy arrays and arithmetic is vectorised across the group.
+
+Vectorised lanes keep every register within `NARROW_VALUE`, so results of any
+arithmetic instruction fit into int64 exactly. A lane which leaves that range,
+or starts with a wider input, is executed by a regular `VM` instead. Without
+NumPy, or for small batches, all lanes are executed by regular VMs.
+"""
+
+import time
+import typing
+
+from . import opcodes
+from .errors import (
+    PopFromEmptyStackError,
+    StackOverflowError,
+    StepLimitExceededError,
+    TimeoutExceededError,
+    VMError,
+)
+from .program import Program
+from .vm import VM
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+NARROW_VALUE: int = 2**31 - 1
+MIN_VECTOR_LANES: int = 64
+
+
+class LaneResult(typing.NamedTuple):
+    registers: typing.Tuple[int, ...]
+    stack: typing.Tuple[int, ...]
+    position: int
+    error: typing.Optional[Exception] = None
+    steps: int = 0
+
+
+def run_lanes(
+    program: typing.Union[Program, typing.Sequence[typing.Tuple[int, int, int]]],
+    stacks: typing.Iterable[typing.Sequence[int]],
+    timeout: typing.Optional[float] = None,
+    vectorize: typing.Optional[bool] = None,
+    max_steps: typing.Optional[int] = None,
+) -> typing.List[LaneResult]:
+    """
+    Run compiled program once for each initial stack.
+    :param program: compiled program or bare bytecode
+    :param stacks: initial stack of each lane, bottom first
+    :param timeout: wall-clock timeout for the whole batch. Lanes, which are
+        not finished in time, get TimeoutExceededError as their error
+    :param vectorize: force or forbid vectorised execution. By default it is
+        used when NumPy is installed and batch is big enough
+    :param max_steps: step budget of each lane. Lanes, which are not finished
+        within it, get StepLimitExceededError as their error
+    :return: final state of each lane
+    """
+    if not isinstance(program, Program):
+        program = Program(tuple(program))
+
+    stacks = [list(stack) for stack in stacks]
+    if vectorize is None:
+        vectorize = np is not None and len(stacks) >= MIN_VECTOR_LANES
+
+    deadline = time.perf_counter() + timeout if timeout else None
+    if not vectorize:
+        return [
+            _run_scalar(program, stack, 0, None, deadline, max_steps)
+            for stack in stacks
+        ]
+
+    return _LaneEngine(program, stacks, deadline, max_steps).run()
+
+
+def _run_scalar(
+    program: Program,
+    stack: typing.List[int],
+    position: int,
+    registers: typing.Optional[typing.Sequence[int]],
+    deadline: typing.Optional[float],
+    max_steps: typing.Optional[int] = None,
+    steps: int = 0,
+) -> LaneResult:
+    """Run single lane from given state using regular VM."""
+    vm = VM()
+    vm.delay = 0
+    vm.load(program)
+    vm.stack.extend(stack)
+    vm.position = position
+    vm.steps = steps
+    if registers is not None:
+        vm.registers[:] = registers
+
+    error = None
+    try:
+        remaining = None
+        if deadline is not None and (remaining := deadline - time.perf_counter()) <= 0:
+            raise TimeoutExceededError("Timeout exceeded")
+
+        vm.run_sync(
+            max_steps=None if max_steps is None else max_steps - steps,
+            timeout=remaining,
+        )
+        if not vm.finished:
+            raise StepLimitExceededError(f"Step limit of {max_steps} exceeded")
+    except (VMError, ZeroDivisionError) as e:
+        error = e
+
+    return LaneResult(
+        tuple(vm.registers), tuple(vm.stack), vm.position, error, vm.steps
+    )
+
+
+class _LaneEngine:
+    def __init__(
+        self,
+        program: Program,
+        stacks: typing.List[typing.List[int]],
+        deadline: typing.Optional[float],
+        max_steps: typing.Optional[int],
+    ):
+        self.program = program
+        self.instructions = program.instructions
+        self.stacks = stacks
+        self.deadline = deadline
+        self.max_steps = max_steps
+        self.size = len(stacks)
+        self.registers = np.zeros((len(VM.REGISTERS), self.size), dtype=np.int64)
+        self.steps = np.zeros(self.size, dtype=np.int64)
+        self.results: typing.List[typing.Optional[LaneResult]] = [None] * self.size
+        self.groups: typing.Dict[int, typing.Any] = {}
+
+    def run(self) -> typing.List[LaneResult]:
+        narrow = []
+        for lane, stack in enumerate(self.stacks):
+            if len(stack) > VM.MAX_STACK_SIZE or any(
+                abs(value) > NARROW_VALUE for value in stack
+            ):
+                self.results[lane] = _run_scalar(
+                    self.program, stack, 0, None, self.deadline, self.max_steps
+                )
+            else:
+                narrow.append(lane)
+
+        if narrow:
+            self._join(0, np.array(narrow, dtype=np.intp))
+
+        code = self.instructions
+        end = len(code)
+        executed = 0
+        while self.groups:
+            pos = min(self.groups)
+            lanes = self.groups.pop(pos)
+            if pos >= end:
+                for lane in lanes.tolist():
+                    self._finish(lane, pos)
+
+                continue
+
+            if self.max_steps is not None:
+                exhausted = self.steps[lanes] >= self.max_steps
+                if np.any(exhausted):
+                    for lane in lanes[exhausted].tolist():
+                        self._finish(
+                            lane,
+                            pos,
+                            StepLimitExceededError(
+                                f"Step limit of {self.max_steps} exceeded"
+                            ),
+                        )
+
+                    lanes = lanes[~exhausted]
+                    if not len(lanes):
+                        continue
+
+            executed += 1
+            if (
+                self.deadline is not None
+                and not executed & 255
+                and time.perf_counter() > self.deadline
+            ):
+                self._join(pos, lanes)
+                self._time_out()
+                break
+
+            op, a, b = instruction = code[pos]
+            if op == opcodes.MOVI and abs(b) > NARROW_VALUE:
+                # Folded constants can be wide. Regular VM executes and counts
+                # the instruction, so it is not counted here
+                for lane in lanes.tolist():
+                    self._demote(lane, pos)
+
+                continue
+
+            self.steps[lanes] += 1
+            self._execute(pos, instruction, lanes)
+
+        return self.results
+
+    def _join(self, pos: int, lanes):
+        if not len(lanes):
+            return
+
+        if pos in self.groups:
+            lanes = np.concatenate((self.groups[pos], lanes))
+
+        self.groups[pos] = lanes
+
+    def _finish(self, lane: int, pos: int, error: typing.Optional[Exception] = None):
+        self.results[lane] = LaneResult(
+            tuple(int(value) for value in self.registers[:, lane]),
+            tuple(self.stacks[lane]),
+            pos,
+            error,
+            int(self.steps[lane]),
+        )
+
+    def _time_out(self):
+        for pos, lanes in self.groups.items():
+            for lane in lanes.tolist():
+                self._finish(lane, pos, TimeoutExceededError("Timeout exceeded"))
+
+        self.groups.clear()
+
+    def _demote(self, lane: int, pos: int):
+        """Continue lane, which left the narrow range, using regular VM."""
+        self.results[lane] = _run_scalar(
+            self.program,
+            self.stacks[lane],
+            pos,
+            [int(value) for value in self.registers[:, lane]],
+            self.deadline,
+            self.max_steps,
+            int(self.steps[lane]),
+        )
+
+    def _execute(self, pos: int, instruction: typing.Tuple[int, int, int], lanes):
+        op, a, b = instruction
+        regs = self.registers
+        if op <= opcodes.MODI:
+            if op == opcodes.MOVI:
+                regs[a, lanes] = b
+            elif op == opcodes.MOV:
+                regs[a, lanes] = regs[b, lanes]
+            else:
+                left = regs[a, lanes]
+                right = b if op & 1 else regs[b, lanes]
+                if op in {opcodes.DIV, opcodes.DIVI, opcodes.MOD, opcodes.MODI}:
+                    # Immediate divisor gives a plain bool, mask has to cover
+                    # every lane
+                    zero = np.full(len(lanes), right == 0) if op & 1 else right == 0
+                    if np.any(zero):
+                        for lane in lanes[zero].tolist():
+                            self._finish(
+                                lane,
+                                pos + 1,
+                                ZeroDivisionError("integer division or modulo by zero"),
+                            )
+
+                        lanes, left = lanes[~zero], left[~zero]
+                        right = right if op & 1 else right[~zero]
+
+                    if op <= opcodes.DIVI:
+                        values = np.floor_divide(left, right)
+                    else:
+                        values = np.mod(left, right)
+                elif op <= opcodes.ADDI:
+                    values = left + right
+                elif op <= opcodes.SUBI:
+                    values = left - right
+                else:
+                    values = left * right
+
+                regs[a, lanes] = values
+                wide = np.abs(values) > NARROW_VALUE
+                if np.any(wide):
+                    for lane in lanes[wide].tolist():
+                        self._demote(lane, pos + 1)
+
+                    lanes = lanes[~wide]
+
+            self._join(pos + 1, lanes)
+        elif op == opcodes.JMP:
+            self._join(a, lanes)
+        elif op in {opcodes.JE, opcodes.JG, opcodes.JL}:
+            values = regs[a, lanes]
+            if op == opcodes.JE:
+                taken = values == 0
+            elif op == opcodes.JG:
+                taken = values > 0
+            else:
+                taken = values < 0
+
+            self._join(b, lanes[taken])
+            self._join(pos + 1, lanes[~taken])
+        elif op == opcodes.POP:
+            popped, values = [], []
+            for lane in lanes.tolist():
+                stack = self.stacks[lane]
+                if not stack:
+                    self._finish(
+                        lane,
+                        pos + 1,
+                        PopFromEmptyStackError("Cannot pop from empty stack"),
+                    )
+                    continue
+
+                popped.append(lane)
+                values.append(stack.pop())
+
+            popped = np.array(popped, dtype=np.intp)
+            regs[a, popped] = values
+            self._join(pos + 1, popped)
+        else:
+            if op == opcodes.PUSHI:
+                values = [a] * len(lanes)
+            else:
+                values = regs[a, lanes].tolist()
+
+            pushed = []
+            for lane, value in zip(lanes.tolist(), values):
+                stack = self.stacks[lane]
+                stack.append(value)
+                if len(stack) > VM.MAX_STACK_SIZE:
+                    self._finish(
+                        lane,
+                        pos + 1,
+                        StackOverflowError(f"Stack size exceeded {VM.MAX_STACK_SIZE}"),
+                    )
+                else:
+                    pushed.append(lane)
+
+            self._join(pos + 1, np.array(pushed, dtype=np.intp))
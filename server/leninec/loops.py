@@ -0,0 +1,59 @@
+import typing
+
+
+class LoopDetector:
+    """
+    Detects non-terminating programs using Brent's cycle detection.
+    VM is deterministic, so if it reaches exactly the same state (position,
+    registers and stack) twice, it will never finish. States are sampled at
+    jumps: one state is saved and every next sample is compared with it,
+    the saved state is replaced after 1, 2, 4, 8... samples. A loop is found
+    within a few of its iterations, while states are copied only
+    a logarithmic number of times.
+    Cheap fields are compared first, so stack contents are compared only
+    when position, registers and stack size are equal.
+    """
+
+    __slots__ = ("position", "registers", "stack", "power", "length")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forget the saved state."""
+        self.position: int = -1
+        self.registers: typing.List[int] = []
+        self.stack: typing.List[int] = []
+        self.power: int = 1
+        self.length: int = 1
+
+    def check(
+        self,
+        position: int,
+        registers: typing.List[int],
+        stack: typing.List[int],
+    ) -> bool:
+        """
+        Sample VM state
+        :param position: position of the next instruction
+        :param registers: register values
+        :param stack: stack values
+        :return: True if this state was already seen
+        """
+        if (
+            position == self.position
+            and registers == self.registers
+            and len(stack) == len(self.stack)
+            and stack == self.stack
+        ):
+            return True
+
+        if self.length == self.power:
+            self.position = position
+            self.registers = list(registers)
+            self.stack = list(stack)
+            self.power *= 2
+            self.length = 0
+
+        self.length += 1
+        return False
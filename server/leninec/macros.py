@@ -0,0 +1,105 @@
+"""
+Macro templates.
+
+Body of `#define name` ... `#enddefine` is parsed once, when the macro is
+defined. Plain lines are compiled into template items right away, so calling
+a macro does not parse its body again. Lines which depend on the call are kept
+as slots and are finished on each call:
+    label lines (ending with ':') are prefixed with `name-N#`
+    lines with '{}' get the same prefix substituted for it
+where N is the number of previous calls of the macro.
+
+Number of instructions and of template items produced by a call are computed
+from the templates before expanding, so oversized programs are rejected
+without generating them. Items include labels and nested calls, so macros,
+which produce few or no instructions, can not expand without bound either.
+"""
+
+import typing
+
+from .errors import VMSyntaxError
+
+# Kinds of template items and of parsed lines
+INSTRUCTION = 0
+LABEL = 1
+CALL = 2
+DEFINE = 3
+PREFIXED_LABEL = 4
+SLOT = 5
+
+Item = typing.Tuple[int, typing.Any]
+
+
+class Macro:
+    def __init__(self, name: str):
+        self.name: str = name
+        self.body: typing.List[Item] = []
+        self.callees: typing.List[str] = []
+        self.instructions: int = 0
+        self.size: typing.Optional[int] = None
+        self.expansion: typing.Optional[int] = None
+        self.calls: int = 0
+
+    def __repr__(self) -> str:
+        return f"<Macro {self.name} of {len(self.body)} items>"
+
+    def add(self, kind: int, payload: typing.Any, instructions: int = 0):
+        """
+        Append item to the template
+        :param kind: item kind
+        :param payload: parsed instruction, raw line for slots or macro name for calls
+        :param instructions: number of instructions the item produces by itself
+        """
+        self.body.append((kind, payload))
+        self.instructions += instructions
+        if kind == CALL:
+            self.callees.append(payload)
+
+    def next_prefix(self) -> str:
+        """
+        Get label prefix for the next call of this macro
+        :return: label prefix
+        """
+        prefix = f"{self.name}-{self.calls}#"
+        self.calls += 1
+        return prefix
+
+
+def measure(macro: Macro, resolve: typing.Callable[[str], Macro]) -> int:
+    """
+    Get number of instructions produced by a call of macro, including nested
+    calls. Number of template items expanded by the call is stored in
+    `expansion`. Sizes are memoized on macros, so each template is visited once.
+    :param macro: macro to measure
+    :param resolve: function returning macro by name, raises if it is not defined
+    :return: number of instructions
+    """
+    if macro.size is not None:
+        return macro.size
+
+    path = [(macro, iter(macro.callees))]
+    active = {macro.name}
+    while path:
+        current, callees = path[-1]
+        for name in callees:
+            callee = resolve(name)
+            if callee.size is not None:
+                continue
+
+            if callee.name in active:
+                raise VMSyntaxError("Recursive macro call detected")
+
+            active.add(callee.name)
+            path.append((callee, iter(callee.callees)))
+            break
+        else:
+            current.size = current.instructions + sum(
+                resolve(name).size for name in current.callees
+            )
+            current.expansion = len(current.body) + sum(
+                resolve(name).expansion for name in current.callees
+            )
+            active.discard(current.name)
+            path.pop()
+
+    return macro.size
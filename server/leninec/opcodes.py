@@ -0,0 +1,103 @@
+"""
+Bytecode definitions.
+
+Every compiled instruction is a ``(opcode, a, b)`` tuple of integers:
+registers are referenced by their index in the register file, immediates
+are stored as already parsed ints and jump targets are absolute positions.
+Instructions with a register and an immediate variant use separate opcodes,
+so the interpreter never has to look at the type of an operand.
+"""
+
+import typing
+
+MOV: int = 0
+MOVI: int = 1
+ADD: int = 2
+ADDI: int = 3
+SUB: int = 4
+SUBI: int = 5
+MUL: int = 6
+MULI: int = 7
+DIV: int = 8
+DIVI: int = 9
+MOD: int = 10
+MODI: int = 11
+PUSH: int = 12
+PUSHI: int = 13
+POP: int = 14
+JMP: int = 15
+JE: int = 16
+JG: int = 17
+JL: int = 18
+
+NAMES: typing.Dict[int, str] = {
+    MOV: "mov",
+    MOVI: "mov",
+    ADD: "add",
+    ADDI: "add",
+    SUB: "sub",
+    SUBI: "sub",
+    MUL: "mul",
+    MULI: "mul",
+    DIV: "div",
+    DIVI: "div",
+    MOD: "mod",
+    MODI: "mod",
+    PUSH: "push",
+    PUSHI: "push",
+    POP: "pop",
+    JMP: "jmp",
+    JE: "je",
+    JG: "jg",
+    JL: "jl",
+}
+
+# Mnemonic -> (register variant, immediate variant)
+ARITHMETIC: typing.Dict[str, typing.Tuple[int, int]] = {
+    "mov": (MOV, MOVI),
+    "add": (ADD, ADDI),
+    "sub": (SUB, SUBI),
+    "mul": (MUL, MULI),
+    "div": (DIV, DIVI),
+    "mod": (MOD, MODI),
+}
+
+CONDITIONAL_JUMPS: typing.Dict[str, int] = {"je": JE, "jg": JG, "jl": JL}
+
+# Opcodes, which write to register ``a``
+WRITES_REGISTER: typing.FrozenSet[int] = frozenset(
+    {MOV, MOVI, ADD, ADDI, SUB, SUBI, MUL, MULI, DIV, DIVI, MOD, MODI, POP}
+)
+
+JUMPS: typing.FrozenSet[int] = frozenset({JMP, JE, JG, JL})
+
+
+def disassemble(
+    instruction: typing.Tuple[int, int, int],
+    registers: str = "abcd",
+) -> str:
+    """
+    Return human-readable representation of a compiled instruction.
+    Example: (ADDI, 0, 5) -> add a 5
+    :param instruction: instruction to disassemble
+    :param registers: register names in register file order
+    :return: instruction text
+    """
+    op, a, b = instruction
+    name = NAMES[op]
+    if op == JMP:
+        return f"{name} {a}"
+
+    if op in CONDITIONAL_JUMPS.values():
+        return f"{name} {registers[a]} {b}"
+
+    if op == PUSHI:
+        return f"{name} {a}"
+
+    if op in {PUSH, POP}:
+        return f"{name} {registers[a]}"
+
+    if op in {MOVI, ADDI, SUBI, MULI, DIVI, MODI}:
+        return f"{name} {registers[a]} {b}"
+
+    return f"{name} {registers[a]} {registers[b]}"
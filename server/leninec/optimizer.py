@@ -0,0 +1,261 @@
+"""
+Peephole optimiser for compiled programs.
+
+Passes are repeated until the program stops changing:
+    jump threading      - jumps to `jmp` go straight to its target,
+                          jumps to the next instruction are removed
+    dead code removal   - instructions unreachable from position 0 are removed
+    constant folding    - `mov r N` followed by arithmetic on `r` with known
+                          operands becomes a single `mov r M`
+    redundant moves     - `mov r r` and moves overwritten by the next
+                          instruction are removed
+
+Optimised program produces the same stack, registers and errors as the
+source one, only in fewer steps. Folding never crosses a jump target and
+is skipped if any intermediate value overflows or a divisor is zero.
+`Program.source_map` maps positions back to the source program.
+"""
+
+import types
+import typing
+
+from . import opcodes
+from .program import Program
+from .vm import VM
+
+# Instruction with its position in the source program
+_Entry = typing.Tuple[int, int, int, int]
+
+FOLDABLE: typing.FrozenSet[int] = frozenset(
+    {
+        opcodes.MOV,
+        opcodes.MOVI,
+        opcodes.ADD,
+        opcodes.ADDI,
+        opcodes.SUB,
+        opcodes.SUBI,
+        opcodes.MUL,
+        opcodes.MULI,
+        opcodes.DIV,
+        opcodes.DIVI,
+        opcodes.MOD,
+        opcodes.MODI,
+    }
+)
+
+MAX_PASSES: int = 8
+
+
+def optimize(program: Program, max_value: int = VM.MAX_VALUE) -> Program:
+    """
+    Optimise compiled program.
+    :param program: program to optimise, can be already optimised
+    :param max_value: max absolute register value of the target VM
+    :return: optimised program with `source_map` set
+    """
+    size = len(program.instructions)
+    source_map = program.source_map or tuple(range(size + 1))
+    entries = [
+        (op, a, b, source_map[i]) for i, (op, a, b) in enumerate(program.instructions)
+    ]
+    # Position in `program` -> position in optimised program
+    positions = list(range(size + 1))
+    for _ in range(MAX_PASSES):
+        changed = False
+        for step in (_thread_jumps, _remove_dead_code, _fold_constants):
+            new_entries, relocation = step(entries, max_value)
+            if relocation is None:
+                entries = new_entries
+                continue
+
+            entries = _relocate(new_entries, relocation)
+            positions = [relocation[position] for position in positions]
+            changed = True
+
+        if not changed:
+            break
+
+    return Program(
+        tuple((op, a, b) for op, a, b, _ in entries),
+        types.MappingProxyType(
+            {label: positions[position] for label, position in program.labels.items()}
+        ),
+        tuple(entry[3] for entry in entries) + (source_map[-1],),
+    )
+
+
+def _targets(entries: typing.List[_Entry]) -> typing.Set[int]:
+    return {
+        a if op == opcodes.JMP else b for op, a, b, _ in entries if op in opcodes.JUMPS
+    }
+
+
+def _relocate(
+    entries: typing.List[typing.Optional[_Entry]],
+    relocation: typing.List[int],
+) -> typing.List[_Entry]:
+    """
+    Drop removed (None) entries and update jump targets.
+    """
+    result = []
+    for entry in entries:
+        if entry is None:
+            continue
+
+        op, a, b, source = entry
+        if op == opcodes.JMP:
+            entry = (op, relocation[a], b, source)
+        elif op in opcodes.JUMPS:
+            entry = (op, a, relocation[b], source)
+
+        result.append(entry)
+
+    return result
+
+
+def _relocation(entries: typing.List[typing.Optional[_Entry]]) -> typing.List[int]:
+    """
+    Map every old position to the first kept instruction at or after it.
+    """
+    relocation = []
+    kept = 0
+    for entry in entries:
+        relocation.append(kept)
+        if entry is not None:
+            kept += 1
+
+    relocation.append(kept)
+    return relocation
+
+
+def _thread_jumps(entries: typing.List[_Entry], max_value: int):
+    size = len(entries)
+
+    def destination(target: int) -> int:
+        seen = set()
+        while target < size and entries[target][0] == opcodes.JMP:
+            if target in seen:  # Infinite loop, keep it as is
+                return target
+
+            seen.add(target)
+            target = entries[target][1]
+
+        return target
+
+    result = list(entries)
+    removed = False
+    for i, (op, a, b, source) in enumerate(entries):
+        if op not in opcodes.JUMPS:
+            continue
+
+        target = destination(a if op == opcodes.JMP else b)
+        if target == i + 1:
+            result[i] = None
+            removed = True
+        elif op == opcodes.JMP:
+            result[i] = (op, target, b, source)
+        else:
+            result[i] = (op, a, target, source)
+
+    return (result, _relocation(result)) if removed else (result, None)
+
+
+def _remove_dead_code(entries: typing.List[_Entry], max_value: int):
+    size = len(entries)
+    reachable = [False] * size
+    pending = [0]
+    while pending:
+        position = pending.pop()
+        while position < size and not reachable[position]:
+            reachable[position] = True
+            op, a, b, _ = entries[position]
+            if op == opcodes.JMP:
+                position = a
+                continue
+
+            if op in opcodes.JUMPS:
+                pending.append(b)
+
+            position += 1
+
+    if all(reachable):
+        return entries, None
+
+    result = [entry if reachable[i] else None for i, entry in enumerate(entries)]
+    return result, _relocation(result)
+
+
+def _apply(op: int, left: int, right: int) -> typing.Optional[int]:
+    """Compute arithmetic instruction like VM does, None if it would fail."""
+    if op in {opcodes.MOV, opcodes.MOVI}:
+        return right
+
+    if op in {opcodes.ADD, opcodes.ADDI}:
+        return left + right
+
+    if op in {opcodes.SUB, opcodes.SUBI}:
+        return left - right
+
+    if op in {opcodes.MUL, opcodes.MULI}:
+        return left * right
+
+    if not right:
+        return None
+
+    if op in {opcodes.DIV, opcodes.DIVI}:
+        return left // right
+
+    return left % right
+
+
+def _fold_constants(entries: typing.List[_Entry], max_value: int):
+    targets = _targets(entries)
+    result: typing.List[typing.Optional[_Entry]] = list(entries)
+    removed = False
+    i = 0
+    while i < len(entries):
+        op, a, b, source = entries[i]
+        if op == opcodes.MOV and a == b:
+            result[i] = None
+            removed = True
+            i += 1
+            continue
+
+        if op != opcodes.MOVI:
+            i += 1
+            continue
+
+        value = b
+        end = i + 1
+        dead = False
+        while end < len(entries) and end not in targets:
+            next_op, next_a, next_b, _ = entries[end]
+            if next_op not in FOLDABLE or next_a != a:
+                break
+
+            if next_op & 1:
+                right = next_b
+            elif next_b == a:
+                right = value
+            else:
+                # Value is overwritten by another register before it is read
+                dead = next_op == opcodes.MOV
+                break
+
+            new_value = _apply(next_op, value, right)
+            if new_value is None or abs(new_value) > max_value:
+                break
+
+            value = new_value
+            end += 1
+
+        if dead:
+            result[i:end] = [None] * (end - i)
+            removed = True
+        elif end > i + 1:
+            result[i:end] = [(opcodes.MOVI, a, value, source)] + [None] * (end - i - 1)
+            removed = True
+
+        i = end
+
+    return (result, _relocation(result)) if removed else (result, None)
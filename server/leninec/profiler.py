@@ -0,0 +1,119 @@
+import time
+import typing
+
+from . import opcodes
+
+if typing.TYPE_CHECKING:
+    from .vm import VM
+
+
+class Profile:
+    """
+    Execution profile of a VM run. Set `VM.profile` to an instance to
+    collect it: VM then executes code step by step (see `VM.iter_steps`)
+    and updates the profile after every instruction. Profile is filled
+    even if VM raises an error, so it also shows where time-limited
+    programs spend their steps.
+
+    Collected statistics:
+        counts      - number of executions of every position
+        taken       - number of taken jumps of every position
+        opcodes     - number of executions and cumulative time of every opcode
+        max_stack   - max stack depth
+    Time includes VM bookkeeping, so it is only meaningful in comparison
+    with other opcodes of the same run.
+    """
+
+    VERSION: int = 1
+
+    def __init__(self, vm: "VM"):
+        self.instructions: typing.Tuple[typing.Tuple[int, int, int], ...] = (
+            vm.instructions
+        )
+        self.counts: typing.List[int] = [0] * len(vm.instructions)
+        self.taken: typing.List[int] = [0] * len(vm.instructions)
+        self.opcode_counts: typing.List[int] = [0] * len(opcodes.NAMES)
+        self.opcode_time: typing.List[float] = [0.0] * len(opcodes.NAMES)
+        self.max_stack: int = len(vm.stack)
+
+    @property
+    def steps(self) -> int:
+        """Number of profiled instructions"""
+        return sum(self.opcode_counts)
+
+    def iter_steps(
+        self,
+        vm: "VM",
+        events: typing.Iterator[typing.Tuple[int, int, int]],
+    ) -> typing.Iterator[typing.Tuple[int, int, int]]:
+        """
+        Profile step events of VM
+        :param vm: VM producing events
+        :param events: step events (see `VM.iter_steps`)
+        """
+        code = self.instructions
+        counts = self.counts
+        taken = self.taken
+        opcode_counts = self.opcode_counts
+        opcode_time = self.opcode_time
+        stack = vm.stack
+        clock = time.perf_counter
+        while (pos := vm.position) < len(code):
+            op = code[pos][0]
+            start = clock()
+            try:
+                event = next(events)
+            finally:
+                opcode_time[op] += clock() - start
+                opcode_counts[op] += 1
+                counts[pos] += 1
+                if len(stack) > self.max_stack:
+                    self.max_stack = len(stack)
+
+            if op == opcodes.JMP or (op in opcodes.JUMPS and event[0] != pos + 1):
+                taken[pos] += 1
+
+            yield event
+
+    def hot_positions(self, limit: int = 10) -> typing.List[int]:
+        """
+        Get most executed positions
+        :param limit: max number of positions
+        :return: positions, most executed first
+        """
+        return sorted(
+            (position for position, count in enumerate(self.counts) if count),
+            key=lambda position: -self.counts[position],
+        )[:limit]
+
+    def to_dict(self) -> dict:
+        jumps = []
+        for position, (op, a, b) in enumerate(self.instructions):
+            if op in opcodes.JUMPS and self.counts[position]:
+                jumps.append(
+                    {
+                        "position": position,
+                        "target": a if op == opcodes.JMP else b,
+                        "count": self.counts[position],
+                        "taken": self.taken[position],
+                    }
+                )
+
+        ops = {}
+        for op, count in enumerate(self.opcode_counts):
+            if count:
+                name = opcodes.NAMES[op]
+                total = ops.setdefault(name, {"count": 0, "time": 0.0})
+                total["count"] += count
+                total["time"] += self.opcode_time[op]
+
+        return {
+            "version": self.VERSION,
+            "steps": self.steps,
+            "time": sum(self.opcode_time),
+            "max_stack": self.max_stack,
+            "counts": self.counts,
+            "hot": self.hot_positions(),
+            "opcodes": ops,
+            "jumps": jumps,
+        }
@@ -0,0 +1,65 @@
+import types
+import typing
+
+from . import jit
+
+
+class _Program(typing.NamedTuple):
+    instructions: typing.Tuple[typing.Tuple[int, int, int], ...]
+    labels: typing.Mapping[str, int] = types.MappingProxyType({})
+    source_map: typing.Tuple[int, ...] = ()
+
+
+class Program(_Program):
+    """
+    Immutable compiled program, which can be shared between VMs.
+    Block functions (see `jit`) are compiled on first use and kept with the
+    program, so VMs sharing it share them too.
+    :param instructions: bytecode, see `opcodes`
+    :param labels: label name -> absolute position
+    :param source_map: position -> position in source program, with an extra
+        item for the end of program. Empty if program was not optimised
+    """
+
+    def __reduce__(self):
+        # mappingproxy can not be pickled
+        return _make_program, (self.instructions, dict(self.labels), self.source_map)
+
+    def source_position(self, position: int, failed: bool = False) -> int:
+        """
+        Map VM position to position in source program
+        :param position: position of the next instruction to execute
+        :param failed: True if VM stopped with an error, position then points
+            right after the instruction which failed
+        :return: position in source program
+        """
+        if not self.source_map:
+            return position
+
+        if failed and position:
+            return self.source_map[position - 1] + 1
+
+        return self.source_map[position]
+
+    def blocks(self, max_value: int, max_stack: int) -> typing.Dict[int, jit.Block]:
+        """
+        Get block functions of program, compiling them on first use
+        :param max_value: max absolute register value
+        :param max_stack: max stack size
+        :return: block start position -> (block function, number of instructions)
+        """
+        compiled = self.__dict__.setdefault("_blocks", {})
+        if (blocks := compiled.get((max_value, max_stack))) is None:
+            blocks = compiled[max_value, max_stack] = jit.compile_blocks(
+                self.instructions, max_value, max_stack
+            )
+
+        return blocks
+
+
+def _make_program(
+    instructions: typing.Tuple[typing.Tuple[int, int, int], ...],
+    labels: typing.Dict[str, int],
+    source_map: typing.Tuple[int, ...] = (),
+) -> Program:
+    return Program(instructions, types.MappingProxyType(labels), source_map)
@@ -1,76 +1,56 @@
 import typing
 
 
-class Registers(dict):
-    AVAILABLE_INSTRUCTIONS: typing.List[str] = ["add", "div", "mov", "mul", "sub"]
+class Registers(list):
+    """
+    Register file, subclass of list.
+    Registers are addressed by their index, names are only used
+    by the compiler and for representation.
+    Size of the register file is fixed, it is never resized after creation.
+    """
+
+    __slots__ = ("registers", "indexes")
 
     def __init__(self, registers: str):
         self.registers: str = registers  # skipcq: PTC-W0052
-        super().__init__()
-        for letter in registers:
-            self[letter] = 0
-
-    def __missing__(self, key: str):
-        return int(key)
-
-    def __contains__(self, key: str):
-        return key in self.registers
-
-    def execute(self, instruction: str, a: str, b: str):
-        """
-        Execute an instruction.
-        :param instruction: Instruction to execute.
-        :param a: First register.
-        :param b: Second register.
-        """
-        if instruction not in self.AVAILABLE_INSTRUCTIONS:
-            raise ValueError("Invalid instruction")
+        self.indexes: typing.Dict[str, int] = {
+            letter: i for i, letter in enumerate(registers)
+        }
+        super().__init__([0] * len(registers))
 
-        getattr(self, instruction)(a, b)
+    def reset(self):
+        """Set all registers to zero in place."""
+        self[:] = [0] * len(self)
 
-    def add(self, a: str, b: str):
-        """
-        Add the value of register b to the value of register a.
-        :param a: First register.
-        :param b: Second register.
-        """
-        self[a] += self[b]
+    def snapshot(self) -> typing.Tuple[int, ...]:
+        """Return immutable copy of register values."""
+        return tuple(self)
 
-    def div(self, a: str, b: str):
+    def restore(self, snapshot: typing.Sequence[int]):
         """
-        Divide the value of register a by the value of register b.
-        :param a: First register.
-        :param b: Second register.
+        Restore register values in place.
+        :param snapshot: values returned by `snapshot`
         """
-        self[a] //= self[b]
+        self[:] = snapshot
 
-    def mov(self, a: str, b: str):
-        """
-        Move value in register b to register a
-        :param a: register to move value in
-        :param b: register to get value from
-        """
-        self[a] = self[b]
+    def __repr__(self):
+        return f"Registers({self.as_dict()!r})"
 
-    def mul(self, a: str, b: str):
+    def get(self, name: str) -> int:
         """
-        Multiply register b by register a
-        :param a: register to multiply
-        :param b: register to multiply by
+        Get value of register by its name.
+        :param name: register name
+        :return: register value
         """
-        self[a] *= self[b]
+        return self[self.indexes[name]]
 
-    def sub(self, a: str, b: str):
-        """
-        Subtract register b from register a
-        :param a: register to subtract from
-        :param b: register to subtract
-        """
-        self[a] -= self[b]
+    def as_dict(self) -> typing.Dict[str, int]:
+        """Return mapping of register names to their values."""
+        return dict(zip(self.registers, self))
 
     def to_str(self) -> str:
         """
         Return a string representation of the registers.
         Example: 1|0|-5|1
         """
-        return "|".join(map(str, self.values()))
+        return "|".join(map(str, self))
@@ -0,0 +1,70 @@
+import asyncio
+import time
+import typing
+
+from .errors import StepLimitExceededError, TimeoutExceededError
+
+if typing.TYPE_CHECKING:
+    from .vm import VM
+
+
+class Scheduler:
+    """
+    Cooperative time slicer for VMs sharing one event loop.
+    Each VM runs for at most `slice_steps` instructions or `slice_time`
+    seconds, whichever comes first, and then yields to the event loop.
+    Yielded VMs are put at the end of the loop's ready queue, so all active
+    VMs and other coroutines (page loads, logins) are served round-robin.
+    """
+
+    def __init__(self, slice_steps: int = 10_000, slice_time: float = 0.005):
+        self.slice_steps: int = slice_steps
+        self.slice_time: float = slice_time
+        self.active: int = 0
+
+    async def checkpoint(self):
+        """Give other coroutines a chance to run."""
+        await asyncio.sleep(0)
+
+    async def run(
+        self,
+        vm: "VM",
+        timeout: typing.Optional[float] = None,
+        max_steps: typing.Optional[int] = None,
+    ) -> int:
+        """
+        Run VM to completion in time slices. Hooks are not called.
+        :param vm: VM to run
+        :param timeout: if specified, raises TimeoutExceededError
+        :param max_steps: if specified, raises StepLimitExceededError after
+            executing this many steps without finishing
+        :return: number of executed steps
+        """
+        steps = 0
+        start = time.perf_counter()
+        self.active += 1
+        try:
+            while True:
+                slice_steps = self.slice_steps
+                if max_steps is not None:
+                    slice_steps = min(slice_steps, max_steps - steps)
+
+                steps += vm.run_sync(
+                    max_steps=slice_steps,
+                    max_time=self.slice_time,
+                )
+                if vm.finished:
+                    return steps
+
+                if max_steps is not None and steps >= max_steps:
+                    raise StepLimitExceededError(f"Step limit of {max_steps} exceeded")
+
+                if timeout and time.perf_counter() - start > timeout:
+                    raise TimeoutExceededError(f"Timeout of {timeout} seconds exceeded")
+
+                await self.checkpoint()
+        finally:
+            self.active -= 1
+
+
+scheduler = Scheduler()
@@ -1,17 +1,15 @@
+import typing
+
+
 class Stack(list):
     """Stack class, subclass of list."""
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    __slots__ = ()
 
     def push(self, value):
         """Push a value to the stack."""
         self.append(value)
 
-    def pop(self):
-        """Pop a value from the stack."""
-        return super().pop()
-
     def __repr__(self):
         return f"Stack({super().__repr__()})"
 
@@ -22,6 +20,21 @@ class Stack(list):
         """
         return "|".join(map(str, self))
 
+    def reset(self):
+        """Remove all values in place."""
+        del self[:]
+
+    def snapshot(self) -> typing.Tuple[int, ...]:
+        """Return immutable copy of stack values, bottom first."""
+        return tuple(self)
+
+    def restore(self, snapshot: typing.Sequence[int]):
+        """
+        Restore stack values in place.
+        :param snapshot: values returned by `snapshot`
+        """
+        self[:] = snapshot
+
     @property
     def size(self):
         """Return the size of the stack."""
@@ -30,4 +43,4 @@ class Stack(list):
     @property
     def is_empty(self):
         """Return True if the stack is empty."""
-        return self.size == 0
+        return not self
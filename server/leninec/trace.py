@@ -0,0 +1,134 @@
+import base64
+import itertools
+import json
+import typing
+import zlib
+
+from .errors import StepLimitExceededError
+
+if typing.TYPE_CHECKING:
+    from .vm import VM
+
+# Values above this are not representable as JavaScript numbers
+MAX_SAFE_INTEGER: int = 2**53 - 1
+
+
+def _encode_value(value: int) -> typing.Union[int, str]:
+    return value if abs(value) <= MAX_SAFE_INTEGER else str(value)
+
+
+class Trace:
+    """
+    Compact execution trace, which can be replayed on the client side.
+    Each step is encoded as a list of integers:
+        [d]              - only position changed
+        [d, r, v]        - register r was set to v
+        [d, -1, v]       - v was pushed to stack
+        [d, r, v, -1]    - v was popped from stack to register r
+    where d is position delta relative to the previous step.
+    Values not representable in JavaScript are encoded as strings.
+    `truncated` is set if only the beginning of the run was recorded.
+    """
+
+    VERSION: int = 1
+
+    def __init__(self, vm: "VM"):
+        self.registers: typing.List[int] = list(vm.registers)
+        self.stack: typing.List[int] = list(vm.stack)
+        self.position: int = vm.position
+        self.steps: typing.List[typing.List[typing.Union[int, str]]] = []
+        self.truncated: bool = False
+
+    def record(self, vm: "VM", max_steps: typing.Optional[int] = None):
+        """
+        Run VM at full speed, recording every step. Hooks are not called.
+        If VM raises an error, steps executed before it are kept.
+        :param vm: VM to run, must be in the same state as when trace was created
+        :param max_steps: if specified, raises StepLimitExceededError after
+            recording this many steps
+        """
+        self._record(vm, max_steps)
+        if max_steps is not None and not vm.finished:
+            raise StepLimitExceededError(f"Step limit of {max_steps} exceeded")
+
+    async def record_async(
+        self,
+        vm: "VM",
+        max_steps: typing.Optional[int] = None,
+        max_recorded: typing.Optional[int] = None,
+    ):
+        """
+        Same as `record`, but yields to the event loop after every
+        `slice_steps` steps of VM's scheduler.
+        :param vm: VM to run, must be in the same state as when trace was created
+        :param max_steps: if specified, raises StepLimitExceededError after
+            executing this many steps
+        :param max_recorded: if specified, only this many steps are recorded
+            and `truncated` is set. The rest of the run is executed without
+            recording
+        """
+        executed = 0
+        while not vm.finished:
+            count = vm.scheduler.slice_steps
+            if max_steps is not None:
+                if executed >= max_steps:
+                    raise StepLimitExceededError(f"Step limit of {max_steps} exceeded")
+
+                count = min(count, max_steps - executed)
+
+            executed += self._record(vm, count, max_recorded)
+            await vm.scheduler.checkpoint()
+
+    def _record(
+        self,
+        vm: "VM",
+        count: typing.Optional[int] = None,
+        max_recorded: typing.Optional[int] = None,
+    ) -> int:
+        """
+        Execute at most `count` steps, recording them while trace is shorter
+        than `max_recorded`
+        :return: number of executed steps
+        """
+        steps = self.steps
+        registers = vm.registers
+        stack = vm.stack
+        last = vm.position
+        executed = 0
+        for executed, (pos, reg, stack_change) in enumerate(
+            itertools.islice(vm.iter_steps(), count), 1
+        ):
+            if max_recorded is not None and len(steps) >= max_recorded:
+                self.truncated = True
+                continue
+
+            if stack_change > 0:
+                steps.append([pos - last, -1, _encode_value(stack[-1])])
+            elif reg < 0:
+                steps.append([pos - last])
+            elif stack_change:
+                steps.append([pos - last, reg, _encode_value(registers[reg]), -1])
+            else:
+                steps.append([pos - last, reg, _encode_value(registers[reg])])
+
+            last = pos
+
+        return executed
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.VERSION,
+            "registers": list(map(_encode_value, self.registers)),
+            "stack": list(map(_encode_value, self.stack)),
+            "position": self.position,
+            "steps": self.steps,
+            "truncated": self.truncated,
+        }
+
+    def dump(self) -> str:
+        """
+        Return trace as base64-encoded zlib-compressed JSON
+        """
+        return base64.b64encode(
+            zlib.compress(json.dumps(self.to_dict(), separators=(",", ":")).encode())
+        ).decode()
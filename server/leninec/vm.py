@@ -1,11 +1,15 @@
 import asyncio
 import logging
 import time
+import types
 import typing
-from collections import deque
 
+from . import macros
+from . import opcodes
+from .cache import ProgramCache, program_cache
 from .errors import (
     CodeTooBigError,
+    InfiniteLoopError,
     InvalidArgError,
     InvalidInstructionError,
     InvalidLabelError,
@@ -14,13 +18,19 @@ from .errors import (
     MacroRedefinitionError,
     PopFromEmptyStackError,
     StackOverflowError,
+    StepLimitExceededError,
     TimeoutExceededError,
     UndefinedLabelError,
     UndefinedMacroError,
     ValueOverflowError,
     VMSyntaxError,
 )
+from .loops import LoopDetector
+from .macros import Macro
+from .profiler import Profile
+from .program import Program
 from .registers import Registers
+from .scheduler import Scheduler, scheduler
 from .stack import Stack
 
 logging.basicConfig(level=logging.INFO)
@@ -31,22 +41,51 @@ logger = logging.getLogger(__name__)
 # organizers. It was re-implemented from scratch by me.
 
 
+class State(typing.NamedTuple):
+    """
+    Immutable snapshot of VM state, see `VM.snapshot`.
+    :param position: position of the next instruction
+    :param registers: register values
+    :param stack: stack values, bottom first
+    :param steps: number of executed instructions
+    """
+
+    position: int
+    registers: typing.Tuple[int, ...]
+    stack: typing.Tuple[int, ...]
+    steps: int = 0
+
+
 class VM:
     MAX_STACK_SIZE: int = 10**3
     MAX_VALUE: int = 2**64 - 1
     MAX_CODE_SIZE: int = 2048
+    # Template items (instructions, labels and calls) all macro calls of a
+    # program may expand to
+    MAX_EXPANSION: int = 4 * MAX_CODE_SIZE
     VALID_NUMBERS: set = set(map(str, range(-999, 1000)))
+    REGISTERS: str = "abcd"
 
     def __init__(self):
         self._position_change_hooks: typing.List[callable] = []
         self._registers_change_hooks: typing.List[callable] = []
         self._stack_change_hooks: typing.List[callable] = []
-        self._labels: dict = {}
-
-        self.instructions: list = []
-        self.registers: Registers = None
-        self.stack: Stack = None
+        self._step_hooks: typing.List[callable] = []
+        self._labels: typing.Mapping[str, int] = {}
+
+        self.program: Program = Program(())
+        self.instructions: typing.Tuple[typing.Tuple[int, int, int], ...] = ()
+        self.registers: Registers = Registers(self.REGISTERS)
+        self.stack: Stack = Stack()
+        self.position: int = 0
+        self.steps: int = 0
         self.delay: float = 0.15
+        self.scheduler: Scheduler = scheduler
+        self.cache: typing.Optional[ProgramCache] = program_cache
+        self.jit: bool = True
+        self.detect_loops: bool = True
+        self._loops: LoopDetector = LoopDetector()
+        self.profile: typing.Optional[Profile] = None
 
     def add_position_change_hook(self, hook: callable):
         """
@@ -81,6 +120,17 @@ class VM:
         """Remove hook that is called when VM stack changes."""
         self._stack_change_hooks.remove(hook)
 
+    def add_step_hook(self, hook: callable):
+        """
+        Add hook that is called after each executed instruction.
+        Hook needs to accept one argument - step event (see `iter_steps`).
+        """
+        self._step_hooks.append(hook)
+
+    def remove_step_hook(self, hook: callable):
+        """Remove hook that is called after each executed instruction."""
+        self._step_hooks.remove(hook)
+
     def on_position_change(self, func: callable):
         """Decorator for adding position change hook."""
         self.add_position_change_hook(func)
@@ -96,85 +146,442 @@ class VM:
         self.add_stack_change_hook(func)
         return func
 
+    def on_step(self, func: callable):
+        """Decorator for adding step hook."""
+        self.add_step_hook(func)
+        return func
+
     def update_code(self, code: str):
-        """Update VM code. Resets VM state to initial values."""
+        """
+        Update VM code. Resets VM state to initial values.
+        Compiled programs are shared through `cache`, if it is set.
+        """
+        self.reset_state()
+        if self.cache is None:
+            self.load(self._compile(code))
+        else:
+            self.load(
+                self.cache.compile(
+                    code,
+                    self._compile,
+                    f"{self.REGISTERS}:{self.MAX_CODE_SIZE}:{self.MAX_EXPANSION}",
+                )
+            )
+
+    def load(
+        self,
+        program: typing.Union[Program, typing.Iterable[typing.Tuple[int, int, int]]],
+    ):
+        """
+        Load already compiled program or bare bytecode, e.g. received
+        from another process. Resets VM state to initial values.
+        If `profile` is set, it is replaced with an empty one.
+        """
         self.reset_state()
-        self._compile(code)
+        if not isinstance(program, Program):
+            program = Program(tuple(program))
+
+        self.program = program
+        self.instructions = program.instructions
+        self._labels = program.labels
+        if self.profile is not None:
+            self.profile = Profile(self)
 
     def reset_state(self):
-        """Reset VM state to initial values."""
-        self.stack = Stack()
-        self.registers = Registers("abcd")
+        """
+        Reset VM state to initial values. Register file and stack are
+        cleared in place, so references to them stay valid.
+        """
+        self.stack.reset()
+        self.registers.reset()
+        self.position = 0
+        self.steps = 0
+        self._loops.reset()
+
+    def snapshot(self) -> State:
+        """
+        Save current VM state. Snapshot does not depend on the VM and can be
+        restored any number of times, e.g. to run several tests from the same
+        initial state or to rewind a debugging session.
+        """
+        return State(
+            self.position,
+            self.registers.snapshot(),
+            self.stack.snapshot(),
+            self.steps,
+        )
+
+    def restore(self, state: State):
+        """
+        Restore VM state saved by `snapshot`. Register file and stack are
+        updated in place.
+        """
+        self.registers.restore(state.registers)
+        self.stack.restore(state.stack)
+        self.position = state.position
+        self.steps = state.steps
+        self._loops.reset()
+
+    def _infinite_loop(self, position: int) -> InfiniteLoopError:
+        labels = [name for name, pos in self._labels.items() if pos == position]
+        if labels:
+            return InfiniteLoopError(f"Infinite loop detected at label {labels[0]}")
+
+        return InfiniteLoopError(f"Infinite loop detected at position {position}")
 
     def check_state(self) -> bool:
         if self.stack.size > self.MAX_STACK_SIZE:
             raise StackOverflowError(f"Stack size exceeded {self.MAX_STACK_SIZE}")
 
-        if any(abs(v) > self.MAX_VALUE for v in self.registers.values()):
+        if any(abs(v) > self.MAX_VALUE for v in self.registers):
             raise ValueOverflowError(f"Value exceeded {self.MAX_VALUE}")
 
         return True
 
-    async def run(self, timeout: int = 300):
-        """Run VM code. If timeout is specified, raises TimeoutExceededError"""
-        if not self.instructions:
-            return
+    @property
+    def finished(self) -> bool:
+        """Return True if there are no more instructions to execute."""
+        return self.position >= len(self.instructions)
+
+    @property
+    def _has_hooks(self) -> bool:
+        return bool(
+            self._position_change_hooks
+            or self._registers_change_hooks
+            or self._stack_change_hooks
+            or self._step_hooks
+        )
+
+    def step(self) -> typing.Optional[typing.Tuple[int, int, int]]:
+        """
+        Execute single instruction. Hooks are not called.
+        :return: step event (see `iter_steps`) or None if VM is finished
+        """
+        return next(self.iter_steps(), None)
 
-        CONDITIONAL_JUMPS = {
-            "je": lambda a: self.registers[a] == 0,
-            "jg": lambda a: self.registers[a] > 0,
-            "jl": lambda a: self.registers[a] < 0,
-        }
+    def iter_steps(self) -> typing.Iterator[typing.Tuple[int, int, int]]:
+        """
+        Execute VM code from current position, yielding a step event
+        after each instruction. Hooks are not called.
+        Event is a tuple ``(position, register, stack)``, where ``position``
+        is the position of the next instruction, ``register`` is the index
+        of written register or -1 and ``stack`` is 1 for push, -1 for pop
+        and 0 if stack was not changed.
+        If `profile` is set, executed instructions are recorded to it.
+        """
+        if self.profile is not None:
+            return self.profile.iter_steps(self, self._iter_steps())
+
+        return self._iter_steps()
+
+    def _iter_steps(self) -> typing.Iterator[typing.Tuple[int, int, int]]:
+        self.check_state()
+
+        code = self.instructions
+        size = len(code)
+        regs = self.registers
+        stack = self.stack
+        max_value = self.MAX_VALUE
+        min_value = -max_value
+        max_stack = self.MAX_STACK_SIZE
+        loops = self._loops if self.detect_loops else None
+
+        pos = self.position
+        while pos < size:
+            op, a, b = code[pos]
+            self.position = pos = pos + 1
+            self.steps += 1
+            if op <= opcodes.MODI:
+                if op == opcodes.MOVI:
+                    value = b
+                elif op == opcodes.MOV:
+                    value = regs[b]
+                elif op == opcodes.ADDI:
+                    value = regs[a] + b
+                elif op == opcodes.ADD:
+                    value = regs[a] + regs[b]
+                elif op == opcodes.SUBI:
+                    value = regs[a] - b
+                elif op == opcodes.SUB:
+                    value = regs[a] - regs[b]
+                elif op == opcodes.MULI:
+                    value = regs[a] * b
+                elif op == opcodes.MUL:
+                    value = regs[a] * regs[b]
+                elif op == opcodes.DIVI:
+                    value = regs[a] // b
+                elif op == opcodes.DIV:
+                    value = regs[a] // regs[b]
+                elif op == opcodes.MODI:
+                    value = regs[a] % b
+                else:
+                    value = regs[a] % regs[b]
 
-        pos = 0
-        start = time.perf_counter()
-        while self.check_state() and pos < len(self.instructions):
-            cmd, *args = self.instructions[pos]
-            if cmd in self.registers.AVAILABLE_INSTRUCTIONS:
-                self.registers.execute(cmd, *args)
-                for hook in self._registers_change_hooks:
-                    await hook(self.registers)
+                regs[a] = value
+                if not min_value <= value <= max_value:
+                    raise ValueOverflowError(f"Value exceeded {max_value}")
 
-            if cmd in CONDITIONAL_JUMPS:
-                a, b = args
-                if CONDITIONAL_JUMPS[cmd](a):
-                    b = b[1:-1]
-                    pos = self._labels[b] - 1
-                    for hook in self._position_change_hooks:
-                        await hook(pos)
-            elif cmd == "jmp":
-                (a,) = args
-                a = a[1:-1]
-                pos = self._labels[a] - 1
-                for hook in self._position_change_hooks:
-                    await hook(pos)
-            elif cmd == "pop":
-                (a,) = args
-                if self.stack.is_empty:
+                yield pos, a, 0
+            elif op == opcodes.POP:
+                if not stack:
                     raise PopFromEmptyStackError("Cannot pop from empty stack")
 
-                self.registers[a] = self.stack.pop()
-                for hook in self._stack_change_hooks:
-                    await hook(self.stack)
+                value = regs[a] = stack.pop()
+                if not min_value <= value <= max_value:
+                    raise ValueOverflowError(f"Value exceeded {max_value}")
 
-                for hook in self._registers_change_hooks:
-                    await hook(self.registers)
+                yield pos, a, -1
+            elif op <= opcodes.PUSHI:
+                stack.append(a if op == opcodes.PUSHI else regs[a])
+                if len(stack) > max_stack:
+                    raise StackOverflowError(f"Stack size exceeded {max_stack}")
 
-            elif cmd == "push":
-                (a,) = args
-                self.stack.push(self.registers[a])
-                for hook in self._stack_change_hooks:
+                yield pos, -1, 1
+            else:
+                if (
+                    op == opcodes.JMP
+                    or (op == opcodes.JE and not regs[a])
+                    or (op == opcodes.JG and regs[a] > 0)
+                    or (op == opcodes.JL and regs[a] < 0)
+                ):
+                    self.position = pos = b if op != opcodes.JMP else a
+                    if loops is not None and loops.check(pos, regs, stack):
+                        raise self._infinite_loop(pos)
+
+                yield pos, -1, 0
+
+    def run_sync(
+        self,
+        max_steps: typing.Optional[int] = None,
+        timeout: typing.Optional[float] = None,
+        max_time: typing.Optional[float] = None,
+    ) -> int:
+        """
+        Run VM code from current position without calling any hooks.
+        If `jit` is set, code is executed block by block (see `jit`).
+        :param max_steps: if specified, pause after executing this many steps.
+            Execution can be resumed by calling `run_sync` again
+        :param timeout: if specified, raises TimeoutExceededError
+        :param max_time: if specified, pause after running for this many
+            seconds. Clock is checked every 256 steps
+        :return: number of executed steps
+        """
+        self.check_state()
+        if not self.jit:
+            return self._interpret(max_steps, timeout, max_time)
+
+        blocks = self.program.blocks(self.MAX_VALUE, self.MAX_STACK_SIZE)
+        size = len(self.instructions)
+        regs = self.registers
+        stack = self.stack
+        limit = -1 if max_steps is None else max_steps
+        check_clock = bool(timeout or max_time)
+        loops = self._loops if self.detect_loops else None
+
+        pos = self.position
+        steps = interpreted = 0
+        next_check = 256
+        start = time.perf_counter()
+        try:
+            while pos < size and steps != limit:
+                if (block := blocks.get(pos)) is not None:
+                    func, length = block
+                    if limit < 0 or steps + length <= limit:
+                        if (next_pos := func(regs, stack)) >= 0:
+                            pos = next_pos
+                            steps += length
+                            length = 0
+                            if loops is not None and loops.check(pos, regs, stack):
+                                self.position = pos
+                                raise self._infinite_loop(pos)
+                    else:
+                        length = limit - steps
+                else:
+                    # Resumed in the middle of a block
+                    length = 1
+                    while pos + length < size and pos + length not in blocks:
+                        length += 1
+
+                    if limit >= 0:
+                        length = min(length, limit - steps)
+
+                if length:
+                    # Block failed a check or does not fit into max_steps,
+                    # interpreter executes it and raises the same error
+                    self.position = pos
+                    length = self._interpret(length)
+                    steps += length
+                    interpreted += length
+                    pos = self.position
+
+                if check_clock and steps >= next_check:
+                    next_check = steps + 256
+                    elapsed = time.perf_counter() - start
+                    if timeout and elapsed > timeout:
+                        self.position = pos
+                        raise TimeoutExceededError(
+                            f"Timeout of {timeout} seconds exceeded"
+                        )
+
+                    if max_time and elapsed > max_time:
+                        break
+        finally:
+            # Steps executed by interpreter are already counted
+            self.steps += steps - interpreted
+
+        self.position = pos
+        return steps
+
+    def _interpret(
+        self,
+        max_steps: typing.Optional[int] = None,
+        timeout: typing.Optional[float] = None,
+        max_time: typing.Optional[float] = None,
+    ) -> int:
+        """
+        Execute VM code instruction by instruction, see `run_sync`.
+        """
+        code = self.instructions
+        size = len(code)
+        regs = self.registers
+        stack = self.stack
+        max_value = self.MAX_VALUE
+        min_value = -max_value
+        max_stack = self.MAX_STACK_SIZE
+        limit = -1 if max_steps is None else max_steps
+        check_clock = bool(timeout or max_time)
+        loops = self._loops if self.detect_loops else None
+
+        pos = self.position
+        steps = 0
+        start = time.perf_counter()
+        try:
+            while pos < size and steps != limit:
+                op, a, b = code[pos]
+                pos += 1
+                steps += 1
+                if op <= opcodes.MODI:
+                    if op == opcodes.MOVI:
+                        value = b
+                    elif op == opcodes.MOV:
+                        value = regs[b]
+                    elif op == opcodes.ADDI:
+                        value = regs[a] + b
+                    elif op == opcodes.ADD:
+                        value = regs[a] + regs[b]
+                    elif op == opcodes.SUBI:
+                        value = regs[a] - b
+                    elif op == opcodes.SUB:
+                        value = regs[a] - regs[b]
+                    elif op == opcodes.MULI:
+                        value = regs[a] * b
+                    elif op == opcodes.MUL:
+                        value = regs[a] * regs[b]
+                    elif op == opcodes.DIVI:
+                        value = regs[a] // b
+                    elif op == opcodes.DIV:
+                        value = regs[a] // regs[b]
+                    elif op == opcodes.MODI:
+                        value = regs[a] % b
+                    else:
+                        value = regs[a] % regs[b]
+
+                    regs[a] = value
+                    if not min_value <= value <= max_value:
+                        raise ValueOverflowError(f"Value exceeded {max_value}")
+                elif op >= opcodes.JMP:
+                    if (
+                        op == opcodes.JMP
+                        or (op == opcodes.JE and not regs[a])
+                        or (op == opcodes.JG and regs[a] > 0)
+                        or (op == opcodes.JL and regs[a] < 0)
+                    ):
+                        pos = b if op != opcodes.JMP else a
+                        if loops is not None and loops.check(pos, regs, stack):
+                            raise self._infinite_loop(pos)
+                elif op == opcodes.POP:
+                    if not stack:
+                        raise PopFromEmptyStackError("Cannot pop from empty stack")
+
+                    value = regs[a] = stack.pop()
+                    if not min_value <= value <= max_value:
+                        raise ValueOverflowError(f"Value exceeded {max_value}")
+                else:
+                    stack.append(a if op == opcodes.PUSHI else regs[a])
+                    if len(stack) > max_stack:
+                        raise StackOverflowError(f"Stack size exceeded {max_stack}")
+
+                if check_clock and not steps & 255:
+                    elapsed = time.perf_counter() - start
+                    if timeout and elapsed > timeout:
+                        raise TimeoutExceededError(
+                            f"Timeout of {timeout} seconds exceeded"
+                        )
+
+                    if max_time and elapsed > max_time:
+                        break
+        finally:
+            self.position = pos
+            self.steps += steps
+
+        return steps
+
+    async def run(
+        self,
+        timeout: typing.Optional[float] = 300,
+        max_steps: typing.Optional[int] = None,
+    ) -> int:
+        """
+        Run VM code from current position.
+        If max_steps is specified and VM executes that many instructions
+        without finishing, raises StepLimitExceededError.
+        If timeout is specified, raises TimeoutExceededError. Time spent
+        sleeping for `delay` does not count towards the timeout, so it only
+        guards against stuck hooks.
+        If `profile` is set, code is executed step by step to fill it.
+        :return: number of executed steps
+        """
+        if not self._has_hooks and not self.delay and self.profile is None:
+            return await self.scheduler.run(self, timeout=timeout, max_steps=max_steps)
+
+        position_hooks = self._position_change_hooks
+        registers_hooks = self._registers_change_hooks
+        stack_hooks = self._stack_change_hooks
+        step_hooks = self._step_hooks
+        slice_steps = self.scheduler.slice_steps
+
+        start = time.perf_counter()
+        steps = 0
+        for steps, event in enumerate(self.iter_steps(), 1):
+            pos, reg, stack = event
+            for hook in step_hooks:
+                await hook(event)
+
+            if stack:
+                for hook in stack_hooks:
                     await hook(self.stack)
 
+            if reg >= 0:
+                for hook in registers_hooks:
+                    await hook(self.registers)
+
             if timeout and time.perf_counter() - start > timeout:
                 raise TimeoutExceededError(f"Timeout of {timeout} seconds exceeded")
 
-            pos += 1
-            for hook in self._position_change_hooks:
+            if max_steps is not None and steps >= max_steps and not self.finished:
+                raise StepLimitExceededError(f"Step limit of {max_steps} exceeded")
+
+            for hook in position_hooks:
                 await hook(pos)
 
             if self.delay:
+                sleep_start = time.perf_counter()
                 await asyncio.sleep(self.delay)
+                start += time.perf_counter() - sleep_start
+            elif not steps % slice_steps:
+                await self.scheduler.checkpoint()
+
+        return steps
 
     def _check_reg(self, arg: str) -> bool:
         """
@@ -182,7 +589,7 @@ class VM:
         :param arg: argument to check
         :return: True if arg is a valid register, False otherwise
         """
-        return arg in self.registers
+        return len(arg) == 1 and arg in self.REGISTERS
 
     def _check_num(self, arg: str) -> bool:
         """
@@ -208,92 +615,205 @@ class VM:
         """
         return arg[0] == arg[-1] == '"'
 
-    def _compile(self, code: str):
+    def _compile(self, code: str) -> Program:
         """
-        Compile code to instructions
+        Compile code to bytecode. See `opcodes` for instruction format
         :param code: code to compile
-        :return: None
+        :return: compiled program
         """
+        registers = {letter: i for i, letter in enumerate(self.REGISTERS)}
+
+        def process_arithmetic(cmd: str, a: str, b: str):
+            reg_op, imm_op = opcodes.ARITHMETIC[cmd]
+            if b in registers:
+                instructions.append((reg_op, registers[a], registers[b]))
+            else:
+                instructions.append((imm_op, registers[a], int(b)))
+
+        def process_push(cmd: str, a: str):
+            if a in registers:
+                instructions.append((opcodes.PUSH, registers[a], 0))
+            else:
+                instructions.append((opcodes.PUSHI, int(a), 0))
+
+        def process_pop(cmd: str, a: str):
+            instructions.append((opcodes.POP, registers[a], 0))
 
         def process_conditional_jump(cmd: str, a: str, b: str):
-            nonlocal used_labels
             b = b[1:-1]
-            used_labels.add(b)
-            self.instructions.append((cmd, a, b))
-            self._labels[b] = len(self.instructions)
+            jumps.append((len(instructions), b))
+            instructions.append((opcodes.CONDITIONAL_JUMPS[cmd], registers[a], b))
 
         def process_basic_jump(cmd: str, a: str):
-            nonlocal used_labels
             a = a[1:-1]
-            used_labels.add(a)
-            self.instructions.append((cmd, a, None))
-            self._labels[a] = len(self.instructions)
+            jumps.append((len(instructions), a))
+            instructions.append((opcodes.JMP, a, 0))
 
         SCHEMA = {
-            "add": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "sub": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "mul": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "div": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "mod": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "pop": {"mask": (self._check_reg,)},
-            "push": {"mask": (self._check_reg_or_num,)},
-            "mov": {"mask": (self._check_reg, self._check_reg_or_num)},
-            "je": {
-                "mask": (self._check_reg, self._check_label),
-                "custom_hook": process_conditional_jump,
-            },
-            "jg": {
-                "mask": (self._check_reg, self._check_label),
-                "custom_hook": process_conditional_jump,
-            },
-            "jl": {
-                "mask": (self._check_reg, self._check_label),
-                "custom_hook": process_conditional_jump,
-            },
-            "jmp": {
-                "mask": (self._check_label,),
-                "custom_hook": process_basic_jump,
-            },
+            "add": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "sub": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "mul": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "div": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "mod": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "mov": ((self._check_reg, self._check_reg_or_num), process_arithmetic),
+            "pop": ((self._check_reg,), process_pop),
+            "push": ((self._check_reg_or_num,), process_push),
+            "je": ((self._check_reg, self._check_label), process_conditional_jump),
+            "jg": ((self._check_reg, self._check_label), process_conditional_jump),
+            "jl": ((self._check_reg, self._check_label), process_conditional_jump),
+            "jmp": ((self._check_label,), process_basic_jump),
         }
 
-        self._labels = {}
-        self.instructions = []
+        labels = {}
+        instructions = []
+        jumps = []
 
-        defines = {}
-        defines_count = {}
-        used_labels = set()
+        defines: typing.Dict[str, typing.Optional[Macro]] = {}
+        expanded = 0
 
-        lines = deque(line.strip() for line in code.splitlines())
-        while lines:
-            if len(self.instructions) > self.MAX_CODE_SIZE:
-                raise CodeTooBigError(
-                    f"Code size is {len(self.instructions)} while max is"
-                    f" {self.MAX_CODE_SIZE}"
-                )
-
-            line = lines.popleft().lower().strip()
+        def parse(line: str) -> typing.Optional[macros.Item]:
+            """Parse lowercased stripped line, None for empty lines and comments"""
             if not line or line.startswith("//"):
-                continue
+                return None
 
             if line.endswith("!"):  # Call macro
-                name = line[:-1]
-                if not (content := defines.get(name)):
-                    raise UndefinedMacroError(f"Macro {name} is not defined")
+                return macros.CALL, line[:-1]
+
+            if line.startswith("#define"):  # Define macro
+                return macros.DEFINE, line
+
+            if line == "#enddefine":  # End macro definition
+                raise VMSyntaxError("#enddefine used without #define")
+
+            if line.endswith(":"):  # Define label
+                label = line[:-1]
+                if len(label.split()) != 1:
+                    raise InvalidLabelError()
+
+                return macros.LABEL, label
+
+            cmd, *args = line.split()
+            if cmd not in SCHEMA:
+                raise InvalidInstructionError(f"Invalid instruction {cmd}")
+
+            check, process = SCHEMA[cmd]
+            if len(args) != len(check):
+                raise InvalidArgError(f"Invalid number of arguments for {cmd}")
+
+            for i, arg in enumerate(args):
+                if not check[i](arg):
+                    raise InvalidArgError(f"Invalid argument {arg} for {cmd}")
+
+            return macros.INSTRUCTION, (process, cmd, args)
+
+        def emit(kind: int, payload: typing.Any):
+            if kind == macros.LABEL:
+                if payload in labels:
+                    raise LabelRedefinitionError(f"Label {payload} is already defined")
+
+                labels[payload] = len(instructions)
+            else:
+                process, cmd, args = payload
+                process(cmd, *args)
+
+        def define(name: str, body: typing.List[str]) -> typing.Optional[Macro]:
+            if not body:
+                # Empty macro can not be called
+                return None
+
+            macro = Macro(name)
+            sample = f"{name}-0#"
+            for line in body:
+                if line.endswith(":"):
+                    macro.add(macros.PREFIXED_LABEL, line)
+                    continue
+
+                if slot := "{}" in line:
+                    if line.count("{}") > 1:
+                        raise InvalidMacroError("Too many '{}' in macro")
+
+                    # Prefix does not change kind of the line, so it is
+                    # checked once with the prefix of the first call
+                    item = parse(line.replace("{}", sample).lower().strip())
+                else:
+                    item = parse(line.lower().strip())
+
+                if item is None:
+                    continue
+
+                kind, payload = item
+                if kind == macros.DEFINE:
+                    raise InvalidMacroError("Macro can not be defined inside a macro")
+
+                if slot and kind == macros.CALL:
+                    raise InvalidMacroError("'{}' can not be used in macro call")
+
+                size = kind == macros.INSTRUCTION
+                if slot:
+                    macro.add(macros.SLOT, line, size)
+                else:
+                    macro.add(kind, payload, size)
 
-                label_prefix = f"{name}-{defines_count[name]}#"
-                for line_ in content:
-                    if line_.endswith(":"):
-                        line_ = label_prefix + line_
-                    elif "{}" in line_:
-                        if line_.count("{}") > 1:
-                            raise InvalidMacroError("Too many '{}' in macro")
+            return macro
 
-                        line_ = line_.format(label_prefix)
+        def resolve(name: str) -> Macro:
+            if not (macro := defines.get(name)):
+                raise UndefinedMacroError(f"Macro {name} is not defined")
 
-                    lines.appendleft(line_)
+            return macro
 
-                defines_count[name] += 1
-            elif line.startswith("#define"):  # Define macro
+        def expand(name: str):
+            nonlocal expanded
+            macro = resolve(name)
+            if (
+                size := len(instructions) + macros.measure(macro, resolve)
+            ) > self.MAX_CODE_SIZE:
+                raise CodeTooBigError(
+                    f"Code size is {size} while max is {self.MAX_CODE_SIZE}"
+                )
+
+            expanded += macro.expansion + 1
+            if expanded > self.MAX_EXPANSION:
+                raise CodeTooBigError(
+                    f"Macros expand to {expanded} items while max is"
+                    f" {self.MAX_EXPANSION}"
+                )
+
+            frames = [(macro.next_prefix(), iter(macro.body))]
+            while frames:
+                prefix, body = frames[-1]
+                if (item := next(body, None)) is None:
+                    frames.pop()
+                    continue
+
+                kind, payload = item
+                if kind == macros.PREFIXED_LABEL:
+                    item = parse((prefix + payload).lower().strip())
+                elif kind == macros.SLOT:
+                    item = parse(payload.replace("{}", prefix).lower().strip())
+
+                if item is None:
+                    continue
+
+                kind, payload = item
+                if kind == macros.CALL:
+                    callee = resolve(payload)
+                    frames.append((callee.next_prefix(), iter(callee.body)))
+                else:
+                    emit(kind, payload)
+
+        lines = [line.strip() for line in code.splitlines()]
+        index = 0
+        while index < len(lines):
+            line = lines[index].lower().strip()
+            index += 1
+            if (item := parse(line)) is None:
+                continue
+
+            kind, payload = item
+            if kind == macros.CALL:
+                expand(payload)
+            elif kind == macros.DEFINE:
                 line = line.split()
                 if len(line) != 2:
                     raise InvalidMacroError(f"Invalid macro definition: {line}")
@@ -302,48 +822,40 @@ class VM:
                 if name in defines:
                     raise MacroRedefinitionError(f"Macro {name} is already defined")
 
-                content = []
-                while lines:
-                    n = lines.popleft()
+                body = []
+                while index < len(lines):
+                    n = lines[index]
+                    index += 1
                     if n == "#enddefine":
                         break
 
                     if n == f"{name}!":
                         raise VMSyntaxError("Recursive macro call detected")
 
-                    content.append(n)
-
-                defines[name] = list(reversed(content))
-                defines_count[name] = 0
-            elif line == "#enddefine":  # End macro definition
-                raise VMSyntaxError("#enddefine used without #define")
-            elif line.endswith(":"):  # Define label
-                label = line[:-1]
-                if len(label.split()) != 1:
-                    raise InvalidLabelError()
+                    body.append(n)
 
-                if label in self._labels:
-                    raise LabelRedefinitionError(f"Label {label} is already defined")
-
-                self._labels[label] = len(self.instructions)
+                defines[name] = define(name, body)
             else:
-                cmd, *args = line.split()
-                if cmd not in SCHEMA:
-                    raise InvalidInstructionError(f"Invalid instruction {cmd}")
-
-                check = SCHEMA[cmd]["mask"]
-                if len(args) != len(check):
-                    raise InvalidArgError(f"Invalid number of arguments for {cmd}")
-
-                for i, arg in enumerate(args):
-                    if not check[i](arg):
-                        raise InvalidArgError(f"Invalid argument {arg} for {cmd}")
+                emit(kind, payload)
+                if len(instructions) > self.MAX_CODE_SIZE:
+                    raise CodeTooBigError(
+                        f"Code size is {len(instructions)} while max is"
+                        f" {self.MAX_CODE_SIZE}"
+                    )
+
+        if len(instructions) > self.MAX_CODE_SIZE:
+            raise CodeTooBigError(
+                f"Code size is {len(instructions)} while max is {self.MAX_CODE_SIZE}"
+            )
+
+        # Resolve jump targets to absolute positions
+        for index, label in jumps:
+            if label not in labels:
+                raise UndefinedLabelError(f"Label {label} is not defined")
 
-                if "custom_hook" in check:
-                    check["custom_hook"](cmd, *args)
-                else:
-                    self.instructions.append((cmd, *args))
+            op, a, b = instructions[index]
+            instructions[index] = (
+                (op, labels[label], 0) if op == opcodes.JMP else (op, a, labels[label])
+            )
 
-        for label in used_labels:
-            if label not in self._labels:
-                raise UndefinedLabelError(f"Label {label} is not defined")
+        return Program(tuple(instructions), types.MappingProxyType(labels))
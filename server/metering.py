@@ -0,0 +1,97 @@
+import collections
+import time
+import typing
+
+
+class StepMeter:
+    """
+    Per-user accounting of executed VM instructions over a rolling window.
+    Window is split into `buckets` equal time buckets, so memory per user is
+    bounded and old usage expires bucket by bucket.
+
+    A user, who executed more than `quota` instructions within the last
+    `window` seconds, is throttled until enough of the usage expires.
+    """
+
+    def __init__(
+        self,
+        window: float = 60,
+        quota: typing.Optional[int] = None,
+        buckets: int = 12,
+    ):
+        self.window: float = window
+        self.quota: typing.Optional[int] = quota
+        self.bucket_size: float = window / buckets
+        self.total: int = 0
+        self._swept: float = time.monotonic()
+        self._usage: typing.Dict[str, typing.Deque[typing.List[float]]] = {}
+
+    def _expire(self, username: str, now: float) -> typing.Deque[typing.List[float]]:
+        buckets = self._usage.get(username)
+        if buckets is None:
+            return collections.deque()
+
+        while buckets and buckets[0][0] <= now - self.window:
+            buckets.popleft()
+
+        if not buckets:
+            del self._usage[username]
+
+        return buckets
+
+    def record(self, username: str, steps: int):
+        """
+        Account executed instructions to user
+        :param username: user to account to
+        :param steps: number of executed instructions
+        """
+        if not steps:
+            return
+
+        now = time.monotonic()
+        if now - self._swept > self.window:
+            # Forget users, who were not active within the window
+            self._swept = now
+            for name in list(self._usage):
+                self._expire(name, now)
+
+        self._expire(username, now)
+        buckets = self._usage.setdefault(username, collections.deque())
+        start = now - now % self.bucket_size
+        if buckets and buckets[-1][0] == start:
+            buckets[-1][1] += steps
+        else:
+            buckets.append([start, steps])
+
+        self.total += steps
+
+    def usage(self, username: str) -> int:
+        """
+        Get number of instructions executed by user within the window
+        :param username: user to check
+        :return: number of instructions
+        """
+        return int(sum(steps for _, steps in self._expire(username, time.monotonic())))
+
+    def retry_after(self, username: str) -> float:
+        """
+        Get time until user is not throttled anymore
+        :param username: user to check
+        :return: seconds to wait, 0 if user is not throttled
+        """
+        if self.quota is None:
+            return 0
+
+        now = time.monotonic()
+        buckets = self._expire(username, now)
+        excess = sum(steps for _, steps in buckets) - self.quota
+        for start, steps in buckets:
+            if excess <= 0:
+                break
+
+            # Usage drops by this bucket, when it leaves the window
+            excess -= steps
+            if excess <= 0:
+                return max(start + self.window - now, 0)
+
+        return 0
@@ -0,0 +1,273 @@
+import bisect
+import contextlib
+import functools
+import math
+import threading
+import time
+import typing
+
+LabelValues = typing.Tuple[str, ...]
+
+# Latency buckets in seconds, from fast DB queries to long grading runs
+DEFAULT_BUCKETS: typing.Tuple[float, ...] = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    escaped = (
+        str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        for value in values
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of metrics. Metric is registered in `registry` on creation.
+    Values are kept per tuple of label values, in order of `labels`.
+    If `callback` is set, values are read from it on every scrape
+    instead: it returns a value or, for labelled metrics, a mapping of
+    label values to values.
+    """
+
+    TYPE: str = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        callback: typing.Optional[typing.Callable[[], typing.Any]] = None,
+        registry: typing.Optional["Registry"] = None,
+    ):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labels: typing.Tuple[str, ...] = tuple(labels)
+        self.callback: typing.Optional[typing.Callable[[], typing.Any]] = callback
+        self._values: typing.Dict[LabelValues, typing.Any] = {}
+        self._lock: threading.Lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _check(self, values: LabelValues):
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, LabelValues, float]]:
+        """
+        Get current samples
+        :return: (name suffix, label values, value) tuples
+        """
+        if self.callback is None:
+            with self._lock:
+                values = dict(self._values)
+        elif self.labels:
+            values = {
+                (key,) if isinstance(key, str) else tuple(key): value
+                for key, value in self.callback().items()
+            }
+        else:
+            values = {(): self.callback()}
+
+        for key, value in values.items():
+            yield "", key, value
+
+    def render(self) -> typing.List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for suffix, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(self.labels, values)}"
+                f" {_format_value(value)}"
+            )
+
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing value."""
+
+    TYPE = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        """
+        Increase counter
+        :param labels: label values
+        :param amount: non-negative amount to add
+        """
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value, which can go up and down."""
+
+    TYPE = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._check(labels)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    @contextlib.contextmanager
+    def track(self, *labels: str):
+        """Increase gauge while the block is running."""
+        self.inc(*labels)
+        try:
+            yield
+        finally:
+            self.dec(*labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values over fixed buckets. Observation is
+    a bisect and a few additions, so histograms are cheap enough for hot
+    paths.
+    """
+
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+        registry: typing.Optional["Registry"] = None,
+    ):
+        self.buckets: typing.Tuple[float, ...] = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry=registry)
+
+    def observe(self, value: float, *labels: str):
+        """
+        Record observed value
+        :param value: value, e.g. duration in seconds
+        :param labels: label values
+        """
+        self._check(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            if (state := self._values.get(labels)) is None:
+                # Per-bucket counts, then sum of values
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+            state[index] += 1
+            state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str):
+        """Observe duration of the block in seconds, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> typing.Iterator[typing.Tuple[str, LabelValues, float]]:
+        with self._lock:
+            values = {key: list(state) for key, state in self._values.items()}
+
+        for key, state in values.items():
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                total += count
+                yield "_bucket", key + (_format_value(bound),), total
+
+            yield "_sum", key, state[-1]
+            yield "_count", key, total
+
+    def render(self) -> typing.List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.TYPE}",
+        ]
+        for suffix, values, value in self.samples():
+            names = self.labels + ("le",) if suffix == "_bucket" else self.labels
+            lines.append(
+                f"{self.name}{suffix}{_format_labels(names, values)}"
+                f" {_format_value(value)}"
+            )
+
+        return lines
+
+
+class Registry:
+    """Collection of metrics, rendered in Prometheus text format."""
+
+    CONTENT_TYPE: str = "text/plain; version=0.0.4"
+
+    def __init__(self):
+        self._metrics: typing.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def timed(histogram: Histogram, *labels: str):
+    """
+    Decorator, which observes duration of every call of a sync function
+    :param histogram: histogram to observe durations in
+    :param labels: label values
+    """
+
+    def decorator(func: callable) -> callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+
+        return wrapper
+
+    return decorator
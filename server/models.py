@@ -16,6 +16,7 @@ class User(BaseModel):
     group: str
     taskstatus: str
     taskvars: int
+    taskmaxsteps: int = 0
 
     @classmethod
     def from_tuple(cls, user_tuple: tuple):
@@ -29,4 +30,5 @@ class User(BaseModel):
             group=user_tuple[6],
             taskstatus=user_tuple[7],
             taskvars=user_tuple[8],
+            taskmaxsteps=user_tuple[9] or 0,
         )
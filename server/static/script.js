@@ -65,60 +65,220 @@ function finish() {
 
 var inp = "";
 var running = false;
+var player = null;
+var pending = [];
 window.addEventListener('beforeunload', (event) => {
     if (running) {
         event.returnValue = `Are you sure you want to leave?`;
     }
 });
 
+function decode_trace(payload) {
+    const bytes = Uint8Array.from(atob(payload), (c) => c.charCodeAt(0));
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Response(stream).json();
+}
+
+// Plays back execution trace recorded by the server, see leninec/trace.py
+class TracePlayer {
+    constructor(trace, delay, onend) {
+        this.steps = trace.steps;
+        this.registers = trace.registers.slice();
+        this.stack = trace.stack.slice();
+        this.position = trace.position;
+        this.delay = delay * 1000;
+        this.onend = onend;
+        this.index = 0;
+        this.undo = [];
+        this.timer = null;
+        this.ended = false;
+    }
+
+    forward() {
+        if (this.index >= this.steps.length) return false;
+        const step = this.steps[this.index++];
+        const undo = [this.position];
+        this.position += step[0];
+        if (step.length == 3 && step[1] == -1) {
+            this.stack.push(step[2]);
+        } else if (step.length >= 3) {
+            undo.push(this.registers[step[1]]);
+            this.registers[step[1]] = step[2];
+            if (step.length == 4) this.stack.pop();
+        }
+        this.undo.push(undo);
+        return true;
+    }
+
+    backward() {
+        if (!this.index) return false;
+        const step = this.steps[--this.index];
+        const undo = this.undo.pop();
+        this.position = undo[0];
+        if (step.length == 3 && step[1] == -1) {
+            this.stack.pop();
+        } else if (step.length >= 3) {
+            this.registers[step[1]] = undo[1];
+            if (step.length == 4) this.stack.push(step[2]);
+        }
+        return true;
+    }
+
+    seek(index) {
+        while (this.index < index && this.forward());
+        while (this.index > index && this.backward());
+        this.render();
+    }
+
+    render() {
+        update_pos(this.position);
+        for (let i = 0; i < this.registers.length; i++) {
+            update_reg(i + 1, this.registers[i]);
+        }
+        document.querySelector(".stack").innerHTML = "";
+        this.stack.forEach(stack_push);
+        document.querySelector(".player .seek").value = this.index;
+    }
+
+    play() {
+        if (this.timer) return;
+        document.querySelector(".player .play").innerHTML = "⏸";
+        this.timer = setInterval(() => {
+            if (!this.forward()) {
+                this.pause();
+                this.end();
+                return;
+            }
+            this.render();
+        }, this.delay);
+    }
+
+    pause() {
+        clearInterval(this.timer);
+        this.timer = null;
+        document.querySelector(".player .play").innerHTML = "▶";
+    }
+
+    end() {
+        if (this.ended) return;
+        this.ended = true;
+        this.onend();
+    }
+}
+
+function start_player(trace, delay) {
+    player = new TracePlayer(trace, delay, () => {
+        pending.splice(0).forEach(handle_message);
+    });
+    document.querySelector(".player").style.display = "";
+    document.querySelector(".player .seek").max = trace.steps.length;
+    if (trace.truncated) {
+        update_res(`./run ${inp}<br>Trace shows the first ${trace.steps.length} steps only<br>`);
+    }
+    player.render();
+    player.play();
+}
+
+function delta_text(message) {
+    // msgpack deltas are arrays: [push, v], [pop], [reg, name, v], [pc, n]
+    if (!Array.isArray(message)) return message;
+    let [kind, ...args] = message;
+    return kind == "reg" ? `reg ${args[0]}=${args[1]}` : [kind, ...args].join(" ");
+}
+
+function handle_message(data) {
+    if (data.startsWith("pc ")) {
+        update_pos(parseInt(data.slice(3)));
+    } else if (data.startsWith("reg ")) {
+        let [name, value] = data.slice(4).split("=");
+        update_reg("abcd".indexOf(name) + 1, value);
+    } else if (data.startsWith("push ")) {
+        stack_push(data.slice(5));
+    } else if (data == "pop") {
+        stack_pop();
+    } else if (data.startsWith("@p")) {
+        let pos = parseInt(data.split(" ")[1]);
+        update_pos(pos);
+    } else if (data.startsWith("@r")) {
+        let registers = data.split(" ")[1].split("|");
+        for (let i = 0; i < registers.length; i++) {
+            update_reg(i + 1, registers[i]);
+        }
+    } else if (data.startsWith("@s")) {
+        let stack = data.split(" ")[1].split("|");
+        document.querySelector(".stack").innerHTML = "";
+        for (let i = 0; i < stack.length; i++) {
+            stack_push(stack[i]);
+        }
+    } else if (data.startsWith("@f")) {
+        finish();
+    } else if (data.startsWith("@e")) {
+        update_res(`./run ${inp}<br><span class="error">${data.split(" ").slice(1).join(" ")}</span>`);
+    } else if (data.startsWith("@i")) {
+        inp = data.split(" ").slice(1).join(" ");
+        update_res(`./run ${inp}<br>`);
+    } else if (data.startsWith("@o")) {
+        data = data.split(" ").slice(1).join(" ");
+        if (data == "OK") {
+            data = '<span class="green">Все тесты пройдены!</span>';
+            $(".run_btn").addClass("disabled");
+            setTimeout(() => {window.location.reload();}, 3000);
+        }
+        update_res(`./run ${inp}<br>Output: ${data}<br>leninec@vm:# $ `);
+    }
+}
+
 function run(code) {
     running = true;
+    player = null;
+    pending = [];
+    document.querySelector(".player").style.display = "none";
     document.querySelector(".result").innerHTML = "leninec@vm:# $ ./run";
     var socket = new WebSocket(SOCKET_URL);
+    socket.binaryType = "arraybuffer";
+    var speed_map = { "1": 0.15, "2": 0.075, "5": 0.03, "0": 0, "0.5": 0.3, "0.25": 0.6 };
+    var delay = speed_map[document.querySelector(".wrapper-speed select").value];
+    var loading = null;
     socket.onopen = (e) => {
         console.log("[open] Connection established");
         console.log("Sending to server");
-        var speed_map = { "1": 0.15, "2": 0.075, "5": 0.03, "0": 0, "0.5": 0.3, "0.25": 0.6 };
-        socket.send(`@d ${speed_map[document.querySelector(".wrapper-speed select").value]}`);
+        socket.send(`@d ${delay}`);
+        // Binary frames are smaller, but need a msgpack decoder
+        socket.send(window.MessagePack ? "@v 2 msgpack" : "@v 2");
+        if (window.DecompressionStream) {
+            socket.send("@trace");
+        }
         socket.send(code);
     };
 
     socket.onmessage = (event) => {
-        console.log(`[message] Data received from server: ${event.data}`);
-        if (event.data.startsWith("@p")) {
-            let pos = parseInt(event.data.split(" ")[1]);
-            update_pos(pos);
-        } else if (event.data.startsWith("@r")) {
-            let registers = event.data.split(" ")[1].split("|");
-            for (let i = 0; i < registers.length; i++) {
-                update_reg(i + 1, registers[i]);
-            }
-        } else if (event.data.startsWith("@s")) {
-            let stack = event.data.split(" ")[1].split("|");
-            document.querySelector(".stack").innerHTML = "";
-            for (let i = 0; i < stack.length; i++) {
-                stack_push(stack[i]);
-            }
-        } else if (event.data.startsWith("@f")) {
-            finish();
-        } else if (event.data.startsWith("@e")) {
-            update_res(`./run ${inp}<br><span class="error">${event.data.split(" ").slice(1).join(" ")}</span>`);
-        } else if (event.data.startsWith("@i")) {
-            inp = event.data.split(" ").slice(1).join(" ");
-            update_res(`./run ${inp}<br>`);
-        } else if (event.data.startsWith("@o")) {
-            data = event.data.split(" ").slice(1).join(" ");
-            if (data == "OK") {
-                data = '<span class="green">Все тесты пройдены!</span>';
-                $(".run_btn").addClass("disabled");
-                setTimeout(() => {window.location.reload();}, 3000);
-            }
-            update_res(`./run ${inp}<br>Output: ${data}<br>leninec@vm:# $ `);
+        // Protocol v2 frames hold every message since the previous frame,
+        // messages sent before it is negotiated come one per frame
+        let messages;
+        if (event.data instanceof ArrayBuffer) {
+            messages = MessagePack.decode(new Uint8Array(event.data)).map(delta_text);
+        } else {
+            messages = event.data.startsWith("[") ? JSON.parse(event.data) : [event.data];
         }
+        console.log(`[message] Data received from server: ${messages.join("\n").slice(0, 100)}`);
+        messages.forEach((data) => {
+            if (data.startsWith("@t ")) {
+                loading = decode_trace(data.slice(3)).then((trace) => start_player(trace, delay));
+            } else if (loading) {
+                // Results are shown after the trace is played back
+                pending.push(data);
+            } else {
+                handle_message(data);
+            }
+        });
     };
 
     socket.onclose = (event) => {
-        finish();
+        if (loading) {
+            pending.push("@f");
+        } else {
+            finish();
+        }
     };
 
     socket.onerror = function (error) {
@@ -126,6 +286,41 @@ function run(code) {
     };
 }
 
+document.querySelector(".player .play").addEventListener("click", function () {
+    if (!player) return;
+    if (player.timer) {
+        player.pause();
+    } else {
+        player.play();
+    }
+});
+
+document.querySelector(".player .back").addEventListener("click", function () {
+    if (!player) return;
+    player.pause();
+    player.seek(player.index - 1);
+});
+
+document.querySelector(".player .forward").addEventListener("click", function () {
+    if (!player) return;
+    player.pause();
+    player.seek(player.index + 1);
+    if (player.index == player.steps.length) player.end();
+});
+
+document.querySelector(".player .rewind").addEventListener("click", function () {
+    if (!player) return;
+    player.pause();
+    player.seek(0);
+});
+
+document.querySelector(".player .seek").addEventListener("input", function () {
+    if (!player) return;
+    player.pause();
+    player.seek(parseInt(this.value));
+    if (player.index == player.steps.length) player.end();
+});
+
 document.querySelector(".run-btn").addEventListener("click", function () {
     if (this.classList.contains("disabled")) return;
     Prism.highlightAll();
@@ -18,6 +18,7 @@ function fetch_students() {
 function fetch_task() {
     let group = $("#group-picker").val();
     $.get(`/groups/${group}/task`, (data) => {
+        $("#max-steps").val(data.taskmaxsteps || "");
         if (data.task) {
             $("#task code").html(data.task);
             if (data.template) {
@@ -33,6 +34,39 @@ function fetch_task() {
     });
 }
 
+const REGRADE_STATUSES = {
+    running: "идёт",
+    done: "завершена",
+    cancelled: "отменена, задание изменилось",
+    failed: "ошибка",
+};
+var regrade_timer = null;
+
+function show_regrade(job) {
+    if (!job) {
+        $("#regrade-status").text("");
+        return;
+    }
+    let verdicts = Object.entries(job.verdicts).map(([verdict, count]) => `${verdict}: ${count}`).join(", ");
+    $("#regrade-status").text(`Перепроверка ${REGRADE_STATUSES[job.status] || job.status}: ${job.done}/${job.total}${verdicts ? ` (${verdicts})` : ""}`);
+}
+
+function fetch_regrade() {
+    clearTimeout(regrade_timer);
+    let group = $("#group-picker").val();
+    $.get(`/groups/${group}/regrade`, (data) => {
+        if (group != $("#group-picker").val()) return;
+        show_regrade(data.job);
+        if (data.job.status == "running") {
+            regrade_timer = setTimeout(fetch_regrade, 1000);
+        } else {
+            fetch_students();
+        }
+    }).fail(() => {
+        show_regrade(null);
+    });
+}
+
 
 var editor = document.getElementById("editor")
 var preview = document.getElementById("preview")
@@ -97,6 +131,7 @@ document.querySelector("pre").addEventListener("paste", function (e) {
 $("#group-picker")[0].addEventListener("change", () => {
     fetch_students();
     fetch_task();
+    fetch_regrade();
 });
 
 $("#templates")[0].addEventListener("change", () => {
@@ -111,7 +146,8 @@ $("#templates")[0].addEventListener("change", () => {
 $("#save-task").on("click", () => {
     let group = $("#group-picker").val();
     let task = $("#task code").html();
-    $.post(`/groups/${group}/task`, { task: task }, (data) => {
+    let max_steps = $("#max-steps").val() || 0;
+    $.post(`/groups/${group}/task`, { task: task, max_steps: max_steps }, (data) => {
         if (data.ok) {
             alert("Задание успешно сохранено!");
         }
@@ -141,8 +177,24 @@ $("#delete-task").on("click", () => {
     });
 });
 
+$("#regrade").on("click", () => {
+    let group = $("#group-picker").val();
+    $.post(`/groups/${group}/regrade`, () => {
+        fetch_regrade();
+    }).fail((data) => {
+        if (data.status == 409) {
+            fetch_regrade();
+        } else if (data.status == 400) {
+            alert("Для этого класса нет задания");
+        } else {
+            alert("Произошла ошибка при запуске перепроверки!");
+        }
+    });
+});
+
 
 fetch_students();
 fetch_task();
+fetch_regrade();
 
 setInterval(() => { fetch_students(); }, 3000);
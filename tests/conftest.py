@@ -0,0 +1,23 @@
+import pathlib
+import sys
+import typing
+
+import pytest
+
+# Server modules are imported the same way app.py does
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "server"))
+
+import leninec  # noqa: E402
+
+
+@pytest.fixture
+def compile_program() -> typing.Callable[[str], leninec.Program]:
+    """Compile source without the shared program cache."""
+
+    def compile_program(source: str) -> leninec.Program:
+        vm = leninec.VM()
+        vm.cache = None
+        vm.update_code(source)
+        return vm.program
+
+    return compile_program
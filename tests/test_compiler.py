@@ -0,0 +1,97 @@
+import pytest
+
+import leninec
+from leninec import opcodes
+from leninec.cache import ProgramCache
+
+
+def test_registers_and_immediates_use_separate_opcodes(compile_program):
+    program = compile_program("pop a\nadd a b\nadd a 3\npush a\npush 5")
+    assert program.instructions == (
+        (opcodes.POP, 0, 0),
+        (opcodes.ADD, 0, 1),
+        (opcodes.ADDI, 0, 3),
+        (opcodes.PUSH, 0, 0),
+        (opcodes.PUSHI, 5, 0),
+    )
+
+
+def test_jumps_target_label_positions(compile_program):
+    program = compile_program('pop a\nloop:\nsub a 1\njg a "loop"\njmp "end"\nend:')
+    assert program.labels == {"loop": 1, "end": 4}
+    assert program.instructions[2:] == ((opcodes.JG, 0, 1), (opcodes.JMP, 4, 0))
+
+
+def test_comments_and_case_are_ignored(compile_program):
+    assert compile_program("// add\n  POP A  \n\nPush a") == compile_program(
+        "pop a\npush a"
+    )
+
+
+@pytest.mark.parametrize(
+    "source, error",
+    [
+        ("bogus a", leninec.InvalidInstructionError),
+        ("mov a 1000", leninec.InvalidArgError),
+        ("add a", leninec.InvalidArgError),
+        ('jmp "nowhere"', leninec.UndefinedLabelError),
+        ("l:\nl:", leninec.LabelRedefinitionError),
+        ("m!", leninec.UndefinedMacroError),
+        (
+            "#define m\n#enddefine\n#define m\n#enddefine",
+            leninec.MacroRedefinitionError,
+        ),
+        ("push a\n" * (leninec.VM.MAX_CODE_SIZE + 1), leninec.CodeTooBigError),
+    ],
+)
+def test_invalid_programs(compile_program, source: str, error: type):
+    with pytest.raises(error):
+        compile_program(source)
+
+
+def test_macro_labels_are_local_to_each_call(compile_program):
+    program = compile_program(
+        '#define m\njg a "{}skip"\nadd b 1\nskip:\n#enddefine\npop a\nm!\nm!'
+    )
+    first, second = program.instructions[1], program.instructions[3]
+    assert first == (opcodes.JG, 0, 3)
+    assert second == (opcodes.JG, 0, 5)
+
+
+@pytest.mark.parametrize("body", [["add a 1"], ["// nothing"], [""], ["{}skip:"]])
+def test_macro_bomb_is_rejected_before_expansion(compile_program, body):
+    lines = ["#define m0", *body, "#enddefine"]
+    for level in range(1, 25):
+        lines.extend([f"#define m{level}", *[f"m{level - 1}!"] * 10, "#enddefine"])
+
+    with pytest.raises(leninec.CodeTooBigError):
+        compile_program("\n".join([*lines, "m24!"]))
+
+
+def test_cache_key_ignores_formatting_outside_of_macros():
+    assert ProgramCache.key("pop a\n// comment\n\n  push a") == ProgramCache.key(
+        "pop a\npush a"
+    )
+
+
+def test_cache_key_keeps_macro_bodies(compile_program):
+    empty = "#define m\n#enddefine\nm!"
+    commented = "#define m\n// nothing\n#enddefine\nm!"
+    assert ProgramCache.key(empty) != ProgramCache.key(commented)
+    with pytest.raises(leninec.UndefinedMacroError):
+        compile_program(empty)
+
+    assert compile_program(commented).instructions == ()
+
+
+def test_blocks_are_compiled_once_per_program(compile_program):
+    program = compile_program('pop a\nloop:\nsub a 1\njg a "loop"\npush a')
+    blocks = program.blocks(leninec.VM.MAX_VALUE, leninec.VM.MAX_STACK_SIZE)
+    for inp in (3, 5):
+        vm = leninec.VM()
+        vm.load(program)
+        vm.stack.push(inp)
+        vm.run_sync()
+        assert list(vm.stack) == [0]
+
+    assert program.blocks(leninec.VM.MAX_VALUE, leninec.VM.MAX_STACK_SIZE) is blocks
@@ -0,0 +1,91 @@
+import asyncio
+import json
+import typing
+
+import pytest
+from fastapi import WebSocketDisconnect
+
+from events import EventChannel
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.frames: typing.List[typing.Union[str, bytes]] = []
+
+    async def send_text(self, data: str):
+        self.frames.append(data)
+
+    async def send_bytes(self, data: bytes):
+        self.frames.append(data)
+
+
+def publish(messages, snapshot=None, batch=False, **kwargs) -> list:
+    """Publish all messages before the sender runs, return sent frames"""
+
+    async def main():
+        websocket = FakeWebSocket()
+        async with EventChannel(websocket, tick=0, **kwargs) as channel:
+            channel.batch = batch
+            channel.snapshot = snapshot
+            for message in messages:
+                channel.publish(message)
+
+        return websocket.frames
+
+    return asyncio.run(main())
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        EventChannel(FakeWebSocket(), policy="block")
+
+
+def test_one_frame_per_message():
+    messages = ["@i [1]", "@e first line\nsecond line", "@f"]
+    assert publish(messages) == messages
+
+
+def test_batched_frame():
+    messages = ["@i [1]", "@e first line\nsecond line", "@f"]
+    (frame,) = publish(messages, batch=True)
+    assert json.loads(frame) == messages
+
+
+def test_drop_policy_drops_oldest_state():
+    messages = ["@i [1]"] + [f"@p {i}" for i in range(10)]
+    frames = publish(messages, policy="drop", max_pending=4)
+    assert frames == ["@i [1]", "@p 7", "@p 8", "@p 9"]
+
+
+def test_latest_policy_keeps_latest_state_of_each_kind():
+    messages = [f"@{kind} {i}" for i in range(10) for kind in "prs"] + ["@f"]
+    frames = publish(messages, policy="latest", max_pending=8)
+    assert len(frames) <= 8
+    assert frames[-4:] == ["@p 9", "@r 9", "@s 9", "@f"]
+
+
+def test_deltas_are_replaced_by_snapshot():
+    messages = ["@i [1]"] + ["pc 1", "push 2", "pop"] * 3
+    frames = publish(
+        messages,
+        snapshot=lambda: ["@r 1|0|0|0", "@s 2", "@p 3"],
+        policy="latest",
+        max_pending=4,
+    )
+    assert frames[:4] == ["@i [1]", "@r 1|0|0|0", "@s 2", "@p 3"]
+
+
+def test_disconnect_policy():
+    async def main():
+        async with EventChannel(
+            FakeWebSocket(), tick=0, max_pending=2, policy="disconnect"
+        ) as channel:
+            channel.publish("@p 1")
+            channel.publish("@p 2")
+            with pytest.raises(WebSocketDisconnect):
+                channel.publish("@p 3")
+
+            with pytest.raises(WebSocketDisconnect):
+                channel.publish("@f")
+
+    asyncio.run(main())
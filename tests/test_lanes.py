@@ -0,0 +1,86 @@
+import pytest
+
+import leninec
+from leninec import lanes, opcodes
+from leninec.lanes import run_lanes
+
+needs_numpy = pytest.mark.skipif(lanes.np is None, reason="numpy is not installed")
+
+LANES = lanes.MIN_VECTOR_LANES
+
+DIVISORS = """\
+pop a
+pop b
+div a b
+mod b 3
+push a
+push b
+"""
+
+
+def results(program, stacks, **kwargs):
+    return [
+        (lane.registers, lane.stack, lane.position, type(lane.error), lane.steps)
+        for lane in run_lanes(program, stacks, **kwargs)
+    ]
+
+
+@needs_numpy
+@pytest.mark.parametrize("vectorize", [False, True])
+def test_lanes_match_vm(compile_program, vectorize):
+    program = compile_program(DIVISORS)
+    stacks = [[divisor - LANES // 2, 100 + divisor] for divisor in range(LANES)]
+    expected = []
+    for stack in stacks:
+        vm = leninec.VM()
+        vm.load(program)
+        vm.stack.extend(stack)
+        error = None
+        try:
+            vm.run_sync()
+        except (leninec.errors.VMError, ZeroDivisionError) as e:
+            error = e
+
+        expected.append(
+            (tuple(vm.registers), tuple(vm.stack), vm.position, type(error), vm.steps)
+        )
+
+    assert results(program, stacks, vectorize=vectorize) == expected
+
+
+@needs_numpy
+def test_immediate_zero_divisor(compile_program):
+    program = compile_program("pop a\ndiv a 0\npush a")
+    vector = results(program, [[n] for n in range(LANES)], vectorize=True)
+    assert vector == results(program, [[n] for n in range(LANES)], vectorize=False)
+    assert {lane[3] for lane in vector} == {ZeroDivisionError}
+
+
+@needs_numpy
+def test_wide_lanes_continue_in_vm(compile_program):
+    program = compile_program("pop a\nmul a a\nmul a a\npush a")
+    stacks = [[2**20 + n] for n in range(LANES)] + [[2**40]]
+    assert results(program, stacks, vectorize=True) == results(
+        program, stacks, vectorize=False
+    )
+
+
+@needs_numpy
+def test_wide_constant_is_counted_once():
+    program = leninec.Program(((opcodes.MOVI, 0, 2**40), (opcodes.PUSH, 0, 0)))
+    for max_steps in (None, 2):
+        vector = results(program, [[1]] * LANES, vectorize=True, max_steps=max_steps)
+        scalar = results(program, [[1]] * LANES, vectorize=False, max_steps=max_steps)
+        assert vector == scalar
+        assert vector[0][3:] == (type(None), 2)
+
+
+@pytest.mark.parametrize("vectorize", [False, True] if lanes.np else [False])
+def test_step_limit(compile_program, vectorize):
+    program = compile_program('pop a\nloop:\nsub a 1\njg a "loop"')
+    limited = results(
+        program, [[5], [500]] * (LANES // 2), vectorize=vectorize, max_steps=100
+    )
+    assert limited[0][3] is type(None)
+    assert limited[1][3] is leninec.StepLimitExceededError
+    assert limited[1][4] == 100
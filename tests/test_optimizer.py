@@ -0,0 +1,58 @@
+import pytest
+
+import leninec
+from leninec import opcodes
+from leninec.lanes import run_lanes
+
+
+def run(program: leninec.Program, inputs):
+    return [
+        (lane.stack, lane.registers, type(lane.error))
+        for lane in run_lanes(program, [list(reversed(inp)) for inp in inputs])
+    ]
+
+
+def test_constants_are_folded(compile_program):
+    program = compile_program("pop a\nmov b 5\nadd b 3\nmul b 2\nadd a b\npush a")
+    optimized = leninec.optimize(program)
+    assert optimized.instructions == (
+        (opcodes.POP, 0, 0),
+        (opcodes.MOVI, 1, 16),
+        (opcodes.ADD, 0, 1),
+        (opcodes.PUSH, 0, 0),
+    )
+    assert run(optimized, [[1], [7]]) == run(program, [[1], [7]])
+
+
+def test_folding_stops_at_jump_targets(compile_program):
+    program = compile_program(
+        'pop a\nmov b 1\nloop:\nadd b 2\nsub a 1\njg a "loop"\npush b'
+    )
+    optimized = leninec.optimize(program)
+    assert (opcodes.ADDI, 1, 2) in optimized.instructions
+    assert run(optimized, [[3], [1]]) == run(program, [[3], [1]])
+
+
+def test_division_by_zero_is_not_folded(compile_program):
+    program = compile_program("mov b 5\ndiv b 0\npush b")
+    optimized = leninec.optimize(program)
+    assert run(optimized, [[]]) == run(program, [[]])
+    assert run(optimized, [[]])[0][2] is ZeroDivisionError
+
+
+def test_jumps_are_threaded_and_dead_code_removed(compile_program):
+    program = compile_program('jmp "a"\npush 1\na:\njmp "b"\npush 2\nb:\npush 3')
+    assert leninec.optimize(program).instructions == ((opcodes.PUSHI, 3, 0),)
+
+
+@pytest.mark.parametrize("inp", [[4], [0]])
+def test_positions_map_back_to_source(compile_program, inp):
+    program = compile_program("pop a\nmov b 2\nmul b 3\ndiv b a\npush b")
+    optimized = leninec.optimize(program)
+    (source,) = run_lanes(program, [list(reversed(inp))])
+    (result,) = run_lanes(optimized, [list(reversed(inp))])
+    position = optimized.source_position(
+        result.position, failed=result.error is not None
+    )
+    assert position == source.position
+    assert result.steps < source.steps